@@ -0,0 +1,7 @@
+# Инструменты для замеров производительности бота.
+
+import os
+import tempfile
+
+# Замеры не пишут в bot.log репозитория: лог запущенного или импортированного main.py - во временном каталоге.
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "bench_bot.log"))
@@ -0,0 +1,242 @@
+#############################################################
+####### ЗАМЕР ЗАДЕРЖКИ ОБРАБОТКИ: POLLING И WEBHOOK #########
+#############################################################
+
+# Запускает бота (main.py) против локального поддельного Bot API и измеряет время
+# от появления синтетического обновления /start до ответного запроса бота.
+# Для работы нужен доступный MongoDB (MONGO_URI), как и для обычного запуска.
+#
+#   python -m benchmarks.latency --mode both --updates 50
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:LATENCY-TEST"
+SECRET_TOKEN = "latency-secret"
+REPLY_METHODS = {"sendMessage", "sendPhoto", "sendDocument"}
+
+# Поддельный Bot API: отдаёт обновления через getUpdates и фиксирует ответы бота.
+class FakeBotApi:
+    def __init__(self):
+        self.updates = []
+        self.cond = threading.Condition()
+        self.replies = {}
+        self.seen = set()
+        self.next_update_id = 1
+        self.next_message_id = 1
+
+    def push_update(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def wait_for(self, method, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while method not in self.seen:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+        return True
+
+    def wait_reply(self, chat_id, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while chat_id not in self.replies:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self.cond.wait(left)
+            return self.replies.pop(chat_id)
+
+    def handle(self, method, params):
+        with self.cond:
+            self.seen.add(method)
+            self.cond.notify_all()
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Latency", "username": "latency_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            timeout = float(params.get("timeout") or 0)
+            deadline = time.monotonic() + timeout
+            with self.cond:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                return list(self.updates)
+        if method in REPLY_METHODS:
+            chat_id = int(params["chat_id"])
+            with self.cond:
+                self.replies[chat_id] = time.perf_counter()
+                self.next_message_id += 1
+                self.cond.notify_all()
+                message_id = self.next_message_id
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+        return True
+
+    def build_update(self, chat_id):
+        with self.cond:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+
+# Разбирает параметры запроса бота (JSON или multipart-форма).
+def parse_params(headers, body):
+    content_type = headers.get("Content-Type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    params = {}
+    if content_type.startswith("multipart/form-data"):
+        boundary = content_type.split("boundary=")[1].encode()
+        for part in body.split(b"--" + boundary):
+            head, _, value = part.partition(b"\r\n\r\n")
+            if b'name="' not in head or b"filename=" in head:
+                continue
+            name = head.split(b'name="')[1].split(b'"')[0].decode()
+            params[name] = value.rstrip(b"\r\n").decode(errors="ignore")
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        from urllib.parse import parse_qsl
+        params = dict(parse_qsl(body.decode()))
+    return params
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            method = self.path.rstrip("/").split("/")[-1]
+            result = api.handle(method, parse_params(self.headers, body))
+            payload = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Запускает бота в отдельном процессе в нужном режиме.
+def start_bot(mode, api_port, webhook_port):
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_BOT_API_MODE": "local",
+        "TELEGRAM_BOT_API_URL": f"http://127.0.0.1:{api_port}/bot",
+        "BOT_RUN_MODE": mode,
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(webhook_port),
+        "WEBHOOK_PATH": "telegram",
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}",
+        "WEBHOOK_SECRET_TOKEN": SECRET_TOKEN,
+    })
+    return subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "main.py")], cwd=BASE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def post_webhook(port, update, secret):
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/telegram",
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+# Отправляет обновления по одному и собирает задержки ответов, мс.
+def measure(mode, updates, timeout):
+    api = FakeBotApi()
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_port = free_port()
+    bot = start_bot(mode, server.server_address[1], webhook_port)
+    try:
+        if not api.wait_for("getUpdates" if mode == "polling" else "setWebhook", timeout):
+            raise RuntimeError(f"Бот не запустился в режиме {mode} (проверьте MongoDB).")
+        if mode == "webhook":
+            time.sleep(0.5)
+            rejected = post_webhook(webhook_port, api.build_update(1), "wrong-secret")
+            print(f"Запрос с неверным секретом: HTTP {rejected}")
+        latencies, lost = [], 0
+        for i in range(updates):
+            chat_id = 1000 + i
+            update = api.build_update(chat_id)
+            started = time.perf_counter()
+            if mode == "webhook":
+                post_webhook(webhook_port, update, SECRET_TOKEN)
+            else:
+                api.push_update(update)
+            replied = api.wait_reply(chat_id, timeout)
+            if replied is None:
+                lost += 1
+            else:
+                latencies.append((replied - started) * 1000)
+        return latencies, lost
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка обработки обновлений в режимах polling и webhook.")
+    parser.add_argument("--mode", choices=("polling", "webhook", "both"), default="both")
+    parser.add_argument("--updates", type=int, default=30)
+    parser.add_argument("--timeout", type=float, default=15.0)
+    args = parser.parse_args()
+
+    modes = ("polling", "webhook") if args.mode == "both" else (args.mode,)
+    results = {}
+    for mode in modes:
+        latencies, lost = measure(mode, args.updates, args.timeout)
+        if latencies:
+            results[mode] = {
+                "updates": len(latencies),
+                "lost": lost,
+                "p50_ms": round(statistics.median(latencies), 2),
+                "p95_ms": round(percentile(latencies, 0.95), 2),
+                "max_ms": round(max(latencies), 2),
+            }
+        else:
+            results[mode] = {"updates": 0, "lost": lost}
+        print(f"{mode}: {results[mode]}")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
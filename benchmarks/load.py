@@ -0,0 +1,315 @@
+##################################################################
+####### НАГРУЗОЧНЫЙ ТЕСТ ОБРАБОТЧИКОВ НА ПОДДЕЛЬНЫХ UPDATE #######
+##################################################################
+
+# Собирает настоящее Application из main.build_application (все ConversationHandler и роутеры)
+# с подменённым доступом к Bot API: запросы не уходят в Telegram, а записываются и получают
+# правдоподобные ответы. N пользователей одновременно проходят типичные сценарии -
+# список папок, карточки, листание файлов, переименование, загрузка, управление пользователями.
+# Отчёт: пропускная способность, p50/p95/p99 задержки обработки, запросы к API и базе на обновление.
+#
+#   python -m benchmarks.load --users 50 --iterations 5 --backend memory
+
+import argparse
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Load", "username": "load_test_bot"}
+COLLECTIONS = ("users_collection", "folders_collection", "broadcasts_collection", "sessions_collection", "conversations_collection", "counters_collection")
+
+# Счётчики текущего обновления: {"api": n, "db": n}; задаётся в задаче, обрабатывающей обновление.
+current_counters = contextvars.ContextVar("current_counters", default=None)
+
+def count(kind, totals, name):
+    totals[name] += 1
+    counters = current_counters.get()
+    if counters is not None:
+        counters[kind] += 1
+
+# Подставной Bot API: записывает вызовы и отвечает минимальными корректными объектами.
+class StubBotApi(BaseRequest):
+    def __init__(self, download_size):
+        self.calls = Counter()
+        self.download_size = download_size
+        self.next_message_id = 1000
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if method == "GET":
+            count("api", self.calls, "downloadFile")
+            return 200, b"\0" * self.download_size
+        api_method = url.rsplit("/", 1)[-1]
+        count("api", self.calls, api_method)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self.respond(api_method, params)}).encode()
+
+    def message(self, params, **extra):
+        self.next_message_id += 1
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": params.get("message_id", self.next_message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    def respond(self, api_method, params):
+        if api_method == "getMe":
+            return {**BOT_USER, "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": True}
+        if api_method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": "u" + params["file_id"], "file_size": self.download_size, "file_path": f"documents/{params['file_id']}"}
+        if api_method == "sendDocument":
+            return self.message(params, document={"file_id": f"doc{self.next_message_id}", "file_unique_id": f"udoc{self.next_message_id}"})
+        if api_method == "sendPhoto":
+            return self.message(params, photo=[{"file_id": f"photo{self.next_message_id}", "file_unique_id": f"uphoto{self.next_message_id}", "width": 1, "height": 1}])
+        if api_method.startswith("send") or api_method.startswith("edit"):
+            return self.message(params, text=params.get("text", ""))
+        return True
+
+# Обёртка коллекции MongoDB, считающая вызовы методов.
+class CountingCollection:
+    def __init__(self, collection, totals):
+        self._collection = collection
+        self._totals = totals
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            count("db", self._totals, name)
+            return attr(*args, **kwargs)
+        return counted
+
+# Конструктор подделанных обновлений одного пользователя.
+class FakeUser:
+    def __init__(self, bot, user_id):
+        self.bot = bot
+        self.user_id = user_id
+        self.sequence = 0
+
+    def _base(self):
+        self.sequence += 1
+        return {
+            "message_id": self.sequence,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"},
+        }
+
+    def _update(self, **payload):
+        return Update.de_json({"update_id": self.user_id * 100000 + self.sequence, **payload}, self.bot)
+
+    def text(self, text):
+        message = {**self._base(), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._update(message=message)
+
+    def document(self, file_name, size):
+        message = {**self._base(), "document": {
+            "file_id": f"upload{self.user_id}_{self.sequence}",
+            "file_unique_id": f"uupload{self.user_id}_{self.sequence}",
+            "file_name": file_name,
+            "file_size": size,
+            "mime_type": "application/octet-stream",
+        }}
+        return self._update(message=message)
+
+    def callback(self, data):
+        base = self._base()
+        query = {
+            "id": f"{self.user_id}-{self.sequence}",
+            "from": base["from"],
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {**base, "from": BOT_USER, "text": "menu"},
+        }
+        return self._update(callback_query=query)
+
+# Сценарий пользователя на одну итерацию: [(шаг, обновление)]; обновления строятся по ходу, как клики.
+def click_path(user, folder, rng, iteration, admin, other_user_id, upload_size):
+    files = folder["files"]
+    steps = [
+        ("start", lambda: user.text("/start")),
+        ("folders_menu", lambda: user.text("🗂 Список папок")),
+        ("folder_select", lambda: user.callback(f"folder_select:{folder['id']}:0")),
+        ("file_list", lambda: user.callback(f"folder_file_list:{folder['id']}:0")),
+        ("files_page", lambda: user.callback(f"files_page:{folder['id']}:1")),
+    ]
+    if files:
+        file_meta = rng.choice(files)
+        steps += [
+            ("file_select", lambda: user.callback(f"file_select:{file_meta['id']}:0")),
+            ("file_rename", lambda: user.callback(f"file_rename:{file_meta['id']}:0")),
+            ("rename_text", lambda: user.text(f"renamed_{user.user_id}_{iteration}{os.path.splitext(file_meta['name'])[1]}")),
+        ]
+    steps += [
+        ("add_files", lambda: user.callback(f"folder_add_files:{folder['id']}:0")),
+        ("upload", lambda: user.document(f"upload_{user.user_id}_{iteration}.bin", upload_size)),
+        ("finish_upload", lambda: user.text("✅ Закончить добавление")),
+    ]
+    if admin:
+        steps += [
+            ("users_menu", lambda: user.text("⚙️ Управление пользователями")),
+            ("users_page", lambda: user.callback("users_page:0")),
+            ("user_manage", lambda: user.callback(f"user_manage:{other_user_id}:0")),
+        ]
+    return steps
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(max(latencies), 2),
+    }
+
+async def run(bot, args):
+    from benchmarks.storage import generate_tree
+
+    data_dir = tempfile.mkdtemp(prefix="bench_load_")
+    try:
+        bot.DATABASE_DIR = data_dir
+        folders, users = generate_tree(data_dir, args)
+        for name in COLLECTIONS:
+            getattr(bot, name).delete_many({})
+        bot.folders_collection.insert_many([dict(folder) for folder in folders])
+        bot.users_collection.insert_many([dict(user) for user in users])
+
+        db_calls = Counter()
+        for name in COLLECTIONS:
+            setattr(bot, name, CountingCollection(getattr(bot, name), db_calls))
+        api = StubBotApi(args.upload_size)
+        app = bot.build_application(request=api, rate_limit=False)
+        errors = []
+
+        async def on_error(update, context):
+            errors.append(repr(context.error))
+        app.add_error_handler(on_error)
+        await app.initialize()
+
+        samples = []  # (шаг, мс, запросов к API, запросов к базе)
+
+        async def process(step, update):
+            counters = {"api": 0, "db": 0}
+            current_counters.set(counters)
+            started = time.perf_counter()
+            await app.update_processor.process_update(update, app.process_update(update))
+            samples.append((step, (time.perf_counter() - started) * 1000, counters["api"], counters["db"]))
+
+        async def simulate(index, user_doc):
+            rng = random.Random(args.seed + index)
+            user = FakeUser(app.bot, user_doc["id"])
+            folder = folders[index % len(folders)]
+            other = users[(index + 1) % len(users)]["id"]
+            for iteration in range(args.iterations):
+                for step, build in click_path(user, folder, rng, iteration, user_doc["status"] == "admin", other, args.upload_size):
+                    # Каждое обновление - отдельная задача, как в Application: так считаются запросы именно этого обновления.
+                    await asyncio.create_task(process(step, build()))
+                    if args.think:
+                        await asyncio.sleep(rng.uniform(0, 2 * args.think) / 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate(index, user_doc) for index, user_doc in enumerate(users)))
+        elapsed = time.perf_counter() - started
+        await app.shutdown()
+
+        latencies = [sample[1] for sample in samples]
+        by_step = {}
+        for step in dict.fromkeys(sample[0] for sample in samples):
+            step_samples = [sample for sample in samples if sample[0] == step]
+            by_step[step] = {
+                **summarize([sample[1] for sample in step_samples]),
+                "api_calls": round(statistics.mean(sample[2] for sample in step_samples), 2),
+                "db_calls": round(statistics.mean(sample[3] for sample in step_samples), 2),
+            }
+        return {
+            "meta": {
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                "backend": args.backend,
+                "users": args.users,
+                "iterations": args.iterations,
+                "folders": args.folders,
+                "files_per_folder": args.files,
+                "concurrency": bot.UPDATE_CONCURRENCY,
+            },
+            "updates": len(samples),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_ups": round(len(samples) / elapsed, 1) if elapsed else None,
+            "latency": summarize(latencies),
+            "api_calls_per_update": round(sum(sample[2] for sample in samples) / len(samples), 2),
+            "db_calls_per_update": round(sum(sample[3] for sample in samples) / len(samples), 2),
+            "by_step": by_step,
+            "api_calls": dict(api.calls.most_common()),
+            "db_calls": dict(db_calls.most_common()),
+            "errors": len(errors),
+            "error_samples": errors[:5],
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота на подделанных обновлениях.")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей (первый - администратор)")
+    parser.add_argument("--iterations", type=int, default=3, help="сколько раз каждый проходит сценарий")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза между кликами, мс")
+    parser.add_argument("--folders", type=int, default=10)
+    parser.add_argument("--files", type=int, default=50, help="среднее число файлов в папке")
+    parser.add_argument("--files-spread", type=float, default=0.2)
+    parser.add_argument("--size-distribution", choices=("fixed", "uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--mean-size", type=int, default=64 * 1024)
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="размер «загружаемого» файла, байт")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", choices=("mongo", "memory"), default="mongo")
+    parser.add_argument("--mongo-uri", default=None, help="по умолчанию MONGO_URI из окружения")
+    parser.add_argument("--db", default="bench_load", help="имя отдельной базы для теста")
+    parser.add_argument("--output", default=None, help="файл для JSON с результатами")
+    args = parser.parse_args()
+    args.private_share = 0.0
+
+    if args.backend == "memory":
+        from benchmarks.storage import use_memory_backend
+        use_memory_backend()
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["DB_NAME"] = args.db
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:LOAD-TEST")
+    sys.path.insert(0, BASE_DIR)
+    import main as bot
+    bot.bot_logger.disabled = True
+
+    result = asyncio.run(run(bot, args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
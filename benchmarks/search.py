@@ -0,0 +1,103 @@
+#########################################################
+####### ПОИСК ПО ИМЕНАМ ФАЙЛОВ НА БОЛЬШОМ ИНДЕКСЕ #######
+#########################################################
+
+# Строит FileSearchIndex из main.py на синтетических именах (по умолчанию 1 млн файлов в 2000 папках)
+# и замеряет поиск для пользователей, которым доступно разное число папок: 5, 10% папок, половина, все.
+# Код завершения 1, если какой-то запрос дольше --budget-ms.
+#
+#   python -m benchmarks.search --folders 2000 --files 500 --budget-ms 50
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as bot  # noqa: E402
+
+QUERIES = ("jpg", "img_2020", "0101_", "report_2019_q3", "_2020", "zzzz")
+
+# Источник папок вместо коллекции MongoDB: build() читает папки только через find().
+class FolderSource:
+    def __init__(self, folders):
+        self.folders = folders
+
+    def find(self, *args, **kwargs):
+        return iter(self.folders)
+
+# Имя файла в духе фотоархива: снимки, отчёты и видео с датами.
+def file_name(rng, number):
+    kind = rng.random()
+    year, month, day = rng.randint(2015, 2024), rng.randint(1, 12), rng.randint(1, 28)
+    if kind < 0.5:
+        return f"IMG_{year}{month:02d}{day:02d}_{rng.randint(0, 235959):06d}.jpg"
+    if kind < 0.7:
+        return f"DSC{rng.randint(0, 99999):05d}.JPG"
+    if kind < 0.85:
+        return f"report_{year}_{rng.choice(['q1', 'q2', 'q3', 'q4'])}_{number}.pdf"
+    return f"video_{year}-{month:02d}-{day:02d}_{number}.mp4"
+
+def generate_folders(folders, files, seed):
+    rng = random.Random(seed)
+    number = 0
+    result = []
+    for folder in range(folders):
+        entries = []
+        for _ in range(files):
+            entries.append({"id": f"file{number}", "name": file_name(rng, number)})
+            number += 1
+        result.append({"id": f"folder{folder}", "rev": 0, "files": entries})
+    return result
+
+def run(args):
+    folders = generate_folders(args.folders, args.files, args.seed)
+    bot.folders_collection = FolderSource(folders)
+    index = bot.FileSearchIndex()
+    started = time.perf_counter()
+    index.build()
+    build_seconds = time.perf_counter() - started
+
+    ids = [folder["id"] for folder in folders]
+    audiences = {
+        "5_folders": ids[::max(1, len(ids) // 5)][:5],
+        "10%_folders": ids[::10],
+        "half": ids[::2],
+        "all": ids,
+    }
+    results = {}
+    slowest = 0.0
+    for audience, folder_ids in audiences.items():
+        allowed = dict.fromkeys(folder_ids, "")
+        for query in QUERIES:
+            started = time.perf_counter()
+            total, top = index.search(query, allowed, args.limit)
+            elapsed = (time.perf_counter() - started) * 1000
+            slowest = max(slowest, elapsed)
+            results[f"{audience} {query}"] = {"ms": round(elapsed, 2), "total": total, "shown": len(top)}
+    return {
+        "files": len(index.files),
+        "build_s": round(build_seconds, 2),
+        "slowest_ms": round(slowest, 2),
+        "queries": results,
+        "checks": {"within_budget": slowest <= args.budget_ms},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость поиска по индексу имён файлов.")
+    parser.add_argument("--folders", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=500, help="файлов в папке")
+    parser.add_argument("--limit", type=int, default=bot.SEARCH_MAX_RESULTS)
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="допустимое время одного запроса, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if not all(result["checks"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
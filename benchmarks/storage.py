@@ -0,0 +1,253 @@
+###############################################################
+####### ЗАМЕР МЕТАДАННЫХ ХРАНИЛИЩА НА СИНТЕТИЧЕСКОЙ БАЗЕ ######
+###############################################################
+
+# Генерирует синтетический DATABASE_DIR (папки и файлы с заданным распределением размеров)
+# и соответствующие документы folders/users, затем замеряет функции main.py, которые
+# ходят по диску и базе. Результат - JSON; при наличии базовой линии сравнивает с ней
+# и завершается с кодом 1, если какая-то операция стала медленнее допуска.
+#
+# База: локальный MongoDB (--backend mongo, отдельная база --db) или mongomock в памяти
+# (--backend memory, нужен пакет mongomock).
+#
+#   python -m benchmarks.storage --folders 50 --files 200 --backend memory
+#   python -m benchmarks.storage --save-baseline          # записать базовую линию
+#   python -m benchmarks.storage --baseline benchmarks/storage_baseline.json
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "benchmarks", "storage_baseline.json")
+EXTENSIONS = (".jpg", ".png", ".pdf", ".txt", ".mp4", ".zip", ".docx")
+
+# Подключает mongomock вместо pymongo.MongoClient до импорта main.py.
+def use_memory_backend():
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("Для --backend memory установите mongomock: pip install mongomock")
+    import pymongo
+    from pymongo import DeleteOne, InsertOne, UpdateOne
+
+    # mongomock не понимает операции bulk_write новых версий pymongo - выполняем их по одной.
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        modified = upserted = 0
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                result = self.update_one(request._filter, request._doc, upsert=request._upsert)
+                modified += result.modified_count
+                upserted += result.upserted_id is not None
+            elif isinstance(request, DeleteOne):
+                self.delete_one(request._filter)
+            elif isinstance(request, InsertOne):
+                self.insert_one(request._doc)
+            else:
+                raise NotImplementedError(type(request).__name__)
+        return BulkResult(modified, upserted)
+
+    pymongo.MongoClient = mongomock.MongoClient
+    mongomock.collection.Collection.bulk_write = bulk_write
+
+# Результат bulk_write для mongomock: только поля, которые читает main.py.
+class BulkResult:
+    def __init__(self, modified_count, upserted_count):
+        self.modified_count = modified_count
+        self.upserted_count = upserted_count
+
+# Размер файла по выбранному распределению, байт.
+def sample_size(rng, distribution, mean_size):
+    if distribution == "fixed":
+        return mean_size
+    if distribution == "uniform":
+        return rng.randint(0, 2 * mean_size)
+    # lognormal: много мелких файлов и редкие крупные, среднее около mean_size.
+    sigma = 1.0
+    return max(0, int(rng.lognormvariate(0, sigma) * mean_size / 1.6487))
+
+# Создаёт папки и файлы (разреженные, без записи содержимого) и документы для базы.
+def generate_tree(data_dir, args):
+    rng = random.Random(args.seed)
+    folders, users = [], []
+    for user_index in range(args.users):
+        users.append({
+            "id": 100000 + user_index,
+            "username": f"user{user_index}",
+            "password": "bench",
+            "status": "admin" if user_index == 0 else "default",
+            "authorized": True,
+            "folders": 0,
+        })
+    for folder_index in range(args.folders):
+        name = f"folder_{folder_index:05d}"
+        folder_path = os.path.join(data_dir, name)
+        os.makedirs(folder_path)
+        count = max(0, int(rng.gauss(args.files, args.files * args.files_spread)))
+        files = []
+        for file_index in range(count):
+            file_name = f"file_{file_index:06d}{rng.choice(EXTENSIONS)}"
+            file_path = os.path.join(folder_path, file_name)
+            with open(file_path, "wb") as f:
+                f.truncate(sample_size(rng, args.size_distribution, args.mean_size))
+            stat = os.stat(file_path)
+            files.append({"id": str(uuid.uuid4()), "name": file_name, "size": stat.st_size, "ctime": stat.st_ctime})
+        folders.append({
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "owner_id": users[folder_index % len(users)]["id"] if users else None,
+            "status": "private" if rng.random() < args.private_share else "public",
+            "files": files,
+            "logging": False,
+            "logs": [],
+        })
+    return folders, users
+
+# Время выполнения func в мс за repeat повторов; prepare вызывается перед каждым замером и не учитывается.
+def measure(func, repeat, prepare=None):
+    timings = []
+    for _ in range(repeat):
+        argument = prepare() if prepare else None
+        started = time.perf_counter()
+        if prepare:
+            func(argument)
+        else:
+            func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "max_ms": round(max(timings), 3),
+        "runs": repeat,
+    }
+
+def run(bot, args):
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        started = time.perf_counter()
+        folders, users = generate_tree(data_dir, args)
+        generated_s = time.perf_counter() - started
+        bot.DATABASE_DIR = data_dir
+        bot.folders_collection.delete_many({})
+        bot.users_collection.delete_many({})
+        if folders:
+            bot.folders_collection.insert_many(copy.deepcopy(folders))
+        if users:
+            bot.users_collection.insert_many(copy.deepcopy(users))
+
+        loaded = bot.load_folders()
+        results = {
+            "sync_files_in_folder": measure(
+                lambda docs: [bot.sync_files_in_folder(doc) for doc in docs],
+                args.repeat, prepare=lambda: copy.deepcopy(loaded)
+            ),
+            "sync_folders_with_filesystem": measure(bot.sync_folders_with_filesystem, args.repeat),
+            "cleanup_nonexistent_folders": measure(bot.cleanup_nonexistent_folders, args.repeat),
+            "get_database_stats": measure(bot.get_database_stats, args.repeat),
+            "get_folders_for_list": measure(bot.get_folders_for_list, args.repeat),
+            # Свежая выборка на каждый замер: save_folders записывает папку, только если её rev не изменился.
+            "save_folders": measure(bot.save_folders, args.repeat, prepare=bot.load_folders),
+        }
+        total_files = sum(len(folder["files"]) for folder in folders)
+        return {
+            "meta": {
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "backend": args.backend,
+                "folders": args.folders,
+                "files_total": total_files,
+                "users": args.users,
+                "size_distribution": args.size_distribution,
+                "mean_size": args.mean_size,
+                "seed": args.seed,
+                "generate_s": round(generated_s, 3),
+            },
+            "results": results,
+        }
+    finally:
+        if not args.data_dir and not args.keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+# Сравнивает медианы с базовой линией: {операция: (база, сейчас, изменение)} и список регрессий.
+def compare(results, baseline, tolerance):
+    report, regressions = {}, []
+    for name, current in results["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or not base.get("median_ms"):
+            continue
+        change = current["median_ms"] / base["median_ms"] - 1
+        report[name] = (base["median_ms"], current["median_ms"], change)
+        if change > tolerance:
+            regressions.append(name)
+    return report, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер функций метаданных хранилища на синтетической базе.")
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--files", type=int, default=200, help="среднее число файлов в папке")
+    parser.add_argument("--files-spread", type=float, default=0.5, help="разброс числа файлов (доля от среднего)")
+    parser.add_argument("--size-distribution", choices=("fixed", "uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--mean-size", type=int, default=256 * 1024, help="средний размер файла, байт")
+    parser.add_argument("--private-share", type=float, default=0.2, help="доля приватных папок")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", choices=("mongo", "memory"), default="mongo")
+    parser.add_argument("--mongo-uri", default=None, help="по умолчанию MONGO_URI из окружения")
+    parser.add_argument("--db", default="bench_storage", help="имя отдельной базы для замеров")
+    parser.add_argument("--data-dir", default=None, help="каталог для синтетических папок (по умолчанию временный)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временный каталог")
+    parser.add_argument("--output", default=None, help="файл для JSON с результатами")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как базовую линию")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление относительно базы")
+    args = parser.parse_args()
+
+    if args.backend == "memory":
+        use_memory_backend()
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["DB_NAME"] = args.db
+    sys.path.insert(0, BASE_DIR)
+    import main as bot
+    bot.bot_logger.disabled = True
+
+    results = run(bot, args)
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Базовая линия записана в {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"Базовой линии {args.baseline} нет - сравнение пропущено (создайте её через --save-baseline).")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("meta", {}).get("files_total") != results["meta"]["files_total"]:
+        print("Внимание: базовая линия снята на другом наборе данных - сравнение неточное.")
+    report, regressions = compare(results, baseline, args.tolerance)
+    for name, (base, current, change) in report.items():
+        mark = "  РЕГРЕССИЯ" if name in regressions else ""
+        print(f"{name:32} {base:10.2f} -> {current:10.2f} ms ({change:+.0%}){mark}")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
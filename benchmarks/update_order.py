@@ -0,0 +1,109 @@
+###################################################################
+####### ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА: ПОРЯДОК И БЛОКИРОВКИ ЧАТОВ ########
+###################################################################
+
+# Прогоняет синтетические обновления через ChatOrderedUpdateProcessor из main.py:
+# один пользователь «загружает» большой файл (долгий обработчик), остальные кликают.
+# Проверяет, что другие пользователи не ждут медленного, обновления одного чата
+# выполняются строго по порядку, а число одновременных обработчиков не превышает лимит.
+# Код завершения 1, если какая-то проверка не прошла.
+#
+#   python -m benchmarks.update_order --users 50 --clicks 5 --slow 2
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import sys
+
+from telegram import Chat, Message, Update, User
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as bot  # noqa: E402
+
+SLOW_CHAT_ID = 1
+
+# Текстовое обновление от пользователя в личном чате.
+def build_update(update_id, chat_id, text):
+    user = User(id=chat_id, first_name=f"user{chat_id}", is_bot=False)
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.datetime.now(datetime.timezone.utc), chat=chat, from_user=user, text=text)
+    return Update(update_id=update_id, message=message)
+
+async def run(users, clicks, slow, fast, concurrency):
+    processor = bot.ChatOrderedUpdateProcessor(concurrency)
+    loop = asyncio.get_running_loop()
+    spans = {}  # чат -> [(номер, начало, конец)]
+    latencies = []
+    running = {"now": 0, "max": 0}
+
+    async def handle(update, seq, pushed):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        try:
+            chat_id = update.effective_chat.id
+            begin = loop.time()
+            await asyncio.sleep(slow if update.message.text == "upload" else fast)
+            spans.setdefault(chat_id, []).append((seq, begin, loop.time()))
+            if chat_id != SLOW_CHAT_ID:
+                latencies.append((loop.time() - pushed) * 1000)
+        finally:
+            running["now"] -= 1
+
+    tasks = []
+    update_id = 0
+    sent = {}
+    # Медленный пользователь: загрузка и сразу за ней клики, которые должны дождаться её окончания.
+    for seq, text in enumerate(["upload"] + ["click"] * clicks):
+        update_id += 1
+        update = build_update(update_id, SLOW_CHAT_ID, text)
+        sent.setdefault(SLOW_CHAT_ID, []).append(seq)
+        tasks.append(asyncio.create_task(processor.process_update(update, handle(update, seq, loop.time()))))
+    await asyncio.sleep(0)
+    for seq in range(clicks):
+        for chat_id in range(2, users + 2):
+            update_id += 1
+            update = build_update(update_id, chat_id, "click")
+            sent.setdefault(chat_id, []).append(seq)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update, seq, loop.time()))))
+    started = loop.time()
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+
+    checks = {
+        "others_not_blocked": max(latencies) < slow * 1000 / 2,
+        "per_chat_order": all([seq for seq, _, _ in sorted(spans[chat_id], key=lambda span: span[1])] == seqs for chat_id, seqs in sent.items()),
+        "per_chat_no_overlap": all(
+            later[1] >= earlier[2]
+            for chat_spans in spans.values()
+            for earlier, later in zip(sorted(chat_spans), sorted(chat_spans)[1:])
+        ),
+        "concurrency_cap": running["max"] <= concurrency,
+    }
+    return {
+        "updates": update_id,
+        "elapsed_s": round(elapsed, 3),
+        "others_p50_ms": round(statistics.median(latencies), 2),
+        "others_max_ms": round(max(latencies), 2),
+        "max_running": running["max"],
+        "checks": checks,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельная обработка обновлений без блокировки чужих чатов.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--clicks", type=int, default=5)
+    parser.add_argument("--slow", type=float, default=2.0, help="длительность «загрузки», сек")
+    parser.add_argument("--fast", type=float, default=0.01, help="длительность клика, сек")
+    parser.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.users, args.clicks, args.slow, args.fast, args.concurrency))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if not all(result["checks"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
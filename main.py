@@ -1,30 +1,61 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # начало запуска: учитывается и время импортов
 import os
 import re
+import sys
 import json
+import random
+import asyncio
 import traceback
 import datetime
 import mimetypes
 import shutil
+import gzip
+import zlib
+import subprocess
 import uuid
+import socket
+import functools
+import itertools
+import contextlib
+import contextvars
+import signal
+import heapq
+import bisect
+import threading
+import queue
+import atexit
+import logging
+import logging.handlers
 import telegram.error
 import warnings
 from enum import Enum, auto
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
+import bson
 from dotenv import load_dotenv
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, UpdateOne, DeleteOne, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure, DuplicateKeyError
 from bson import ObjectId
-from telegram.request import HTTPXRequest
 from telegram import (
     Update, ReplyKeyboardMarkup, InlineKeyboardMarkup,
-    KeyboardButton, InlineKeyboardButton, ReplyKeyboardRemove
+    KeyboardButton, InlineKeyboardButton, ReplyKeyboardRemove,
+    InlineQueryResultCachedDocument, InlineQueryResultCachedPhoto, InlineQueryResultCachedAudio,
+    InlineQueryResultCachedVideo, InlineQueryResultCachedGif
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ConversationHandler,
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, InlineQueryHandler, BaseRateLimiter, BaseUpdateProcessor,
+    BasePersistence, PersistenceInput, filters, ContextTypes
 )
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# Этапы запуска: этап -> секунд от начала импорта модуля.
+startup_phases = {"imports": round(time.perf_counter() - STARTUP_STARTED, 3)}
+
 LOG_ENABLED = True  # Логирование (True/False)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_DIR = os.path.join(BASE_DIR, "Database")
@@ -34,6 +65,11 @@ FOLDERS_PER_PAGE = 10
 FILES_PER_PAGE = 10
 USERS_PER_PAGE = 10
 FOLDER_LOGS_LIMIT = 100
+THUMBS_DIR = os.path.join(BASE_DIR, "thumbs")  # кэш превью файлов
+UPLOADS_DIRNAME = ".uploads"  # каталог рядом с DATABASE_DIR для загружаемых файлов (та же ФС - os.replace атомарен)
+THUMB_SIZE = 320  # максимальная сторона превью, px
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+VIDEO_EXTS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
 
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 API_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -41,23 +77,467 @@ BOT_API_MODE = os.getenv("TELEGRAM_BOT_API_MODE", "cloud").lower()
 BOT_API_URL = os.getenv("TELEGRAM_BOT_API_URL")
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = os.getenv("DB_NAME", "telegram_bot")
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))  # ожидание доступного сервера MongoDB на один запрос, мс
+
+# Логирование: очередь и фоновый поток, ротация bot.log по размеру и времени.
+LOG_FILE = os.getenv("LOG_FILE") or os.path.join(BASE_DIR, "bot.log")  # путь к файлу лога
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text или json (по строке JSON на запись)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # размер bot.log до ротации, байт
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", "86400"))  # ротация по времени, сек (0 - только по размеру)
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))  # сколько старых файлов хранить
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # записей в очереди; при переполнении новые отбрасываются
+LOG_STATE_SAMPLE_RATE = float(os.getenv("LOG_STATE_SAMPLE_RATE", "0.1"))  # доля вызовов обработчиков с выводом user_data
+
+# Метрики в текстовом формате Prometheus: локальный HTTP-эндпоинт /metrics.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # порт эндпоинта, 0 - выключен (счётчики собираются всегда)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Бюджет запросов на одно обновление: предупреждение в лог, если обработчик делает слишком много запросов.
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "warn").lower()  # off, warn или debug (счётчики каждого обновления в лог)
+QUERY_BUDGET_DB = int(os.getenv("QUERY_BUDGET_DB", "15"))  # запросов к MongoDB на обновление, 0 - без лимита
+QUERY_BUDGET_DOCS = int(os.getenv("QUERY_BUDGET_DOCS", "1000"))  # прочитанных документов на обновление
+QUERY_BUDGET_FS = int(os.getenv("QUERY_BUDGET_FS", "2000"))  # обращений к файловой системе (листинги каталогов и stat)
+QUERY_BUDGET_REPEAT = int(os.getenv("QUERY_BUDGET_REPEAT", "5"))  # запросов из одного места вызова - признак N+1
+
+# Сэмплирующий профилировщик: /profile для администратора или сигнал SIGUSR2.
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))  # куда писать свёрнутые стеки
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # период сэмплирования, сек
+PROFILE_DEFAULT_SECONDS = int(os.getenv("PROFILE_DEFAULT_SECONDS", "30"))  # длительность без аргумента и по сигналу
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+
+# Проверки /healthz и /readyz на порту METRICS_PORT; результаты обновляет фоновая проверка.
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "5"))  # период проверки, сек
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "1"))  # допустимая задержка цикла событий, сек
+HEALTH_MIN_FREE_MB = int(os.getenv("HEALTH_MIN_FREE_MB", "500"))  # минимум свободного места в DATABASE_DIR, МБ
+HEALTH_POLL_STALE = int(os.getenv("HEALTH_POLL_STALE", "60"))  # polling: допустимое время без ответа getUpdates, сек
+HEALTH_WEBHOOK_INTERVAL = int(os.getenv("HEALTH_WEBHOOK_INTERVAL", "60"))  # webhook: период запроса getWebhookInfo, сек
+HEALTH_MAX_BACKLOG = int(os.getenv("HEALTH_MAX_BACKLOG", "500"))  # обновлений в очереди и ожидающих своего чата
+
+# Режим получения обновлений: polling или webhook (встроенный HTTP-сервер).
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # внешний адрес, например https://example.com (обязателен для webhook)
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")  # секрет заголовка X-Telegram-Bot-Api-Secret-Token (обязателен для webhook)
+
+# Ограничение исходящих запросов к Telegram Bot API.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # запросов в секунду на весь бот
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))  # запросов в секунду в личный чат
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))  # запас запросов в личный чат
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))  # запросов в секунду в группу
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+OUTBOUND_STATS_INTERVAL = int(os.getenv("OUTBOUND_STATS_INTERVAL", "300"))  # период вывода статистики в лог, сек
+CALLBACK_STATS_INTERVAL = int(os.getenv("CALLBACK_STATS_INTERVAL", "300"))  # период вывода статистики кнопок в лог, сек
+MESSAGE_EDIT_CACHE_SIZE = int(os.getenv("MESSAGE_EDIT_CACHE_SIZE", "10000"))  # сколько сообщений помнить для пропуска одинаковых правок
+
+# Параллельная обработка обновлений: разные чаты - одновременно, обновления одного чата - строго по очереди.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))  # одновременно выполняющихся обновлений, 1 - последовательно
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "1000"))  # выполняющихся и ожидающих очереди своего чата
+
+# Несколько экземпляров бота на одной базе и общем хранилище: блокировки папок в MongoDB.
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"  # имя экземпляра в документах блокировок
+LOCK_TTL = int(os.getenv("LOCK_TTL", "30"))  # срок аренды блокировки, сек; держатель продлевает её, пока работает
+LOCK_WAIT = float(os.getenv("LOCK_WAIT", "10"))  # сколько ждать занятую блокировку, сек
+
+# Сохранение состояния диалогов и context.user_data между перезапусками.
+SESSION_PERSISTENCE = os.getenv("SESSION_PERSISTENCE", "mongo").lower()  # mongo или off
+SESSION_FLUSH_INTERVAL = int(os.getenv("SESSION_FLUSH_INTERVAL", "10"))  # как часто записывать изменения в базу, сек
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", "1800"))  # выгружать user_data из памяти после простоя, сек (0 - не выгружать)
+SESSION_ABANDON_TTL = int(os.getenv("SESSION_ABANDON_TTL", str(30 * 24 * 3600)))  # удалять из базы брошенные сессии и диалоги, сек (0 - хранить)
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "60"))  # период проверки простаивающих сессий, сек
+
+# Массовая рассылка.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # одновременных отправок
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))  # пользователей за одну выборку
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "10"))  # отправок между сохранениями прогресса (при перезапуске повторится не больше одной)
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # период обновления прогресса, сек
+
+# Кэш страниц списка папок.
+FOLDERS_SYNC_INTERVAL = int(os.getenv("FOLDERS_SYNC_INTERVAL", "30"))  # как часто сверять список папок с диском, сек
+FILE_INDEX_CACHE_SIZE = int(os.getenv("FILE_INDEX_CACHE_SIZE", "32"))  # для скольких папок держать отсортированный список файлов
+FOLDER_UPDATE_RETRIES = int(os.getenv("FOLDER_UPDATE_RETRIES", "5"))  # попыток записать папку, если её одновременно изменили
+
+# Поиск файлов по имени.
+SEARCH_MIN_QUERY = int(os.getenv("SEARCH_MIN_QUERY", "3"))  # минимальная длина запроса, символов
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "200"))  # сколько совпадений показывать
+SEARCH_SCAN_LIMIT = int(os.getenv("SEARCH_SCAN_LIMIT", "20000"))  # сколько имён просматривать для общих запросов, дальше - "уточните запрос"
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))  # сколько хранится ответ на inline-запрос (в Telegram и в боте), сек
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "1000"))  # сколько inline-запросов помнить на стороне бота
+
+# Превью изображений (Pillow) и видео (ffmpeg, если установлен).
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or shutil.which("ffmpeg")
+
+# Сжатое хранение файлов: off, gzip, zstd или auto (zstd, если установлен, иначе gzip).
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "off").lower()
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "4096"))  # меньшие файлы не сжимаются, байт
+COMPRESSION_MIN_RATIO = float(os.getenv("COMPRESSION_MIN_RATIO", "1.5"))  # минимальная выгода от сжатия
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSIBLE_EXTS = (".txt", ".log", ".csv", ".tsv", ".json", ".ndjson", ".xml", ".yaml", ".yml", ".md", ".sql", ".html", ".ini", ".cfg")
+COMPRESSIBLE_MIME_TYPES = ("application/json", "application/xml", "application/javascript", "application/sql", "application/x-ndjson", "application/csv")
+
+###########################
+######### МЕТРИКИ #########
+###########################
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+TRANSFER_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+metrics_registry = []
+
+# Экранирует значение метки для текстового формата Prometheus.
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Метки в виде {name="value",...}; extra - дополнительная пара (le у корзин гистограммы).
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Метрика с метками: значения по кортежу меток. Изменения под блокировкой - метрики пишутся и из рабочих потоков.
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    # Строки выдачи: [(суффикс имени, значения меток, дополнительная метка, значение)].
+    def samples(self):
+        with self._lock:
+            return [("", key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {value}")
+        return lines
+
+class MetricCounter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+# Гистограмма: счётчики по корзинам хранятся без накопления, накопленные значения считаются при выдаче.
+class MetricHistogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        result = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                result.append(("_bucket", key, ("le", bound), cumulative))
+            result.append(("_sum", key, None, round(total, 6)))
+            result.append(("_count", key, None, cumulative))
+        return result
+
+# Метрика, значения которой берутся при выдаче из уже существующей статистики: collect() -> {кортеж меток: значение}.
+class MetricCollector(Metric):
+    def __init__(self, name, help_text, labels, collect, kind="gauge"):
+        super().__init__(name, help_text, labels)
+        self.kind = kind
+        self._collect = collect
+
+    def samples(self):
+        return [("", key, None, value) for key, value in self._collect().items()]
+
+updates_handled = MetricCounter("bot_updates_total", "Обработанные обновления по обработчику, состоянию диалога и результату.", ("handler", "state", "outcome"))
+handler_seconds = MetricHistogram("bot_handler_duration_seconds", "Время выполнения обработчика.", ("handler",))
+route_seconds = MetricHistogram("bot_callback_route_duration_seconds", "Время выполнения обработчика Inline-кнопки по маршруту.", ("router", "route"))
+route_errors = MetricCounter("bot_callback_route_errors_total", "Исключения в обработчиках Inline-кнопок.", ("router", "route"))
+mongo_commands = MetricCounter("bot_mongo_commands_total", "Команды MongoDB по результату.", ("command", "outcome"))
+mongo_command_seconds = MetricHistogram("bot_mongo_command_duration_seconds", "Время выполнения команды MongoDB.", ("command",), DB_BUCKETS)
+fs_scan_seconds = MetricHistogram("bot_fs_scan_duration_seconds", "Время обхода каталогов: одна папка или сверка всех папок с диском.", ("scope",), DB_BUCKETS + (2.5, 5, 10))
+transfer_bytes = MetricCounter("bot_transfer_bytes_total", "Байты файлов: download - из Telegram на диск, upload - с диска в Telegram.", ("direction",))
+transfer_seconds = MetricHistogram("bot_transfer_duration_seconds", "Время передачи файла.", ("direction",), TRANSFER_BUCKETS)
+api_errors = MetricCounter("bot_api_errors_total", "Ошибки исходящих запросов к Bot API по методу и типу.", ("method", "error"))
+folder_conflicts = MetricCounter("bot_folder_write_conflicts_total", "Записи папок, отклонённые из-за одновременного изменения (rev): update - повторены, save - пропущены.", ("writer",))
+cache_requests = MetricCounter("bot_cache_requests_total", "Обращения к кэшам: hit, miss или prefix (inline-результаты из более короткого запроса).", ("cache", "result"))
+
+# Статистика обработчика обновлений запущенного приложения (при параллельной обработке).
+def collect_update_processor_stats():
+    processor = getattr(bot_application, "update_processor", None)
+    return {(kind,): n for kind, n in processor.stats().items()} if hasattr(processor, "stats") else {}
+
+MetricCollector("bot_api_requests_total", "Исходящие запросы к Bot API по приоритету.", ("priority",),
+                lambda: {(p,): n for p, n in outbound_limiter.stats()["requests"].items()}, kind="counter")
+MetricCollector("bot_api_queue_depth", "Запросы к Bot API в очереди ограничителя.", ("priority",),
+                lambda: {(p,): n for p, n in outbound_limiter.stats()["queue_depth"].items()})
+MetricCollector("bot_api_flood_waits_total", "Ответы RetryAfter (flood control).", (),
+                lambda: {(): outbound_limiter.stats()["flood_waits"]}, kind="counter")
+MetricCollector("bot_message_edits_total", "Правки сообщений: отправленные, пропущенные одинаковые, сведённые, not modified.", ("result",),
+                lambda: {(result,): n for result, n in message_edit_stats.items()}, kind="counter")
+MetricCollector("bot_log_records_dropped_total", "Записи лога, отброшенные при переполнении очереди.", (),
+                lambda: {(): bot_log_queue.dropped}, kind="counter")
+MetricCollector("bot_updates_in_progress", "Чаты с обновлениями в работе и обновления, которые выполняются или ждут очереди своего чата.", ("kind",),
+                collect_update_processor_stats)
+MetricCollector("bot_cache_entries", "Размер кэшей в записях.", ("cache",),
+                lambda: {("file_index",): len(file_indexes), ("inline_results",): len(inline_results_cache), ("message_edits",): len(message_edits), ("search_files",): len(file_search_index.files)})
+
+# Команды MongoDB: счётчики и время выполнения (события приходят из потоков драйвера), учёт в бюджете обновления.
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.db += 1
+            budget.db_sites[budget_call_site()] += 1
+
+    def succeeded(self, event):
+        mongo_commands.inc(event.command_name, "ok")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name)
+        budget = current_budget.get()
+        cursor = event.reply.get("cursor") if budget is not None else None
+        if cursor:
+            budget.docs += len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+
+    def failed(self, event):
+        mongo_commands.inc(event.command_name, "error")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name)
+
+# Учитывает передачу файла между Telegram и диском.
+def record_transfer(direction, size, seconds):
+    transfer_bytes.inc(direction, amount=size)
+    transfer_seconds.observe(seconds, direction)
+
+# Оборачивает callback обработчика замером времени, подсчётом обновлений и бюджетом запросов; state - метка состояния диалога.
+def timed_callback(callback, state):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        profiling = profiler.updates_left is not None
+        budget = UpdateBudget() if QUERY_BUDGET_MODE != "off" else None
+        token = current_budget.set(budget)
+        started = time.perf_counter()
+        health_marks["last_update"] = time.monotonic()
+        if update.effective_user:
+            session_store.touch(update.effective_user.id)
+        outcome = "error"
+        try:
+            result = await callback(update, context)
+            outcome = "ok"
+            return result
+        finally:
+            current_budget.reset(token)
+            updates_handled.inc(name, state, outcome)
+            handler_seconds.observe(time.perf_counter() - started, name)
+            if profiling:
+                profiler.note_update()
+            if budget is not None:
+                check_update_budget(budget, name, state)
+    return timed
+
+# Без сохранения сессий у выгруженного пользователя остаётся состояние диалога, но не user_data.
+# Первое его обновление в диалоге снимает отметку; если это обработчик состояния, диалог завершается
+# (ConversationHandler.END) вместо вызова обработчика, который ждёт своих данных в user_data.
+def conversation_session_guard(callback, in_state):
+    @functools.wraps(callback)
+    async def guarded(update, context):
+        user = update.effective_user
+        if user and session_store.expire(user.id) and in_state:
+            text = "Сеанс устарел: бот долго не получал ответа. Начните действие заново."
+            if update.callback_query:
+                await update.callback_query.answer(text, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text, reply_markup=get_main_kb(user.id) if is_in_database(user.id) else get_guest_kb())
+            return ConversationHandler.END
+        return await callback(update, context)
+    return guarded
+
+# Подключает замеры ко всем обработчикам приложения, в диалогах - с именем состояния.
+def instrument_handlers(app):
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                handler.callback = timed_callback(handler.callback, "-")
+                continue
+            groups = [("entry", handler.entry_points), ("fallback", handler.fallbacks)]
+            groups += [(state.name, state_handlers) for state, state_handlers in handler.states.items()]
+            for label, group in groups:
+                for inner in group:
+                    guarded = conversation_session_guard(inner.callback, label not in ("entry", "fallback"))
+                    inner.callback = timed_callback(guarded, f"{handler.name}:{label}")
+
+# Выдача всех метрик в текстовом формате Prometheus; сбойный сборщик не ломает остальные.
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f"# {metric.name}: {type(e).__name__}")
+    return "\n".join(lines) + "\n"
+
+async def metrics_response():
+    return "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode()
+
+# Пути локального HTTP-сервера: путь -> корутина, возвращающая (статус, Content-Type, тело).
+metrics_http_routes = {"/metrics": metrics_response}
+bot_application = None
+metrics_server = None
+
+# Минимальный HTTP/1.1-сервер для метрик и проверок здоровья: только GET, соединение закрывается после ответа.
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        route = metrics_http_routes.get(parts[1].split("?")[0]) if len(parts) > 1 and parts[0] == "GET" else None
+        if route is None:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+        else:
+            status, content_type, body = await route()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# Запускает HTTP-сервер метрик и проверок, если задан METRICS_PORT.
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None:
+        return
+    metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+    log(f"Metrics endpoint: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics (/healthz, /readyz)")
+
+#################################################
+######### БЮДЖЕТ ЗАПРОСОВ НА ОБНОВЛЕНИЕ #########
+#################################################
+
+# Функции самого учёта - пропускаются при поиске места вызова.
+BUDGET_INTERNAL_FUNCTIONS = {"started", "succeeded", "budget_audit_hook", "note_fs_calls", "budget_call_site", "timed"}
+BUDGET_AUDIT_EVENTS = {"os.listdir", "os.scandir"}
+
+# Счётчики одного обновления: запросы к MongoDB, прочитанные документы, обращения к файловой системе по местам вызова.
+class UpdateBudget:
+    __slots__ = ("db", "docs", "fs", "db_sites", "fs_sites")
+
+    def __init__(self):
+        self.db = 0
+        self.docs = 0
+        self.fs = 0
+        self.db_sites = Counter()
+        self.fs_sites = Counter()
+
+    # Нарушения: превышенные лимиты и места вызова, повторившиеся больше QUERY_BUDGET_REPEAT раз (N+1).
+    def violations(self):
+        exceeded = [
+            f"{name}={value}/{limit}"
+            for name, value, limit in (("db", self.db, QUERY_BUDGET_DB), ("docs", self.docs, QUERY_BUDGET_DOCS), ("fs", self.fs, QUERY_BUDGET_FS))
+            if limit and value > limit
+        ]
+        repeated = [f"{site} x{n}" for site, n in self.db_sites.items() if n > QUERY_BUDGET_REPEAT]
+        return exceeded, repeated
+
+# Счётчики обновления, которое выполняется в текущей задаче (asyncio.to_thread переносит их и в рабочий поток).
+current_budget = contextvars.ContextVar("current_budget", default=None)
+
+# Место вызова в коде бота: две ближайшие функции main.py в стеке, например "get_user:340<show_user_card:3790".
+def budget_call_site():
+    frame = sys._getframe(2)
+    sites = []
+    while frame is not None and len(sites) < 2:
+        code = frame.f_code
+        if code.co_filename == __file__ and code.co_name not in BUDGET_INTERNAL_FUNCTIONS:
+            sites.append(f"{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return "<".join(sites) or "?"
+
+# Учитывает count обращений к файловой системе (stat по записям каталога и т.п.) в текущем обновлении.
+def note_fs_calls(count=1):
+    budget = current_budget.get()
+    if budget is not None:
+        budget.fs += count
+        budget.fs_sites[budget_call_site()] += count
+
+# Аудит-хук Python: каждый os.listdir/os.scandir внутри обработки обновления.
+def budget_audit_hook(event, args):
+    if event in BUDGET_AUDIT_EVENTS and current_budget.get() is not None:
+        note_fs_calls()
+
+# Проверяет счётчики обновления после обработчика: предупреждение с разбивкой по местам вызова при превышении.
+def check_update_budget(budget, handler, state):
+    exceeded, repeated = budget.violations()
+    if exceeded or repeated:
+        budget_exceeded.inc(handler)
+        log(
+            f"Query budget exceeded in {handler} ({state}): db={budget.db}, docs={budget.docs}, fs={budget.fs}"
+            + (f"; over limit: {', '.join(exceeded)}" if exceeded else "")
+            + (f"; repeated calls: {', '.join(repeated)}" if repeated else ""),
+            level=logging.WARNING,
+            handler=handler, state=state, db=budget.db, docs=budget.docs, fs=budget.fs,
+            db_sites=dict(budget.db_sites.most_common(10)), fs_sites=dict(budget.fs_sites.most_common(10))
+        )
+    elif QUERY_BUDGET_MODE == "debug":
+        log(
+            f"Query budget {handler} ({state}): db={budget.db}, docs={budget.docs}, fs={budget.fs}",
+            level=logging.INFO,
+            handler=handler, state=state, db_sites=dict(budget.db_sites), fs_sites=dict(budget.fs_sites)
+        )
 
-try:
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    users_collection = db['users']
-    folders_collection = db['folders']
-    
-    users_collection.create_index("id", unique=True)
-    folders_collection.create_index("name", unique=True)
-except Exception as e:
-    print(f"Ошибка подключения к MongoDB: {e}")
-    sys.exit(1)
-
-if BOT_API_MODE == "local":
-    request = HTTPXRequest(api_url_base=BOT_API_URL)
-else:
-    request = None
+budget_exceeded = MetricCounter("bot_query_budget_exceeded_total", "Обновления, превысившие бюджет запросов или с повторяющимися запросами (N+1).", ("handler",))
+
+if QUERY_BUDGET_MODE != "off":
+    sys.addaudithook(budget_audit_hook)
+
+# Клиент не подключается при импорте: соединение открывается при первом запросе, индексы строятся в фоне (ensure_indexes).
+client = MongoClient(MONGO_URI, connect=False, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS, event_listeners=[MongoCommandMetrics()])
+db = client[DB_NAME]
+users_collection = db['users']
+folders_collection = db['folders']
+broadcasts_collection = db['broadcasts']
+sessions_collection = db['sessions']
+conversations_collection = db['conversations']
+locks_collection = db['locks']
+counters_collection = db['counters']
+
+# Индексы: (коллекция, ключ, параметры).
+MONGO_INDEXES = [
+    (users_collection, "id", {"unique": True}),
+    (folders_collection, "name", {"unique": True}),
+    (broadcasts_collection, "id", {"unique": True}),
+    (broadcasts_collection, "status", {}),
+    (conversations_collection, "name", {}),
+]
+if SESSION_ABANDON_TTL:
+    # TTL-индексы: MongoDB сама удаляет сессии и состояния диалогов, не обновлявшиеся дольше срока.
+    MONGO_INDEXES += [
+        (sessions_collection, "updated_at", {"expireAfterSeconds": SESSION_ABANDON_TTL}),
+        (conversations_collection, "updated_at", {"expireAfterSeconds": SESSION_ABANDON_TTL}),
+    ]
 
 class ConversationStates(Enum):
     AUTH = auto()
@@ -79,28 +559,102 @@ class ConversationStates(Enum):
     USER_CONFIRM_SEND_MSG = auto()
     USER_DELETE_CONFIRM = auto()
     CHOOSING_FOLDER = auto()
+    BROADCAST_TEXT = auto()
+    BROADCAST_CONFIRM = auto()
+    SEARCH_QUERY = auto()
 
 ###########################################
 ######### ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ #########
 ###########################################
 
-# Логирует сообщения в консоль и в файл bot.log (если включено логирование).
-def log(msg):
-    if LOG_ENABLED:
-        line = f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}][LOG]: {msg}"
-        print(line)
-        with open(os.path.join(BASE_DIR, "bot.log"), "a", encoding="utf-8") as f:
-            f.write(line + "\n")
-
-# Логирует состояние пользователя, сообщение и данные внутри обработчика.
+# Текстовая запись лога: [время][уровень]: сообщение key=value.
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"[{self.formatTime(record, '%Y-%m-%d %H:%M:%S')}][{record.levelname}]: {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+# Структурированная запись лога: одна строка JSON.
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Очередь записей лога: при переполнении запись отбрасывается и считается, а не блокирует обработчик.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Файл лога с ротацией по размеру и по времени: bot.log -> bot.log.1 -> ... -> bot.log.N.
+class BotLogFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=max(1, backup_count), encoding="utf-8", delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+# Настраивает логгер бота: запись в консоль и bot.log выполняет фоновый поток, обработчики только кладут запись в очередь.
+def setup_logging():
+    logger = logging.getLogger("bot")
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    logger.disabled = not LOG_ENABLED
+    formatter = JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    log_file = BotLogFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT)
+    log_file.setFormatter(formatter)
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, console, log_file, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger, queue_handler
+
+bot_logger, bot_log_queue = setup_logging()
+
+# Логирует сообщения в консоль и в файл bot.log (если включено логирование); fields - дополнительные поля записи.
+def log(msg, level=logging.INFO, **fields):
+    if bot_logger.isEnabledFor(level):
+        bot_logger.log(level, msg, extra={"fields": fields} if fields else None)
+
+# Логирует состояние пользователя, сообщение и данные внутри обработчика; user_data - только для доли вызовов.
 def log_state(update, context, handler_name):
+    if not bot_logger.isEnabledFor(logging.INFO):
+        return
     msg = update.message.text if update and update.message else None
     qd = update.callback_query.data if update and hasattr(update, "callback_query") and update.callback_query else None
-    log(f"=== HANDLER: {handler_name} ===")
-    log(f"User: {update.effective_user.id if update and update.effective_user else 'None'}")
-    log(f"Message: {msg}")
-    log(f"CallbackData: {qd}")
-    log(f"user_data: {context.user_data}")
+    fields = {
+        "user": update.effective_user.id if update and update.effective_user else None,
+        "message": msg,
+        "callback_data": qd,
+    }
+    if LOG_STATE_SAMPLE_RATE >= 1 or random.random() < LOG_STATE_SAMPLE_RATE:
+        fields["user_data"] = repr(context.user_data)
+    log(f"=== HANDLER: {handler_name} ===", **fields)
 
 # Преобразует размер в байтах в строку с KB, MB или GB.
 def format_size(size_bytes):
@@ -113,14 +667,14 @@ def format_size(size_bytes):
     gb = mb / 1024
     return f"{gb:.1f} GB"
 
-# Проверка работы MongoDB
+# Проверка работы MongoDB: (доступна ли, время ответа в мс, текст ошибки).
 def check_mongodb_connection():
+    started = time.perf_counter()
     try:
         client.admin.command('ping')
-        return True
+        return True, round((time.perf_counter() - started) * 1000, 1), None
     except Exception as e:
-        log(f"Ошибка подключения к MongoDB: {e}")
-        return False
+        return False, None, str(e)
 
 # Экранирует спецсимволы для Markdown-разметки.
 def escape_md(text):
@@ -165,7 +719,10 @@ def save_users(users):
                 UpdateOne({"id": u["id"]}, {"$set": u}, upsert=True)
             )
     if bulk_ops:
-        users_collection.bulk_write(bulk_ops)
+        result = users_collection.bulk_write(bulk_ops)
+        # Список папок зависит от пользователей только через их число.
+        if result.upserted_count:
+            bump_data_version()
 # Проверяет, существует ли пользователь с данным ID.
 def user_exists(user_id: int) -> bool:
     return users_collection.count_documents({"id": user_id}) > 0
@@ -190,6 +747,7 @@ def add_user(user_id: int, password: str, status: str = "default", username: str
         "folders_limit": 10
     }
     users_collection.insert_one(user_data)
+    bump_data_version()
 
 # Проверяет пароль пользователя.
 def check_password(user_id: int, password: str) -> bool:
@@ -218,22 +776,46 @@ def is_admin(user_id: int) -> bool:
     user = get_user(user_id)
     return user and user.get("status") == "admin"
 
+# Один проход по каталогу папки: ({имя файла: stat}, stat каталога) или (None, None), если каталога нет.
+def scan_folder_dir(folder_path):
+    started = time.perf_counter()
+    try:
+        dir_stat = os.stat(folder_path)
+        entries = {}
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    entries[entry.name] = entry.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None, None
+    finally:
+        fs_scan_seconds.observe(time.perf_counter() - started, "folder")
+    note_fs_calls(len(entries) + 1)
+    return entries, dir_stat
+
 # Синхронизирует метаданные файлов папки с реальными файлами на диске.
-def sync_files_in_folder(folder):
-    folder_path = os.path.join(DATABASE_DIR, folder["name"])
-    if not os.path.exists(folder_path):
+def sync_files_in_folder(folder, entries=None):
+    if entries is None:
+        entries, _ = scan_folder_dir(os.path.join(DATABASE_DIR, folder["name"]))
+    if entries is None:
         folder["files"] = []
         return folder
 
-    fs_files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
+    fs_files = list(entries)
     files_meta = folder.get("files", [])
 
+    folder_path = os.path.join(DATABASE_DIR, folder["name"])
     meta_by_name = {}
     meta_lost = []
     for meta in files_meta:
-        fpath = os.path.join(folder_path, meta["name"])
-        if os.path.exists(fpath):
-            stat = os.stat(fpath)
+        stat = entries.get(meta["name"])
+        if stat is not None:
+            if meta.get("tg_size") not in (None, stat.st_size):
+                # Файл на диске изменился - сохранённый file_id Telegram ему больше не соответствует.
+                for key in ("tg_file_id", "tg_file_type", "tg_size"):
+                    meta.pop(key, None)
+            if meta.get("compression") or meta.get("size") != stat.st_size:
+                sync_compression_meta(meta, os.path.join(folder_path, meta["name"]), stat.st_size)
             meta["size"] = stat.st_size
             meta["ctime"] = stat.st_ctime
             meta_by_name[meta["name"]] = meta
@@ -249,8 +831,7 @@ def sync_files_in_folder(folder):
             new_filemetas.append(meta_by_name[fname])
             continue
 
-        fpath = os.path.join(folder_path, fname)
-        stat = os.stat(fpath)
+        stat = entries[fname]
         fsize = stat.st_size
         fctime = stat.st_ctime
 
@@ -259,6 +840,8 @@ def sync_files_in_folder(folder):
             if "size" in lost and "ctime" in lost:
                 if abs(lost["size"] - fsize) < 2 or abs(lost["ctime"] - fctime) < 2:
                     lost["name"] = fname
+                    if lost.get("compression") or lost["size"] != fsize:
+                        sync_compression_meta(lost, os.path.join(folder_path, fname), fsize)
                     lost["size"] = fsize
                     lost["ctime"] = fctime
                     new_filemetas.append(lost)
@@ -266,32 +849,103 @@ def sync_files_in_folder(folder):
                     found = True
                     break
         if not found:
-            new_filemetas.append({
+            new_meta = {
                 "id": str(uuid.uuid4()),
                 "name": fname,
                 "size": fsize,
                 "ctime": fctime
-            })
+            }
+            # Файл мог быть сжат ботом раньше (например, метаданные папки потеряны) - узнаём по заголовку.
+            sync_compression_meta(new_meta, os.path.join(folder_path, fname), fsize)
+            new_filemetas.append(new_meta)
 
     folder["files"] = new_filemetas
     return folder
 
+# Поля файлов, от которых зависит список файлов папки: id, имена, размеры и даты (без file_id Telegram).
+def files_listing(files):
+    return {(f.get("id"), f.get("name"), f.get("size"), f.get("ctime"), f.get("logical_size")) for f in files}
+
+# Синхронизирует файлы папки с диском; True, если метаданные изменились и папку нужно сохранить.
+# Если изменился сам список файлов, увеличивает files_rev папки.
+def sync_folder_changed(folder, entries=None):
+    before = [dict(meta) for meta in folder.get("files", [])]
+    sync_files_in_folder(folder, entries)
+    if files_listing(folder["files"]) != files_listing(before):
+        folder["files_rev"] = folder.get("files_rev", 0) + 1
+    return folder["files"] != before
+
 # Загружает список папок и синхронизирует их с файловой системой.
 def load_folders():
     return list(folders_collection.find())
 
-# Сохраняет список папок.
+# Условие записи папки с версией rev, прочитанной раньше; у папок, созданных до появления rev, её нет (= 0).
+def folder_rev_filter(folder_id, rev):
+    return {"id": folder_id, "rev": rev if rev else {"$in": [0, None]}}
+
+# Сохраняет список папок. Прочитанная из базы папка (есть _id) записывается, только если её rev
+# не изменился с момента чтения; каждая запись увеличивает rev. Возвращает ID папок, которые за это
+# время изменили другие - их нужно перечитать (данные в списке для них устарели).
 def save_folders(folders):
     if not folders:
-        return
+        return []
     bulk_ops = []
+    expected = {}  # id -> rev после нашей записи
+    write_id = ObjectId()  # метка этой записи: по ней видно, какие из папок записали именно мы
     for f in folders:
         if "id" in f:
-            bulk_ops.append(
-                UpdateOne({"id": f["id"]}, {"$set": f}, upsert=True)
-            )
-    if bulk_ops:
-        folders_collection.bulk_write(bulk_ops)
+            fields = {key: value for key, value in f.items() if key not in ("_id", "rev")}
+            fields["write_id"] = write_id
+            if "_id" in f:
+                expected[f["id"]] = f.get("rev", 0) + 1
+                bulk_ops.append(UpdateOne(folder_rev_filter(f["id"], f.get("rev", 0)), {"$set": fields, "$inc": {"rev": 1}}))
+            else:
+                bulk_ops.append(
+                    UpdateOne({"id": f["id"]}, {"$set": fields, "$inc": {"rev": 1}}, upsert=True)
+                )
+    if not bulk_ops:
+        return []
+    result = folders_collection.bulk_write(bulk_ops)
+    conflicts = set()
+    if result.modified_count + result.upserted_count < len(bulk_ops):
+        written = {doc["id"] for doc in folders_collection.find({"id": {"$in": list(expected)}, "write_id": write_id}, {"id": 1})}
+        conflicts = set(expected) - written
+    for f in folders:
+        if "id" in f and f["id"] not in conflicts:
+            f["rev"] = expected.get(f["id"], 1)
+            if "files" in f:
+                file_search_index.update_folder(f)
+    if result.modified_count or result.upserted_count:
+        bump_data_version()
+    if conflicts:
+        folder_conflicts.inc("save", amount=len(conflicts))
+    return sorted(conflicts)
+
+# Изменение папки «прочитать - изменить - записать»: mutate(folder) меняет документ на месте и
+# возвращает False, если менять нечего. Запись проходит, только если rev не изменился с чтения;
+# иначе папка перечитывается и mutate применяется заново (до FOLDER_UPDATE_RETRIES раз).
+# Возвращает сохранённую папку, None - папки нет или конфликты не прекратились.
+def update_folder(folder_id, mutate):
+    for _ in range(FOLDER_UPDATE_RETRIES):
+        folder = folders_collection.find_one({"id": folder_id})
+        if not folder:
+            return None
+        rev = folder.get("rev", 0)
+        listing = files_listing(folder.get("files", []))
+        if mutate(folder) is False:
+            return folder
+        folder["rev"] = rev + 1
+        if files_listing(folder.get("files", [])) != listing:
+            folder["files_rev"] = folder.get("files_rev", 0) + 1
+        result = folders_collection.replace_one(folder_rev_filter(folder_id, rev), folder)
+        if result.matched_count:
+            if "files" in folder:
+                file_search_index.update_folder(folder)
+            bump_data_version()
+            return folder
+        folder_conflicts.inc("update")
+    log(f"Папку {folder_id} не удалось записать: её постоянно изменяют", level=logging.WARNING)
+    return None
 
 # Получает папку по имени.
 def get_folder_by_name(name):
@@ -328,25 +982,46 @@ def add_folder(name, owner_id, status="public"):
         "status": status,
         "files": [],
         "logging": False,
-        "logs": []
+        "logs": [],
+        "rev": 0,
+        "files_rev": 0
     }
     folders_collection.insert_one(folder_data)
+    bump_data_version()
 
 # Меняет статус папки (private/public) по ID.
 def set_folder_status_by_id(folder_id, status):
     folders_collection.update_one(
         {"id": folder_id},
-        {"$set": {"status": status}}
+        {"$set": {"status": status}, "$inc": {"rev": 1}}
     )
+    bump_data_version()
+
+# Запоминает file_id файла в Telegram, чтобы отправлять его повторно без выгрузки с диска.
+def remember_telegram_file(folder_id, file_meta, tg_file_id, tg_file_type, size):
+    tg_fields = {"tg_file_id": tg_file_id, "tg_file_type": tg_file_type, "tg_size": size}
+    file_meta.update(tg_fields)
+    folder = folders_collection.find_one_and_update(
+        {"id": folder_id, "files.id": file_meta["id"]},
+        {"$set": {f"files.$.{key}": value for key, value in tg_fields.items()}, "$inc": {"rev": 1}},
+        projection={"rev": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if folder:
+        file_search_index.set_telegram_file(file_meta["id"], tg_file_id, tg_file_type, folder["rev"])
 
 # Устанавливает или снимает "заморозку" папки.
 def set_folder_freezing_by_id(folder_id, freezing: bool):
-    folders = load_folders()
-    for folder in folders:
-        if folder["id"] == folder_id:
-            folder["freezing"] = freezing
-            break
-    save_folders(folders)
+    set_folder_fields(folder_id, freezing=freezing)
+
+# Поля папки, видимые в списке папок и влияющие на доступ к ней при поиске.
+FOLDER_LIST_FIELDS = {"name", "status", "freezing", "owner_id"}
+
+# Меняет поля одной папки атомарно (без чтения) и увеличивает её rev.
+def set_folder_fields(folder_id, **fields):
+    result = folders_collection.update_one({"id": folder_id}, {"$set": fields, "$inc": {"rev": 1}})
+    if result.modified_count and FOLDER_LIST_FIELDS.intersection(fields):
+        bump_data_version()
 
 # Проверяет, заморожена ли папка.
 def is_folder_frozen_by_id(folder_id):
@@ -378,16 +1053,57 @@ def rename_folder_fs(old_name, new_name):
     except Exception as e:
         return False, str(e)
 
-# Удаляет папку из базы по ID.
-def delete_folder_in_db_by_id(folder_id):
-    folders_collection.delete_one({"id": folder_id})
-
-# Переименовывает папку в базе по ID.
-def rename_folder_in_db_by_id(folder_id, new_name):
-    folders_collection.update_one(
-        {"id": folder_id},
-        {"$set": {"name": new_name}}
+# Удаляет папку из базы по ID; с арендой блокировки - только если жетон не устарел (иначе False).
+def delete_folder_in_db_by_id(folder_id, lease=None):
+    result = folders_collection.delete_one(fenced_folder_filter(folder_id, lease) if lease else {"id": folder_id})
+    if lease and not result.deleted_count:
+        return False
+    file_search_index.remove_folder(folder_id)
+    bump_data_version()
+    return True
+
+# Переименовывает папку в базе по ID; с арендой блокировки - только если жетон не устарел (иначе False).
+def rename_folder_in_db_by_id(folder_id, new_name, lease=None):
+    if lease:
+        result = folders_collection.update_one(
+            fenced_folder_filter(folder_id, lease),
+            {"$set": {"name": new_name, "lock_token": lease.token}, "$inc": {"rev": 1}}
+        )
+        if not result.matched_count:
+            return False
+    else:
+        folders_collection.update_one(
+            {"id": folder_id},
+            {"$set": {"name": new_name}, "$inc": {"rev": 1}}
+        )
+    bump_data_version()
+    return True
+
+# Добавляет метаданные файла в папку под блокировкой; False, если жетон устарел или папки уже нет.
+def add_file_to_folder(folder_id, file_meta, lease):
+    folder = folders_collection.find_one_and_update(
+        fenced_folder_filter(folder_id, lease),
+        {"$push": {"files": file_meta}, "$set": {"lock_token": lease.token}, "$inc": {"rev": 1, "files_rev": 1}},
+        return_document=ReturnDocument.AFTER
     )
+    if not folder:
+        return False
+    file_search_index.update_folder(folder)
+    bump_data_version()
+    return True
+
+# Убирает метаданные файла из папки под блокировкой; False, если жетон устарел или папки уже нет.
+def remove_file_from_folder(folder_id, file_id, lease):
+    folder = folders_collection.find_one_and_update(
+        fenced_folder_filter(folder_id, lease),
+        {"$pull": {"files": {"id": file_id}}, "$set": {"lock_token": lease.token}, "$inc": {"rev": 1, "files_rev": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not folder:
+        return False
+    file_search_index.update_folder(folder)
+    bump_data_version()
+    return True
 
 # Формирует список папок для вывода пользователю.
 def get_folders_for_list():
@@ -440,106 +1156,222 @@ def get_actual_folder_name_by_id(folder_id):
         return folder["name"] + suffix
     return None
 
+# Каталог для недокачанных файлов: вне DATABASE_DIR, чтобы сверка с диском их не видела.
+def get_uploads_dir():
+    path = os.path.join(os.path.dirname(DATABASE_DIR), UPLOADS_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
 # Синхронизирует папки между файловой системой и базой.
+# Папки и имена под блокировкой (их сейчас переименовывают или удаляют) пропускаются.
 def sync_folders_with_filesystem():
     folders_db = load_folders()
     folders_db_names = [f["name"] for f in folders_db]
     folders_fs = [f for f in os.listdir(DATABASE_DIR) if os.path.isdir(os.path.join(DATABASE_DIR, f))]
-    changed = False
-    for fs_folder in folders_fs:
-        if fs_folder not in folders_db_names:
+    new_fs = [f for f in folders_fs if f not in folders_db_names]
+    held = held_lock_keys([folder_lock_key(f["id"]) for f in folders_db] + [folder_name_lock_key(f) for f in new_fs])
+    changed = []
+    for fs_folder in new_fs:
+        if folder_name_lock_key(fs_folder) not in held:
             folders_db.append({"id": str(uuid.uuid4()), "name": fs_folder, "owner_id": None, "status": "public", "files": []})
             log(f"Добавлена новая папка с диска: {fs_folder}")
-            changed = True
-    valid_folders = []
     for folder in folders_db:
+        if folder_lock_key(folder["id"]) in held:
+            continue
         folder_path = os.path.join(DATABASE_DIR, folder["name"])
-        if os.path.isdir(folder_path):
-            folder = sync_files_in_folder(folder)
-            valid_folders.append(folder)
-    if changed:
-        save_folders(valid_folders)
+        if os.path.isdir(folder_path) and (sync_folder_changed(folder) or "_id" not in folder):
+            changed.append(folder)
+    # Папки, изменённые за время сверки, не перезаписываются: их сверит следующий проход.
+    save_folders(changed)
 
-# Удаляет из базы папки, которых нет на диске.
+# Удаляет из базы папки, которых нет на диске (кроме папок под блокировкой).
 def cleanup_nonexistent_folders():
     folders = load_folders()
-    valid_folders = []
-    valid_names = set()
+    held = held_lock_keys([folder_lock_key(f["id"]) for f in folders])
+    changed = []
+    to_remove = []
     for folder in folders:
+        if folder_lock_key(folder["id"]) in held:
+            continue
         folder_path = os.path.join(DATABASE_DIR, folder["name"])
-        if os.path.isdir(folder_path):
-            folder = sync_files_in_folder(folder)
-            valid_folders.append(folder)
-            valid_names.add(folder["name"])
-    all_db_names = set(f["name"] for f in folders)
-    to_remove = all_db_names - valid_names
+        if not os.path.isdir(folder_path):
+            to_remove.append(folder)
+        elif sync_folder_changed(folder):
+            changed.append(folder)
     if to_remove:
-        folders_collection.delete_many({"name": {"$in": list(to_remove)}})
-    save_folders(valid_folders)
+        # Как и при сохранении - только если папку не меняли после чтения.
+        folders_collection.bulk_write(
+            [DeleteOne(folder_rev_filter(f["id"], f.get("rev", 0))) for f in to_remove],
+            ordered=False
+        )
+        for folder in to_remove:
+            file_search_index.remove_folder(folder["id"])
+        bump_data_version()
+    save_folders(changed)
+
+# Снимок папки на время обработки одного нажатия: один запрос к базе и один проход по каталогу.
+class FolderSnapshot:
+    def __init__(self, folder, entries, dir_stat, changed=False):
+        self.folder = folder
+        self.entries = entries
+        self.dir_stat = dir_stat
+        self.changed = changed  # синхронизация с диском изменила метаданные файлов
+
+    @classmethod
+    def load(cls, folder_id):
+        folder = folders_collection.find_one({"id": folder_id})
+        if not folder:
+            return None
+        entries, dir_stat = scan_folder_dir(os.path.join(DATABASE_DIR, folder["name"]))
+        changed = sync_folder_changed(folder, entries)
+        return cls(folder, entries, dir_stat, changed)
+
+    @property
+    def id(self):
+        return self.folder["id"]
+
+    @property
+    def name(self):
+        return self.folder["name"]
+
+    @property
+    def owner_id(self):
+        return self.folder.get("owner_id")
+
+    @property
+    def status(self):
+        return self.folder.get("status")
+
+    @property
+    def frozen(self):
+        return self.folder.get("freezing") is True
+
+    @property
+    def logging(self):
+        return self.folder.get("logging", False)
+
+    @property
+    def files(self):
+        return self.folder["files"]
+
+    # Папка есть и в базе, и на диске.
+    @property
+    def exists(self):
+        return self.entries is not None
+
+    def created_date(self):
+        if self.dir_stat is None:
+            return "нет данных"
+        return datetime.datetime.fromtimestamp(self.dir_stat.st_ctime).strftime("%d.%m.%y")
+
+    # Количество файлов, логический и физический (на диске) размер.
+    def stats(self):
+        logical_size = sum(get_logical_size(f) for f in self.files)
+        physical_size = sum(f.get("size", 0) for f in self.files)
+        return len(self.files), format_size(logical_size), format_size(physical_size)
+
+    def find_file(self, file_id):
+        return next((f for f in self.files if f["id"] == file_id), None)
+
+    def file_path(self, file_meta):
+        return os.path.join(DATABASE_DIR, self.name, file_meta["name"])
+
+    # stat файла из снимка каталога или None, если файла на диске нет.
+    def file_stat(self, file_meta):
+        return self.entries.get(file_meta["name"]) if file_meta and self.entries else None
+
+    def access_denied_reason(self, user_id, admin):
+        return folder_access_denied_reason(self.folder, user_id, admin)
+
+# Причина отказа в доступе к папке (заморозка, приватность) или None.
+def folder_access_denied_reason(folder, user_id, admin):
+    if folder.get("freezing") is True and not admin:
+        return "Папка заморожена администратором."
+    if folder.get("status") == "private" and not (admin or user_id == folder.get("owner_id")):
+        return "Нет доступа к приватной папке."
+    return None
 
-# Получает количество файлов и общий размер папки.
-def get_folder_stats_by_id(folder_id):
-    folder = get_folder_by_id(folder_id)
+# Режимы сортировки списка файлов: подпись кнопки, ключ, по убыванию.
+FILE_SORT_MODES = {
+    "name": ("🔤 Имя", lambda f: f["name"], False),
+    "size": ("🗄 Размер", lambda f: (get_logical_size(f), f["name"]), True),
+    "date": ("🗓 Дата", lambda f: (f.get("ctime", 0), f["name"]), True),
+}
+
+# Отсортированные списки файлов по папкам: folder_id -> индекс, в порядке LRU.
+file_indexes = OrderedDict()
+
+# Возвращает (документ папки без файлов, файлы в порядке sort) или (None, None).
+# Список пересобирается, только если изменился список файлов папки (её files_rev) или её каталог на диске;
+# file_id Telegram, логи, изменения других папок и пользователей его не сбрасывают.
+def get_sorted_files(folder_id, sort):
+    folder = folders_collection.find_one({"id": folder_id}, {"files": 0, "logs": 0})
     if not folder:
-        return 0, "0 KB"
-    folder_path = os.path.join(DATABASE_DIR, folder["name"])
+        return None, None
     try:
-        files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-    except Exception:
-        files = []
-    num_files = len(files)
-    total_size = sum(os.path.getsize(os.path.join(folder_path, f)) for f in files) if files else 0
-    return num_files, format_size(total_size)
+        dir_mtime = os.stat(os.path.join(DATABASE_DIR, folder["name"])).st_mtime_ns
+    except OSError:
+        return folder, None
+
+    index = file_indexes.get(folder_id)
+    if index and index["files_rev"] == folder.get("files_rev", 0) and index["mtime"] == dir_mtime:
+        cache_requests.inc("file_index", "hit")
+        file_indexes.move_to_end(folder_id)
+    else:
+        cache_requests.inc("file_index", "miss")
+        # Новые файлы с диска получают id при синхронизации - сохраняем их, чтобы кнопки оставались рабочими.
+        # Если папку одновременно изменили, наши id не записались - перечитываем и синхронизируем заново.
+        for _ in range(FOLDER_UPDATE_RETRIES):
+            snapshot = FolderSnapshot.load(folder_id)
+            if not snapshot or not snapshot.exists:
+                return folder, None
+            conflicts = save_folders([snapshot.folder]) if snapshot.changed else []
+            if not conflicts:
+                break
+        # files_rev после синхронизации: save_folders записывает его вместе с файлами.
+        index = {"files_rev": snapshot.folder.get("files_rev", 0), "mtime": dir_mtime, "files": snapshot.files, "orders": {}}
+        if not conflicts:
+            file_indexes[folder_id] = index
+            file_indexes.move_to_end(folder_id)
+            if len(file_indexes) > FILE_INDEX_CACHE_SIZE:
+                file_indexes.popitem(last=False)
+
+    if sort not in index["orders"]:
+        _, key, reverse = FILE_SORT_MODES[sort]
+        index["orders"][sort] = sorted(index["files"], key=key, reverse=reverse)
+    return folder, index["orders"][sort]
+
+# Получает количество файлов, логический и физический (на диске) размер папки.
+def get_folder_stats_by_id(folder_id):
+    snapshot = FolderSnapshot.load(folder_id)
+    return snapshot.stats() if snapshot else (0, "0 KB", "0 KB")
 
 # Получает дату создания папки.
 def get_folder_created_date_by_id(folder_id):
-    folder = get_folder_by_id(folder_id)
-    if not folder:
-        return "нет данных"
-    folder_path = os.path.join(DATABASE_DIR, folder["name"])
-    if os.path.exists(folder_path):
-        stat = os.stat(folder_path)
-        date = datetime.datetime.fromtimestamp(stat.st_ctime)
-        return date.strftime("%d.%m.%y")
-    return "нет данных"
+    snapshot = FolderSnapshot.load(folder_id)
+    return snapshot.created_date() if snapshot else "нет данных"
 
 # Получает логи папки.
 def get_folder_logs(folder_id):
     folder = get_folder_by_id(folder_id)
     return folder.get("logs", []) if folder else []
 
-# Записывает логи папки.
+# Записывает логи папки: запись добавляется атомарно, в базе остаются последние FOLDER_LOGS_LIMIT.
 def add_folder_log(folder_id, user_id, username, log_text):
-    folders = load_folders()
-    for folder in folders:
-        if folder["id"] == folder_id:
-            now = datetime.datetime.now().strftime("%d.%m.%y, %H:%M")
-            log_entry = f"*[{now}]*: Пользователь {username} ({user_id}) {log_text}"
-            logs = folder.get("logs", [])
-            logs.append(log_entry)
-            if len(logs) > FOLDER_LOGS_LIMIT:
-                logs = logs[-FOLDER_LOGS_LIMIT:]
-            folder["logs"] = logs
-            break
-    save_folders(folders)
+    now = datetime.datetime.now().strftime("%d.%m.%y, %H:%M")
+    log_entry = f"*[{now}]*: Пользователь {username} ({user_id}) {log_text}"
+    folders_collection.update_one(
+        {"id": folder_id},
+        {"$push": {"logs": {"$each": [log_entry], "$slice": -FOLDER_LOGS_LIMIT}}, "$inc": {"rev": 1}}
+    )
 
 # Отчищает логи папки.
 def clear_folder_logs(folder_id):
-    folders = load_folders()
-    for folder in folders:
-        if folder["id"] == folder_id:
-            folder["logs"] = []
-            break
-    save_folders(folders)
+    set_folder_fields(folder_id, logs=[])
 
 # Устанавливает логирование для папки.
 def set_folder_logging(folder_id, enabled: bool):
-    folders = load_folders()
-    for folder in folders:
-        if folder["id"] == folder_id:
-            folder["logging"] = enabled
-            break
-    save_folders(folders)
+    set_folder_fields(folder_id, logging=enabled)
 
 # Проверка на логирование.
 def is_folder_logging_enabled(folder_id):
@@ -547,8 +1379,9 @@ def is_folder_logging_enabled(folder_id):
     return folder.get("logging", False) if folder else False
 
 # Получает дату последнего лога
-def get_last_folder_log_time(folder_id):
-    logs = get_folder_logs(folder_id)
+def get_last_folder_log_time(folder_id, logs=None):
+    if logs is None:
+        logs = get_folder_logs(folder_id)
     if not logs:
         return "нет логов"
     last_log = logs[-1]
@@ -558,13 +1391,13 @@ def get_last_folder_log_time(folder_id):
     return "нет логов"
 
 # Клавиатура меню логирования папки.
-def build_folder_logging_keyboard(folder_id, page, user_id):
-    enabled = is_folder_logging_enabled(folder_id)
-    logs = get_folder_logs(folder_id)
+def build_folder_logging_keyboard(folder_id, page, user_id, snapshot=None):
+    snapshot = snapshot or FolderSnapshot.load(folder_id)
+    enabled = snapshot.logging if snapshot else False
+    logs = snapshot.folder.get("logs", []) if snapshot else []
     logs_count = len(logs)
-    last_log = get_last_folder_log_time(folder_id)
-    folder = get_folder_by_id(folder_id)
-    folder_name = folder["name"] if folder else ""
+    last_log = get_last_folder_log_time(folder_id, logs)
+    folder_name = snapshot.name if snapshot else ""
     log_status_btn = InlineKeyboardButton("✅ Логирование: Вкл" if enabled else "❌ Логирование: Выкл",callback_data=f"folder_logging_toggle:{folder_id}:{page}")
     download_btn = InlineKeyboardButton("👁 Смотреть логи", callback_data=f"folder_logging_download:{folder_id}:{page}")
     clear_btn = InlineKeyboardButton("🗑 Удалить логи", callback_data=f"folder_logging_clear:{folder_id}:{page}")
@@ -583,20 +1416,15 @@ def build_folder_logging_keyboard(folder_id, page, user_id):
     )
     return text, InlineKeyboardMarkup(kb)
 
-# Получает общую статистику по базе данных.
+# Получает общую статистику по базе данных: одна агрегация по размерам файлов, сохранённым в базе,
+# без чтения документов папок целиком и без обхода диска.
 def get_database_stats():
-    folders = load_folders()
-    total_files = 0
-    total_size = 0
-    for folder in folders:
-        folder_path = os.path.join(DATABASE_DIR, folder["name"])
-        if not os.path.exists(folder_path):
-            continue
-        files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-        total_files += len(files)
-        total_size += sum(os.path.getsize(os.path.join(folder_path, f)) for f in files)
-    users_count = len([u for u in load_users() if "id" in u])
-    return len(folders), total_files, format_size(total_size), users_count
+    totals = next(folders_collection.aggregate([
+        {"$project": {"files": {"$size": {"$ifNull": ["$files", []]}}, "size": {"$sum": "$files.size"}}},
+        {"$group": {"_id": None, "folders": {"$sum": 1}, "files": {"$sum": "$files"}, "size": {"$sum": "$size"}}}
+    ]), {"folders": 0, "files": 0, "size": 0})
+    users_count = users_collection.count_documents({"id": {"$exists": True}})
+    return totals["folders"], totals["files"], format_size(totals["size"]), users_count
 
 # Возвращает клавиатуру для гостя.
 def get_guest_kb():
@@ -632,6 +1460,7 @@ def build_users_list_keyboard(users, current_user_id, page=0, total_pages=1):
     if nav_buttons:
         buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton("👤 Добавить пользователя", callback_data="user_add")])
+    buttons.append([InlineKeyboardButton("📢 Рассылка", callback_data="broadcast_new")])
     return InlineKeyboardMarkup(buttons)
 
 # Формирует строку с информацией о пользователях.
@@ -754,7 +1583,7 @@ def get_main_kb(user_id):
     ]
     if get_status(user_id) == "admin":
         buttons.append([KeyboardButton("⚙️ Управление пользователями")])
-    buttons.append([KeyboardButton("👁 Мой аккаунт")])
+    buttons.append([KeyboardButton("🔎 Поиск файлов"), KeyboardButton("👁 Мой аккаунт")])
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
 # Текст для меню профиля пользователя.
@@ -831,7 +1660,7 @@ def get_files_finish_kb():
     return ReplyKeyboardMarkup([[KeyboardButton("✅ Закончить добавление")]], resize_keyboard=True)
 
 # Клавиатура для списка файлов в папке.
-def build_files_keyboard(folder_id, page, total_pages, files):
+def build_files_keyboard(folder_id, page, total_pages, files, sort="name"):
     buttons = []
     for i in range(0, len(files), 2):
         row = [
@@ -854,6 +1683,11 @@ def build_files_keyboard(folder_id, page, total_pages, files):
             nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"files_page:{folder_id}:{page+1}"))
     if nav_buttons:
         buttons.append(nav_buttons)
+    if files:
+        buttons.append([
+            InlineKeyboardButton(("• " if mode == sort else "") + caption, callback_data=f"files_sort:{folder_id}:{mode}")
+            for mode, (caption, _, _) in FILE_SORT_MODES.items()
+        ])
     buttons.append([InlineKeyboardButton("🔙 Назад к управлению папкой", callback_data=f"back_to_folder:{folder_id}:{page}")])
     return InlineKeyboardMarkup(buttons)
 
@@ -882,15 +1716,16 @@ def build_folders_keyboard(page: int, total_pages: int, folders: list):
     return InlineKeyboardMarkup(buttons)
 
 # Клавиатура и текст для управления папкой.
-def build_folder_manage_keyboard(folder_id: str, page: int, user_id=None):
-    folder = get_folder_by_id(folder_id)
-    if not folder:
+def build_folder_manage_keyboard(folder_id: str, page: int, user_id=None, snapshot=None, admin=None):
+    snapshot = snapshot or FolderSnapshot.load(folder_id)
+    if not snapshot:
         return "Папка не найдена.", InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=f"folders_page:{page}")]])
-    num_files, folder_size = get_folder_stats_by_id(folder_id)
-    owner_id = folder["owner_id"]
-    date_str = get_folder_created_date_by_id(folder_id)
-    status = folder["status"]
-    freezing = folder.get("freezing", False)
+    folder = snapshot.folder
+    num_files, folder_size, disk_size = snapshot.stats()
+    owner_id = snapshot.owner_id
+    date_str = snapshot.created_date()
+    status = snapshot.status
+    freezing = snapshot.frozen
     owner_str = f"{owner_id}" if owner_id else "Console"
     priv_str = "🔒 Тип: Приватная" if status == "private" else "🌎 Тип: Публичная"
     freeze_str = "❄️ Статус: Заморожена" if freezing else "🔥 Статус: Обычный"
@@ -902,7 +1737,9 @@ def build_folder_manage_keyboard(folder_id: str, page: int, user_id=None):
             f"{freeze_str}\n"
             f"🗓 Дата создания: {date_str}\n"
             f"📄 Файлов: {num_files}\n"
-            f"🗄 Размер: {folder_size}```\n\n")
+            f"🗄 Размер: {folder_size}"
+            + (f"\n💾 На диске: {disk_size}" if disk_size != folder_size else "")
+            + "```\n\n")
     status_btn = InlineKeyboardButton("🔓 Сделать публичной" if status == "private" else "🔒 Сделать приватной",callback_data=f"{'folder_public' if status=='private' else 'folder_priv'}:{folder_id}:{page}")
     add_btn = InlineKeyboardButton("📂 Добавить файлы", callback_data=f"folder_add_files:{folder_id}:{page}")
     rename_btn = InlineKeyboardButton("✏️ Изменить имя", callback_data=f"folder_rename:{folder_id}:{page}")
@@ -911,7 +1748,8 @@ def build_folder_manage_keyboard(folder_id: str, page: int, user_id=None):
     delete_btn = InlineKeyboardButton("🗑 Удалить папку", callback_data=f"folder_delete_confirm:{folder_id}:{page}")
     back_btn = InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")
 
-    admin = is_admin(user_id)
+    if admin is None:
+        admin = is_admin(user_id)
     buttons = [
         [status_btn],
         [add_btn, rename_btn],
@@ -930,24 +1768,25 @@ def build_folder_manage_keyboard(folder_id: str, page: int, user_id=None):
     return text, InlineKeyboardMarkup(buttons)
 
 # Клавиатура и текст для управления файлом.
-def build_file_manage_keyboard(folder_id, file_id, page):
-    folder = get_folder_by_id(folder_id)
-    if not folder:
+def build_file_manage_keyboard(folder_id, file_id, page, snapshot=None):
+    snapshot = snapshot or FolderSnapshot.load(folder_id)
+    if not snapshot:
         return "Папка не найдена.", InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=f"folders_page:{page}")]])
-    file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
+    file_meta = snapshot.find_file(file_id)
     if not file_meta:
         return "Файл не найден.", InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=f"back_to_file_list:{folder_id}:{page}")]])
-    file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"])
-    file_exists = os.path.exists(file_path)
+    file_path = snapshot.file_path(file_meta)
+    file_stat = snapshot.file_stat(file_meta)
+    file_exists = file_stat is not None
 
     file_type = "📄 Тип файла: Документ"
     if file_exists:
         ext = os.path.splitext(file_meta["name"])[1].lower()
         if ext == ".gif":
             file_type = "🎞 Тип файла: GIF"
-        elif ext in [".jpg", ".jpeg", ".png", ".bmp", ".webp"]:
+        elif ext in IMAGE_EXTS:
             file_type = "🖼 Тип файла: Фото"
-        elif ext in [".mp4", ".mov", ".avi", ".mkv", ".webm"]:
+        elif ext in VIDEO_EXTS:
             file_type = "📹 Тип файла: Видео"
         elif ext in [".zip", ".rar", ".7z", ".tar", ".gz", ".iso", "arj"]:
             file_type = "📚 Тип файла: Архив"
@@ -967,11 +1806,10 @@ def build_file_manage_keyboard(folder_id, file_id, page):
 
     info_text = f"*📄 Управление файлом*\n\n"
     if file_exists:
-        size = format_size(os.path.getsize(file_path))
+        size = format_size(get_logical_size(file_meta, file_stat.st_size))
         created_at = file_meta.get("created_at")
-        if not created_at and os.path.exists(file_path):
-            stat = os.stat(file_path)
-            created_at = datetime.datetime.fromtimestamp(stat.st_ctime).strftime('%d.%m.%y')
+        if not created_at:
+            created_at = datetime.datetime.fromtimestamp(file_stat.st_ctime).strftime('%d.%m.%y')
         elif created_at:
             try:
                 dt = datetime.datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
@@ -994,121 +1832,1800 @@ def build_file_manage_keyboard(folder_id, file_id, page):
         [InlineKeyboardButton("📥 Скачать файл", callback_data=f"file_get:{file_id}:{page}")],
         [InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]
     ]
+    if file_exists and is_thumbnail_supported(file_meta["name"]):
+        if get_cached_thumbnail(file_id, file_path, file_stat.st_mtime):
+            buttons[1].insert(0, InlineKeyboardButton("🖼 Превью", callback_data=f"file_preview:{file_id}:{page}"))
+        else:
+            schedule_thumbnail(file_id, file_path)
     return info_text, InlineKeyboardMarkup(buttons)
 
-###############################
-######### ОБРАБОТЧИКИ #########
-###############################
+#############################################
+######### РАСПРЕДЕЛЁННЫЕ БЛОКИРОВКИ #########
+#############################################
+
+# Аренда блокировки в коллекции locks: документ {_id: ключ, owner, token, expires_at}.
+# Жетон (fencing token) растёт при каждом захвате ключа и записывается в изменённый документ папки,
+# поэтому запись держателя, чья аренда истекла и перешла другому экземпляру, база отклонит.
+# Срок аренды сравнивается по часам экземпляров - они должны быть синхронизированы (NTP).
+class Lease:
+    def __init__(self, key, token, ttl, requested):
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.expires = requested + ttl  # по time.monotonic(), с момента запроса - с запасом
+
+    def valid(self):
+        return time.monotonic() < self.expires
+
+# Блокировку не удалось взять за LOCK_WAIT секунд.
+class LockBusy(Exception):
+    pass
+
+def folder_lock_key(folder_id):
+    return f"folder:{folder_id}"
+
+# Имя папки блокируется отдельно: переименование и сверка с диском не должны занять одно имя дважды.
+def folder_name_lock_key(name):
+    return f"folder_name:{name}"
+
+# Пытается взять блокировку без ожидания; Lease или None, если её держит кто-то другой.
+def try_acquire_lock(key, ttl=LOCK_TTL):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    requested = time.monotonic()
+    try:
+        doc = locks_collection.find_one_and_update(
+            {"_id": key, "expires_at": {"$lte": now}},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + datetime.timedelta(seconds=ttl)}, "$inc": {"token": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None  # документ есть и аренда не истекла
+    return Lease(key, doc["token"], ttl, requested)
+
+# Продлевает аренду; False, если её уже забрал другой экземпляр.
+def renew_lock(lease):
+    requested = time.monotonic()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    result = locks_collection.update_one(
+        {"_id": lease.key, "token": lease.token},
+        {"$set": {"expires_at": now + datetime.timedelta(seconds=lease.ttl)}}
+    )
+    if not result.matched_count:
+        lease.expires = 0
+        return False
+    lease.expires = requested + lease.ttl
+    return True
+
+# Освобождает блокировку, если она всё ещё наша; документ остаётся, чтобы жетоны ключа продолжали расти.
+def release_lock(lease):
+    locks_collection.update_one(
+        {"_id": lease.key, "token": lease.token},
+        {"$set": {"owner": None, "expires_at": datetime.datetime.now(datetime.timezone.utc)}}
+    )
 
-#Проверяет доступ пользователя для Inline-обработчиков.
-async def precheck_inline(update, context):
-    user_id = update.effective_user.id if update and update.effective_user else None
-    if not is_in_database(user_id) or is_banned(user_id):
-        await update.callback_query.answer("Нет доступа.", show_alert=True)
-        return True
-    return False
+# Какие из ключей сейчас заняты (одним запросом).
+def held_lock_keys(keys):
+    if not keys:
+        return set()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {doc["_id"] for doc in locks_collection.find({"_id": {"$in": list(keys)}, "expires_at": {"$gt": now}}, {"_id": 1})}
+
+# Держит блокировки ключей на время операции и отдаёт список Lease в порядке ключей. Ждёт занятые
+# до wait секунд (иначе LockBusy), пока держит - продлевает аренду. Ключи берутся в отсортированном
+# порядке, чтобы два экземпляра с пересекающимися наборами не ждали друг друга.
+@contextlib.asynccontextmanager
+async def hold_locks(*keys, wait=LOCK_WAIT):
+    leases = {}
+    deadline = time.monotonic() + wait
+    try:
+        for key in sorted(set(keys)):
+            delay = 0.05
+            while (lease := try_acquire_lock(key)) is None:
+                if time.monotonic() + delay > deadline:
+                    lock_waits.inc("busy")
+                    raise LockBusy(key)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1)
+            leases[key] = lease
+        lock_waits.inc("acquired")
+        renewer = asyncio.create_task(keep_leases(list(leases.values())))
+        try:
+            yield [leases[key] for key in keys]
+        finally:
+            renewer.cancel()
+    finally:
+        for lease in leases.values():
+            try:
+                release_lock(lease)
+            except Exception as e:
+                log(f"Блокировка {lease.key} не освобождена (истечёт сама): {e}", level=logging.WARNING)
+
+async def keep_leases(leases):
+    while True:
+        await asyncio.sleep(LOCK_TTL / 3)
+        for lease in leases:
+            if lease.expires and not await asyncio.to_thread(renew_lock, lease):
+                log(f"Аренда блокировки {lease.key} потеряна", level=logging.WARNING)
+
+# Условие записи в папку под блокировкой: отклоняет держателя с устаревшим жетоном.
+def fenced_folder_filter(folder_id, lease):
+    return {"id": folder_id, "$or": [{"lock_token": {"$lte": lease.token}}, {"lock_token": {"$exists": False}}]}
+
+lock_waits = MetricCounter("bot_lock_acquire_total", "Захваты блокировок папок: acquired - взяты, busy - не дождались.", ("result",))
+
+####################################
+######### КЭШ СПИСКА ПАПОК #########
+####################################
+
+# Версия данных: растёт при изменениях, видимых в списке папок, его статистике и поиске -
+# папки и их статусы, файлы, число пользователей. Логи и file_id Telegram её не меняют.
+# Версия общая для всех экземпляров бота (счётчик в коллекции counters); data_version - её последнее
+# увиденное этим процессом значение.
+data_version = 0
+last_folders_sync = 0.0
+folders_page_cache = {"version": None, "folders": None, "stats": None, "pages": {}}
+
+# Отмечает изменение данных для всех экземпляров; кэши с прежней версией становятся неактуальными.
+def bump_data_version():
+    doc = counters_collection.find_one_and_update(
+        {"_id": "data_version"}, {"$inc": {"value": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    observe_data_version(doc["value"], own=True)
+
+# Читает общую версию перед выдачей из кэшей: так видны изменения, сделанные другими экземплярами.
+def refresh_data_version():
+    doc = counters_collection.find_one({"_id": "data_version"})
+    observe_data_version(doc["value"] if doc else 0)
+
+# Запоминает версию; если между нашими версиями данные меняли другие, индекс поиска догоняет их изменения.
+def observe_data_version(value, own=False):
+    global data_version
+    if value != data_version + (1 if own else 0):
+        file_search_index.catch_up()
+    data_version = value
+
+# Сверяет папки с диском не чаще, чем раз в FOLDERS_SYNC_INTERVAL секунд.
+def reconcile_folders(force=False):
+    global last_folders_sync
+    now = time.monotonic()
+    if not force and now - last_folders_sync < FOLDERS_SYNC_INTERVAL:
+        return
+    last_folders_sync = now
+    # Сверку выполняет один экземпляр за раз; остальные пропускают этот период.
+    lease = try_acquire_lock("reconcile", ttl=max(LOCK_TTL, FOLDERS_SYNC_INTERVAL))
+    if lease is None:
+        return
+    try:
+        sync_folders_with_filesystem()
+        cleanup_nonexistent_folders()
+    finally:
+        release_lock(lease)
+    fs_scan_seconds.observe(time.monotonic() - now, "all")
+
+# Текст и клавиатура страницы списка папок; кэшируются по (страница, версия данных).
+def render_folders_page(page):
+    reconcile_folders()
+    refresh_data_version()
+    cache = folders_page_cache
+    if cache["version"] != data_version:
+        cache.update(version=data_version, folders=None, stats=None, pages={})
+    if page in cache["pages"]:
+        cache_requests.inc("folders_page", "hit")
+        return cache["pages"][page]
+    cache_requests.inc("folders_page", "miss")
+
+    if cache["folders"] is None:
+        cache["folders"] = get_folders_for_list()
+    if cache["stats"] is None:
+        cache["stats"] = get_database_stats()
+    folders = cache["folders"]
+    total_pages = max(1, (len(folders) + FOLDERS_PER_PAGE - 1) // FOLDERS_PER_PAGE)
+    page_index = max(0, min(page, total_pages - 1))
+    page_folders = folders[page_index * FOLDERS_PER_PAGE : (page_index + 1) * FOLDERS_PER_PAGE]
+    num_folders, total_files, total_size, users_count = cache["stats"]
+    stats_message = (
+        f"*🗂 Список всех доступных папок в БД*\n\n"
+        f"```Информация\n"
+        f"📂 Папок: {num_folders}\n"
+        f"📄 Всего файлов: {total_files}\n"
+        f"🗄 Общий вес базы: {total_size}\n"
+        f"👤 Пользователей: {users_count}```\n\n"
+        "*🔎 Выберите папку:*"
+    )
+    rendered = (stats_message, build_folders_keyboard(page_index, total_pages, page_folders))
+    # Кэш ограничен числом существующих страниц: номера за пределами сводятся к крайним.
+    cache["pages"][page_index] = rendered
+    return rendered
+
+################################
+######### ПОИСК ФАЙЛОВ #########
+################################
+
+# Триграммы строки для индекса поиска.
+def name_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Поля папки, нужные индексу поиска.
+SEARCH_INDEX_PROJECTION = {"id": 1, "rev": 1, "files.id": 1, "files.name": 1, "files.tg_file_id": 1, "files.tg_file_type": 1}
+
+# Индекс имён файлов в памяти: триграмма -> id файлов, плюс имена всех файлов и каждой папки по порядку -
+# по ним поиск сужается до доступных пользователю папок, если в них меньше файлов, чем кандидатов по триграммам.
+# Обновляется при каждой записи файлов папки (save_folders, update_folder и др.), поэтому изменения попадают в него сразу;
+# изменения других экземпляров бота догоняет catch_up по rev папок, когда меняется общая версия данных.
+class FileSearchIndex:
+    def __init__(self):
+        self.files = {}  # file_id -> (folder_id, имя, имя в нижнем регистре)
+        self.folders = {}  # folder_id -> {file_id: имя}
+        self.grams = {}
+        self.order = []  # (имя в нижнем регистре, file_id), по возрастанию после построения
+        self.orders = {}  # folder_id -> такие же пары файлов папки
+        self.telegram = {}  # file_id -> (tg_file_id, tg_file_type) для inline-режима
+        self.revs = {}  # folder_id -> rev папки, с которым она попала в индекс
+        self.ready = False
+        self._lock = threading.Lock()
+        self._touched = None  # папки, изменённые во время построения
+
+    # Полное построение по базе; выполняется в фоне при запуске.
+    def build(self):
+        started = time.perf_counter()
+        with self._lock:
+            self._touched = set()
+        try:
+            for folder in folders_collection.find({}, SEARCH_INDEX_PROJECTION):
+                with self._lock:
+                    if folder.get("id") and folder["id"] not in self._touched:
+                        self._update(folder)
+        except Exception as e:
+            log(f"Ошибка построения индекса поиска: {e}", level=logging.ERROR)
+            return
+        finally:
+            with self._lock:
+                self._touched = None
+                self.order.sort()
+                for order in self.orders.values():
+                    order.sort()
+        self.ready = True
+        log(f"Индекс поиска построен: {len(self.files)} файлов за {time.perf_counter() - started:.2f} с")
+
+    # Сверяет файлы папки с индексом; меняются только добавленные, удалённые и переименованные.
+    def update_folder(self, folder):
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(folder["id"])
+            self._update(folder)
+
+    # folder_rev - rev папки после записи file_id; если до неё папку меняли другие, её перечитает catch_up.
+    def set_telegram_file(self, file_id, tg_file_id, tg_file_type, folder_rev=None):
+        with self._lock:
+            if file_id in self.files:
+                self.telegram[file_id] = (tg_file_id, tg_file_type)
+                folder_id = self.files[file_id][0]
+                if folder_rev is not None and self.revs.get(folder_id) == folder_rev - 1:
+                    self.revs[folder_id] = folder_rev
+
+    # Перечитывает папки, чей rev в базе отличается от rev в индексе, и убирает удалённые.
+    def catch_up(self):
+        if not self.ready:
+            return
+        revs = {f["id"]: f.get("rev", 0) for f in folders_collection.find({}, {"id": 1, "rev": 1}) if f.get("id")}
+        with self._lock:
+            stale = [folder_id for folder_id, rev in revs.items() if self.revs.get(folder_id) != rev]
+            gone = [folder_id for folder_id in self.folders if folder_id not in revs]
+        for folder_id in gone:
+            self.remove_folder(folder_id)
+        if stale:
+            for folder in folders_collection.find({"id": {"$in": stale}}, SEARCH_INDEX_PROJECTION):
+                self.update_folder(folder)
+
+    def remove_folder(self, folder_id):
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(folder_id)
+            self._update({"id": folder_id, "files": []})
+            self.folders.pop(folder_id, None)
+            self.orders.pop(folder_id, None)
+            self.revs.pop(folder_id, None)
+
+    # Файлы из папок allowed, в имени которых есть query, по имени: (всего совпадений, [(file_id, folder_id, имя)]).
+    # Для слишком общих запросов совпадения не досчитываются до конца (просматривается не больше SEARCH_SCAN_LIMIT
+    # имён), вместо числа возвращается None, а в списке - найденные к этому моменту.
+    # telegram_only - только файлы с сохранённым file_id Telegram.
+    def search(self, query, allowed, limit, telegram_only=False):
+        needle = query.lower()
+        grams = name_trigrams(needle)
+        with self._lock:
+            files = self.files
+            orders = [self.orders[folder_id] for folder_id in allowed if folder_id in self.orders]
+            visible = sum(map(len, orders))
+            sets = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+
+            def matches(file_id, lowered):
+                return needle in lowered and (not telegram_only or file_id in self.telegram)
+
+            if visible <= limit * 50:
+                # Доступных файлов мало: просматриваем их имена по порядку целиком.
+                found = [file_id for order in orders for lowered, file_id in order if matches(file_id, lowered)]
+                top = heapq.nsmallest(limit, found, key=lambda file_id: files[file_id][2])
+                return len(found), [(file_id, files[file_id][0], files[file_id][1]) for file_id in top]
+            candidates = sets[0].intersection(*sets[1:]) if sets and len(sets[0]) <= SEARCH_SCAN_LIMIT else None
+            if candidates is not None and len(candidates) <= limit * 50:
+                found = [file_id for file_id in candidates if files[file_id][0] in allowed and matches(file_id, files[file_id][2])]
+                top = heapq.nsmallest(limit, found, key=lambda file_id: files[file_id][2])
+                return len(found), [(file_id, files[file_id][0], files[file_id][1]) for file_id in top]
+
+            # Кандидатов много: идём по именам доступных папок по порядку до первых limit совпадений,
+            # но не дальше SEARCH_SCAN_LIMIT имён.
+            # Если доступна большая часть файлов, общий порядок дешевле слияния списков папок.
+            top = []
+            if visible * 2 >= len(files):
+                walk = ((lowered, file_id) for lowered, file_id in self.order if files[file_id][0] in allowed)
+            else:
+                walk = orders[0] if len(orders) == 1 else heapq.merge(*orders)
+            for lowered, file_id in itertools.islice(walk, SEARCH_SCAN_LIMIT):
+                if matches(file_id, lowered):
+                    top.append(file_id)
+                    if len(top) > limit:
+                        return None, [(file_id, files[file_id][0], files[file_id][1]) for file_id in top[:limit]]
+            if visible <= SEARCH_SCAN_LIMIT:
+                return len(top), [(file_id, files[file_id][0], files[file_id][1]) for file_id in top]
+            # Первые по порядку имена почти не совпадают: добираем любые совпадения среди кандидатов по триграммам
+            # (тоже не больше SEARCH_SCAN_LIMIT) и сообщаем, что список неполный.
+            found = set(top)
+            pool = candidates if candidates is not None else sets[0] if sets else (file_id for order in orders for _, file_id in order)
+            for file_id in itertools.islice(pool, SEARCH_SCAN_LIMIT):
+                if files[file_id][0] in allowed and matches(file_id, files[file_id][2]):
+                    found.add(file_id)
+                    if len(found) > limit:
+                        break
+            top = heapq.nsmallest(limit, found, key=lambda file_id: files[file_id][2])
+            return None, [(file_id, files[file_id][0], files[file_id][1]) for file_id in top]
+
+    def _update(self, folder):
+        folder_id = folder["id"]
+        self.revs[folder_id] = folder.get("rev", 0)
+        current = self.folders.get(folder_id, {})
+        fresh = {f["id"]: f["name"] for f in folder.get("files", []) if "id" in f and "name" in f}
+        for f in folder.get("files", []):
+            if f.get("tg_file_id") and f.get("id") in fresh:
+                self.telegram[f["id"]] = (f["tg_file_id"], f.get("tg_file_type", "document"))
+            elif f.get("id") in self.telegram:
+                del self.telegram[f["id"]]
+        if current == fresh:
+            return
+        removed = [(name.lower(), file_id) for file_id, name in current.items() if fresh.get(file_id) != name]
+        added = [(name.lower(), file_id) for file_id, name in fresh.items() if current.get(file_id) != name]
+        for lowered, file_id in removed:
+            self._discard(file_id, lowered)
+        for lowered, file_id in added:
+            self._add(folder_id, file_id, fresh[file_id], lowered)
+        self._reorder(folder_id, removed, added)
+        self.folders[folder_id] = fresh
+
+    # Поддерживает общий порядок имён и порядок папки: единичные изменения - бинарным поиском, массовые - одним проходом.
+    def _reorder(self, folder_id, removed, added):
+        self.order = self._reordered(self.order, removed, added)
+        order = self._reordered(self.orders.get(folder_id, []), removed, added)
+        if order:
+            self.orders[folder_id] = order
+        else:
+            self.orders.pop(folder_id, None)
+
+    def _reordered(self, order, removed, added):
+        if removed:
+            if self.ready and len(removed) <= 32:
+                for entry in removed:
+                    position = bisect.bisect_left(order, entry)
+                    if position < len(order) and order[position] == entry:
+                        del order[position]
+            else:
+                dropped = set(removed)
+                order = [entry for entry in order if entry not in dropped]
+        if added:
+            if self.ready and len(added) <= 32:
+                for entry in added:
+                    bisect.insort(order, entry)
+            else:
+                order.extend(added)
+                if self.ready:
+                    order.sort()
+        return order
+
+    def _add(self, folder_id, file_id, name, lowered):
+        self.files[file_id] = (folder_id, name, lowered)
+        for gram in name_trigrams(lowered):
+            self.grams.setdefault(gram, set()).add(file_id)
+
+    def _discard(self, file_id, lowered):
+        self.files.pop(file_id, None)
+        self.telegram.pop(file_id, None)
+        for gram in name_trigrams(lowered):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(file_id)
+                if not ids:
+                    del self.grams[gram]
+
+file_search_index = FileSearchIndex()
+
+# Папки, в которых пользователь может искать (с учётом заморозки и приватности): folder_id -> имя.
+def get_searchable_folders(user_id):
+    admin = is_admin(user_id)
+    return {
+        folder["id"]: folder["name"]
+        for folder in folders_collection.find({}, {"files": 0, "logs": 0})
+        if folder.get("id") and not folder_access_denied_reason(folder, user_id, admin)
+    }
 
-# Проверяет доступ пользователя для Reply-обработчиков.
-async def precheck_reply(update, context):
-    user_id = update.effective_user.id if update and update.effective_user else None
-    if not is_in_database(user_id):
-        await update.message.reply_text("Войдите через кнопку ниже.", reply_markup=get_guest_kb())
-        return True
-    if is_banned(user_id):
-        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
-        return True
-    return False
+# Тип файла Telegram по классу объекта из сообщения.
+TELEGRAM_FILE_TYPES = {"Document": "document", "PhotoSize": "photo", "Audio": "audio", "Video": "video", "Animation": "animation"}
+
+# Результат inline-запроса по типу сохранённого file_id: (id результата, file_id, имя файла, имя папки).
+INLINE_RESULT_BUILDERS = {
+    "document": lambda rid, tg_id, name, folder: InlineQueryResultCachedDocument(rid, name, tg_id, description=folder),
+    "photo": lambda rid, tg_id, name, folder: InlineQueryResultCachedPhoto(rid, tg_id, title=name, description=folder),
+    "audio": lambda rid, tg_id, name, folder: InlineQueryResultCachedAudio(rid, tg_id),
+    "video": lambda rid, tg_id, name, folder: InlineQueryResultCachedVideo(rid, tg_id, name, description=folder),
+    "animation": lambda rid, tg_id, name, folder: InlineQueryResultCachedGif(rid, tg_id, title=name),
+}
+
+# Совпадения inline-запросов: (user_id, запрос) -> (версия данных, время, полный ли список, совпадения), в порядке LRU.
+inline_results_cache = OrderedDict()
+
+# Файлы для inline-запроса: [(file_id, имя, имя папки, tg_file_id, tg_file_type)].
+# Пока пользователь дописывает запрос, совпадения фильтруются из уже найденных для его начала.
+def get_inline_matches(user_id, text):
+    refresh_data_version()
+    needle = text.lower()
+    now = time.monotonic()
+    for size in range(len(needle), SEARCH_MIN_QUERY - 1, -1):
+        key = (user_id, needle[:size])
+        cached = inline_results_cache.get(key)
+        if not cached or cached[0] != data_version or now - cached[1] >= INLINE_CACHE_TIME:
+            continue
+        if size == len(needle):
+            cache_requests.inc("inline_results", "hit")
+            inline_results_cache.move_to_end(key)
+            return cached[3]
+        if cached[2]:
+            cache_requests.inc("inline_results", "prefix")
+            matches = [match for match in cached[3] if needle in match[1].lower()]
+            break
+    else:
+        cache_requests.inc("inline_results", "miss")
+        folders = get_searchable_folders(user_id)
+        total, found = file_search_index.search(text, folders, SEARCH_MAX_RESULTS, telegram_only=True)
+        matches = []
+        for file_id, folder_id, name in found:
+            tg_file = file_search_index.telegram.get(file_id)
+            if tg_file:
+                matches.append((file_id, name, folders[folder_id], *tg_file))
+        cached = (data_version, now, total is not None and total <= SEARCH_MAX_RESULTS)
+
+    inline_results_cache[(user_id, needle)] = (cached[0], cached[1], cached[2], matches)
+    inline_results_cache.move_to_end((user_id, needle))
+    while len(inline_results_cache) > INLINE_CACHE_SIZE:
+        inline_results_cache.popitem(last=False)
+    return matches
+
+###################################
+######### СЖАТОЕ ХРАНЕНИЕ #########
+###################################
+
+_zstd_module = None
+
+# Сжатый ботом файл начинается с заголовка: метка, алгоритм (g/z) и исходный размер (8 байт).
+# По нему сжатие распознаётся по самому файлу, а не только по метаданным в базе.
+STORAGE_MAGIC = b"TGDBZ1"
+STORAGE_HEADER_SIZE = len(STORAGE_MAGIC) + 1 + 8
+STORAGE_CODEC_IDS = {"gzip": b"g", "zstd": b"z"}
+# Сигнатуры форматов: по ним проверяются файлы, сжатые до появления заголовка.
+STORAGE_CODEC_SIGNATURES = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+# Возвращает модуль zstandard или None, если он не установлен.
+def get_zstd():
+    global _zstd_module
+    if _zstd_module is None:
+        try:
+            import zstandard
+            _zstd_module = zstandard
+        except ImportError:
+            _zstd_module = False
+    return _zstd_module or None
+
+# Выбирает алгоритм сжатия по настройке STORAGE_COMPRESSION.
+def get_storage_codec():
+    if STORAGE_COMPRESSION in ("zstd", "auto") and get_zstd():
+        return "zstd"
+    if STORAGE_COMPRESSION in ("gzip", "zstd", "auto"):
+        return "gzip"
+    return None
 
-# Приветственное сообщение, /start бота
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log_state(update, context, "start")
-    photo_path = os.path.join(BASE_DIR, "start.jpg")
-    caption = (
-        "*👋 Добро пожаловать!*\n\n"
-        "🗄 *Приватный файловый менеджер*\n\n"
-        "*1️⃣ Возможности:*\n"
-        "✈️ Отправка файлов на сервер\n"
-        "📑 Загрузка любых типов файлов\n"
-        "✏️ Настройка файлов внутри бота\n"
-        "🔒 Ограничение доступка к папкам\n"
-        "📝 Система логирования\n"
-        "⚙️ Умное управление пользователями\n"
-        "🦾 Хранение данных в MongoDB\n"
-        "🤖 Доступно Local Bot API\n\n"
-        "*2️⃣ Принципы работы:*\n"
-        "⚡ Все действия — простые и быстрые\n"
-        "🛡 Безопасность ваших данных\n"
-        "✅ Только авторизованные пользователи\n\n"
-        "*3️⃣ Ссылки:*\n"
-        "💭 Автор проекта: [ibuzy](https://t.me/ibuzy)\n"
-        "🔗 GitHub репозиторий: [Kol-Dayn](https://github.com/Kol-Dayn/Database)\n\n"
-        "`Этот проект распространяется на условиях лицензии Apache-2.0 license.`\n\n"
-        "*➡️ Для входа — воспользуйтесь кнопкой в меню*"
-    )
-    if os.path.exists(photo_path):
-        with open(photo_path, "rb") as photo_file:
-            await update.message.reply_photo(photo=photo_file,caption=caption,parse_mode="Markdown",reply_markup=get_guest_kb())
+# Оценивает степень сжатия по первым байтам файла.
+def sample_compression_ratio(file_path, codec):
+    with open(file_path, "rb") as f:
+        sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    if not sample:
+        return 1.0
+    if codec == "zstd":
+        packed = get_zstd().ZstdCompressor(level=1).compress(sample)
     else:
-        await update.message.reply_text(caption, parse_mode="Markdown", reply_markup=get_guest_kb())
+        packed = zlib.compress(sample, 1)
+    return len(sample) / max(1, len(packed))
 
-# Обработка авторизации пользователя.
-async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log_state(update, context, "auth")
-    user_id = update.effective_user.id
-    if not is_in_database(user_id):
-        await update.message.reply_text("❓ Вас нет в базе данных пользователей. Доступ ограничен.", reply_markup=get_guest_kb())
-        return ConversationHandler.END
-    if is_banned(user_id):
-        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
-        return ConversationHandler.END
-    password = update.message.text
-    if check_password(user_id, password):
-        set_authorized(user_id, True)
-        try:
-            await update.message.delete()
-        except Exception:
-            pass
-        await update.message.reply_text("*✅ Успешный вход!*\n\n_Сообщение с вашим паролем было удалено для повышения безопасности._",parse_mode="Markdown", reply_markup=get_main_kb(user_id))
-        return ConversationHandler.END
-    set_authorized(user_id, False)
-    await update.message.reply_text("*❌ Неверный пароль.* Попробуйте снова.",parse_mode="Markdown", reply_markup=get_guest_kb())
-    return ConversationHandler.END
+# Проверяет, стоит ли сжимать файл: по MIME-типу или по пробному сжатию.
+def is_compressible(file_path, codec):
+    if os.path.getsize(file_path) < COMPRESSION_MIN_SIZE:
+        return False
+    ext = os.path.splitext(file_path)[1].lower()
+    mime, _ = mimetypes.guess_type(file_path)
+    if ext in COMPRESSIBLE_EXTS or (mime and (mime.startswith("text/") or mime in COMPRESSIBLE_MIME_TYPES)):
+        return True
+    if mime and mime.split("/")[0] in ("image", "video", "audio"):
+        return False
+    return sample_compression_ratio(file_path, codec) >= COMPRESSION_MIN_RATIO
 
-# Меню для неавторизованных пользователей.
-async def guest_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log_state(update, context, "guest_menu")
-    user_id = update.effective_user.id
-    if not is_in_database(user_id):
-        await update.message.reply_text("❓ Вас нет в базе данных пользователей. Доступ ограничен.", reply_markup=get_guest_kb())
-        return ConversationHandler.END
-    if is_banned(user_id):
-        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
-        return ConversationHandler.END
-    user = get_user(user_id)
-    if user.get("authorized", False):
-        await update.message.reply_text("Вы уже авторизованы.", reply_markup=get_main_kb(user_id))
-        return ConversationHandler.END
-    await update.message.reply_text("Введите ваш пароль:", reply_markup=ReplyKeyboardRemove())
-    return ConversationStates.AUTH
+# Заголовок сжатого файла.
+def build_storage_header(codec, logical_size):
+    return STORAGE_MAGIC + STORAGE_CODEC_IDS[codec] + logical_size.to_bytes(8, "big")
 
-# Главное меню для авторизованных пользователей.
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await precheck_reply(update, context): return ConversationHandler.END
-    log_state(update, context, "main_menu")
-    user_id = update.effective_user.id
-    text = update.message.text
+# (алгоритм, исходный размер) из первых байт файла или None, если файл сжат не ботом.
+def parse_storage_header(head):
+    if len(head) < STORAGE_HEADER_SIZE or not head.startswith(STORAGE_MAGIC):
+        return None
+    codec_id = head[len(STORAGE_MAGIC):len(STORAGE_MAGIC) + 1]
+    codec = next((codec for codec, value in STORAGE_CODEC_IDS.items() if value == codec_id), None)
+    if codec is None:
+        return None
+    return codec, int.from_bytes(head[len(STORAGE_MAGIC) + 1:STORAGE_HEADER_SIZE], "big")
 
-    if not is_authorized(user_id):
-        await update.message.reply_text("Войдите через кнопку ниже.", reply_markup=get_guest_kb())
+def read_storage_header(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            return parse_storage_header(f.read(STORAGE_HEADER_SIZE))
+    except OSError:
+        return None
+
+# Сверяет сведения о сжатии с файлом на диске. Пока физический размер совпадает с записанным при сжатии,
+# метаданные верны; иначе файл заменили - сжатие определяется заново по заголовку.
+def sync_compression_meta(meta, file_path, physical_size):
+    if meta.get("compression") and meta.get("stored_size", meta.get("size")) in (None, physical_size):
+        meta["stored_size"] = physical_size
         return
+    for key in ("compression", "logical_size", "stored_size"):
+        meta.pop(key, None)
+    header = read_storage_header(file_path)
+    if header:
+        meta.update(compression=header[0], logical_size=header[1], stored_size=physical_size)
+
+# Сжимает файл потоково на месте; возвращает метаданные сжатия или None.
+def compress_stored_file(file_path):
+    codec = get_storage_codec()
+    if not codec or not is_compressible(file_path, codec):
+        return None
+    logical_size = os.path.getsize(file_path)
+    tmp_path = file_path + ".ztmp"
+    try:
+        with open(file_path, "rb") as src, open(tmp_path, "wb") as raw:
+            raw.write(build_storage_header(codec, logical_size))
+            if codec == "zstd":
+                with get_zstd().ZstdCompressor(level=3).stream_writer(raw, closefd=False) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            else:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+        physical_size = os.path.getsize(tmp_path)
+        if physical_size * COMPRESSION_MIN_RATIO > logical_size:
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, file_path)
+        return {"compression": codec, "logical_size": logical_size, "stored_size": physical_size}
+    except Exception as e:
+        log(f"Не удалось сжать файл {file_path}: {e}", level=logging.WARNING)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
 
-    if text == "➕ Создать папку":
-        user = get_user(user_id)
-        limit = user.get("folders_limit", 10)
-        folders_created = user.get("folders", 0)
-        if limit != 0 and folders_created >= limit:
-            await update.message.reply_text(
-                "Вы достигли лимита на создание папок. Удалите какую-то папку.",
+# GzipFile поверх открытого файла, который закрывает и сам файл.
+class ClosingGzipFile(gzip.GzipFile):
+    def __init__(self, raw):
+        super().__init__(fileobj=raw, mode="rb")
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+# Открывает файл для чтения с потоковой распаковкой, если он хранится сжатым.
+# Алгоритм берётся из заголовка файла; метаданным без заголовка верим, только если совпадает сигнатура формата.
+def open_stored_file(file_path, file_meta):
+    raw = open(file_path, "rb")
+    try:
+        head = raw.read(STORAGE_HEADER_SIZE)
+        header = parse_storage_header(head)
+        if header:
+            codec = header[0]
+            raw.seek(STORAGE_HEADER_SIZE)
+        else:
+            codec = file_meta.get("compression")
+            if codec and not head.startswith(STORAGE_CODEC_SIGNATURES.get(codec, b"-")):
+                codec = None
+            raw.seek(0)
+        if codec == "gzip":
+            return ClosingGzipFile(raw)
+        if codec == "zstd":
+            zstd = get_zstd()
+            if not zstd:
+                raise RuntimeError("Для чтения файла требуется пакет zstandard.")
+            return zstd.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return raw
+    except BaseException:
+        raw.close()
+        raise
+
+# Логический (исходный) размер файла.
+def get_logical_size(file_meta, physical_size=None):
+    if file_meta.get("compression") and "logical_size" in file_meta:
+        return file_meta["logical_size"]
+    return file_meta.get("size", 0) if physical_size is None else physical_size
+
+#################################
+######### ПРЕВЬЮ ФАЙЛОВ #########
+#################################
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumbs")
+thumbnail_pending = set()
+thumbnail_file_ids = {}  # имя файла превью -> file_id уже загруженного в Telegram фото
+
+# Проверяет, можно ли построить превью для файла.
+def is_thumbnail_supported(file_name):
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in IMAGE_EXTS or ext == ".gif":
+        return True
+    return ext in VIDEO_EXTS and FFMPEG_BIN is not None
+
+# Путь к превью в кэше: ключ — ID файла и время его изменения.
+def get_thumbnail_path(file_id, file_path, mtime=None):
+    mtime = int(os.stat(file_path).st_mtime if mtime is None else mtime)
+    return os.path.join(THUMBS_DIR, f"{file_id}_{mtime}.jpg")
+
+# Возвращает путь к готовому превью или None.
+def get_cached_thumbnail(file_id, file_path, mtime=None):
+    try:
+        thumb_path = get_thumbnail_path(file_id, file_path, mtime)
+    except OSError:
+        return None
+    return thumb_path if os.path.exists(thumb_path) else None
+
+# Строит превью изображения через Pillow.
+def render_image_thumbnail(file_path, thumb_path):
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    with Image.open(file_path) as img:
+        img.seek(0)
+        img = img.convert("RGB")
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        img.save(thumb_path, "JPEG", quality=80)
+    return True
+
+# Строит превью видео по кадру через ffmpeg.
+def render_video_thumbnail(file_path, thumb_path):
+    if not FFMPEG_BIN:
+        return False
+    for offset in ("1", "0"):
+        result = subprocess.run(
+            [FFMPEG_BIN, "-loglevel", "error", "-y", "-ss", offset, "-i", file_path,
+             "-frames:v", "1", "-vf", f"scale='min({THUMB_SIZE},iw)':-2", "-f", "mjpeg", thumb_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
+        )
+        if result.returncode == 0 and os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 0:
+            return True
+    return False
+
+# Генерирует превью в рабочем потоке и удаляет устаревшие версии этого файла.
+def generate_thumbnail(file_id, file_path):
+    try:
+        thumb_path = get_thumbnail_path(file_id, file_path)
+        if os.path.exists(thumb_path):
+            return thumb_path
+        os.makedirs(THUMBS_DIR, exist_ok=True)
+        tmp_path = thumb_path + ".tmp"
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in VIDEO_EXTS:
+            ok = render_video_thumbnail(file_path, tmp_path)
+        else:
+            ok = render_image_thumbnail(file_path, tmp_path)
+        if not ok:
+            return None
+        os.replace(tmp_path, thumb_path)
+        for name in os.listdir(THUMBS_DIR):
+            if name.startswith(f"{file_id}_") and os.path.join(THUMBS_DIR, name) != thumb_path:
+                os.remove(os.path.join(THUMBS_DIR, name))
+                thumbnail_file_ids.pop(name, None)
+        return thumb_path
+    except Exception as e:
+        log(f"Не удалось построить превью для {file_path}: {e}", level=logging.WARNING)
+        return None
+    finally:
+        thumbnail_pending.discard(file_id)
+
+# Ставит построение превью в очередь фонового пула (без повторов).
+def schedule_thumbnail(file_id, file_path):
+    if file_id in thumbnail_pending or not is_thumbnail_supported(file_path):
+        return
+    if get_cached_thumbnail(file_id, file_path):
+        return
+    thumbnail_pending.add(file_id)
+    thumbnail_executor.submit(generate_thumbnail, file_id, file_path)
+
+# Удаляет превью файла из кэша.
+def delete_thumbnails(file_id):
+    if not os.path.isdir(THUMBS_DIR):
+        return
+    for name in os.listdir(THUMBS_DIR):
+        if name.startswith(f"{file_id}_"):
+            os.remove(os.path.join(THUMBS_DIR, name))
+            thumbnail_file_ids.pop(name, None)
+
+###########################################
+######### ИСХОДЯЩИЕ ЗАПРОСЫ К API #########
+###########################################
+
+OUTBOUND_INTERACTIVE = "interactive"  # ответы на действия пользователя
+OUTBOUND_BULK = "bulk"  # уведомления и массовые отправки
+OUTBOUND_PRIORITIES = (OUTBOUND_INTERACTIVE, OUTBOUND_BULK)
+
+# Корзина токенов: не более rate запросов в секунду с запасом capacity.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько секунд ждать до появления свободного токена.
+    def delay(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+# Центральная очередь исходящих запросов: общий и по-чатовые лимиты, приоритеты, повторы.
+class OutboundRateLimiter(BaseRateLimiter):
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST, group_rate=OUTBOUND_GROUP_RATE, max_retries=OUTBOUND_MAX_RETRIES):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._max_retries = max_retries
+        self._chats = {}
+        self._paused_until = 0.0
+        self._queued = {p: 0 for p in OUTBOUND_PRIORITIES}
+        self._global_waiters = {p: 0 for p in OUTBOUND_PRIORITIES}
+        self._last_report = time.monotonic()
+        self._stats = {
+            "requests": {p: 0 for p in OUTBOUND_PRIORITIES},
+            "wait_total": {p: 0.0 for p in OUTBOUND_PRIORITIES},
+            "wait_max": {p: 0.0 for p in OUTBOUND_PRIORITIES},
+            "flood_waits": 0,
+            "retries": 0,
+            "errors": {},
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        log(f"Outbound API stats: {self.stats()}")
+        self._chats.clear()
+
+    # Возвращает корзину чата (для групп — более строгий лимит).
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_full()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self._group_rate, 1)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    # Ждёт своей очереди: пауза после flood-wait, лимит чата, затем общий лимит с учётом приоритета.
+    async def _acquire(self, chat_id, priority):
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        rank = OUTBOUND_PRIORITIES.index(priority)
+        while True:
+            delay = max(self._paused_until - time.monotonic(), bucket.delay() if bucket else 0.0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if any(self._global_waiters[p] for p in OUTBOUND_PRIORITIES[:rank]):
+                delay = 1 / self._global.rate
+            else:
+                delay = self._global.delay()
+            if delay <= 0:
+                self._global.take()
+                if bucket:
+                    bucket.take()
+                return
+            self._global_waiters[priority] += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._global_waiters[priority] -= 1
+
+    def _count_error(self, exc, endpoint):
+        name = type(exc).__name__
+        self._stats["errors"][name] = self._stats["errors"].get(name, 0) + 1
+        api_errors.inc(endpoint, name)
+
+    # Статистика очереди: глубина, время ожидания, повторы и ошибки.
+    def stats(self):
+        result = {
+            "queue_depth": dict(self._queued),
+            "requests": dict(self._stats["requests"]),
+            "wait_avg": {},
+            "wait_max": {p: round(v, 3) for p, v in self._stats["wait_max"].items()},
+            "flood_waits": self._stats["flood_waits"],
+            "retries": self._stats["retries"],
+            "errors": dict(self._stats["errors"]),
+        }
+        for p in OUTBOUND_PRIORITIES:
+            count = self._stats["requests"][p]
+            result["wait_avg"][p] = round(self._stats["wait_total"][p] / count, 3) if count else 0.0
+        return result
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_report >= OUTBOUND_STATS_INTERVAL:
+            self._last_report = now
+            log(f"Outbound API stats: {self.stats()}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in OUTBOUND_PRIORITIES else OUTBOUND_INTERACTIVE
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        self._queued[priority] += 1
+        started = time.monotonic()
+        try:
+            for attempt in range(self._max_retries + 1):
+                await self._acquire(chat_id, priority)
+                if attempt == 0:
+                    waited = time.monotonic() - started
+                    self._stats["requests"][priority] += 1
+                    self._stats["wait_total"][priority] += waited
+                    self._stats["wait_max"][priority] = max(self._stats["wait_max"][priority], waited)
+                try:
+                    return await callback(*args, **kwargs)
+                except telegram.error.RetryAfter as e:
+                    self._count_error(e, endpoint)
+                    self._stats["flood_waits"] += 1
+                    if attempt == self._max_retries:
+                        raise
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                    # Flood-wait действует на весь бот: приостанавливаем все исходящие запросы.
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+                    log(f"Flood control on {endpoint} (chat {chat_id}), retry in {retry_after}s", level=logging.WARNING)
+                except (telegram.error.BadRequest, telegram.error.Forbidden, telegram.error.TimedOut) as e:
+                    self._count_error(e, endpoint)
+                    raise
+                except telegram.error.NetworkError as e:
+                    self._count_error(e, endpoint)
+                    if attempt == self._max_retries:
+                        raise
+                    backoff = min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                    log(f"Network error on {endpoint}: {e}, retry in {backoff:.1f}s", level=logging.WARNING)
+                    await asyncio.sleep(backoff)
+                except telegram.error.TelegramError as e:
+                    self._count_error(e, endpoint)
+                    raise
+                self._stats["retries"] += 1
+        finally:
+            self._queued[priority] -= 1
+            self._maybe_report()
+
+outbound_limiter = OutboundRateLimiter()
+
+# Отправляет уведомление пользователю с низким приоритетом; ошибки пишутся в лог.
+async def send_notification(bot, chat_id, text, parse_mode="Markdown"):
+    try:
+        await bot.send_message(chat_id, text, parse_mode=parse_mode, rate_limit_args=OUTBOUND_BULK)
+        return True
+    except Exception as e:
+        log(f"Не удалось отправить уведомление пользователю {chat_id}: {e}", level=logging.WARNING)
+        return False
+
+#####################################################
+######### ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ #########
+#####################################################
+
+# Ключ очереди обновления - (чат, пользователь), как у ConversationHandler; None, если обновление ни к кому не относится.
+def update_order_key(update):
+    if not isinstance(update, Update):
+        return None
+    chat, user = update.effective_chat, update.effective_user
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+# Обновления разных чатов выполняются параллельно (не больше max_concurrent_updates сразу),
+# а обновления одного чата - по одному и в порядке поступления, поэтому состояние диалогов не путается.
+# Ожидающее своей очереди обновление не занимает слот: долгая загрузка одного пользователя не задерживает других.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, queue_limit=UPDATE_QUEUE_LIMIT):
+        super().__init__(max(queue_limit, max_concurrent_updates))
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._chats = {}  # ключ -> [Lock, сколько обновлений чата выполняется или ждёт]
+
+    async def do_process_update(self, update, coroutine):
+        key = update_order_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {"chats": len(self._chats), "queued": sum(entry[1] for entry in self._chats.values())}
+
+###############################################
+######### ПРОФИЛИРОВАНИЕ ОБРАБОТЧИКОВ #########
+###############################################
+
+# Подпись кадра для свёрнутого стека: функция (файл:строка начала); кэшируется по объекту кода.
+profile_frame_labels = {}
+
+def profile_frame_label(code):
+    label = profile_frame_labels.get(code)
+    if label is None:
+        label = profile_frame_labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+    return label
+
+# Стек кадра от корня к вершине в формате collapsed stacks (кадры через ';').
+def collapse_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(profile_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+# Сэмплирующий профилировщик потока цикла событий: фоновый поток раз в PROFILE_INTERVAL снимает стек,
+# в котором выполняются обработчики (корутины задач asyncio). Пока сбор не запущен, затрат нет.
+class SamplingProfiler:
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self.updates_left = None
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Запускает сбор на seconds секунд или до updates обработанных обновлений (что раньше) в потоке,
+    # из которого вызван; on_done(путь, число сэмплов) вызывается из потока профилировщика.
+    def start(self, seconds, updates=None, on_done=None):
+        if self.active:
+            return False
+        self._stop.clear()
+        self.updates_left = updates
+        target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, args=(target, seconds, on_done), name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    # Отмечает обработанное обновление (вызывается из обработчиков).
+    def note_update(self):
+        left = self.updates_left
+        if left is None:
+            return
+        self.updates_left = left - 1
+        if left <= 1:
+            self._stop.set()
+
+    def _run(self, target, seconds, on_done):
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while not self._stop.wait(PROFILE_INTERVAL) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                stacks[collapse_stack(frame)] += 1
+            del frame
+        self.updates_left = None
+        try:
+            path = write_profile(stacks)
+        except OSError as e:
+            log(f"Не удалось записать профиль: {e}", level=logging.ERROR)
+            return
+        log(f"Profile written: {path} ({sum(stacks.values())} samples)")
+        if on_done:
+            on_done(path, sum(stacks.values()))
+
+# Записывает свёрнутые стеки (формат flamegraph.pl / speedscope): "кадр;кадр;... число" в строке.
+def write_profile(stacks):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, datetime.datetime.now().strftime("profile_%Y%m%d_%H%M%S.collapsed"))
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+profiler = SamplingProfiler()
+
+# Разбирает аргумент /profile: "60" - секунды, "200u" - число обновлений; (секунды, обновления) или None.
+def parse_profile_args(args):
+    if not args:
+        return PROFILE_DEFAULT_SECONDS, None
+    value = args[0].lower()
+    try:
+        if value.endswith("u"):
+            return PROFILE_MAX_SECONDS, max(1, int(value[:-1]))
+        return min(PROFILE_MAX_SECONDS, max(1, int(value.rstrip("s")))), None
+    except ValueError:
+        return None
+
+# SIGUSR2: запускает профилирование на PROFILE_DEFAULT_SECONDS, повторный сигнал завершает его досрочно.
+def toggle_profiler_by_signal():
+    if profiler.active:
+        profiler.stop()
+    elif profiler.start(PROFILE_DEFAULT_SECONDS):
+        log(f"Profiling started by SIGUSR2 for {PROFILE_DEFAULT_SECONDS}s")
+
+#################################################
+######### СОХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ #########
+#################################################
+
+# Состояние ConversationHandler для базы: элементы ConversationStates хранятся по имени.
+def encode_conversation_state(state):
+    return state.name if isinstance(state, ConversationStates) else state
+
+def decode_conversation_state(state):
+    return ConversationStates[state] if isinstance(state, str) and state in ConversationStates.__members__ else state
+
+# Состояние диалогов и context.user_data в MongoDB (коллекции conversations и sessions).
+# PTB раз в update_interval секунд передаёт только изменившиеся данные; неизменённые отбрасываются,
+# остальное записывается одним bulk_write в фоне. user_data читается лениво - при первом обновлении
+# от пользователя после запуска, поэтому старт не зависит от числа сохранённых сессий.
+class MongoPersistence(BasePersistence):
+    def __init__(self, update_interval=SESSION_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded_users = set()
+        self._written = {}  # user_id -> BSON последних записанных данных
+        self._pending_users = {}  # user_id -> BSON данных или None (удалить)
+        self._pending_conversations = {}  # (имя, ключ) -> состояние или None (удалить)
+        self._released = set()  # выгружены из памяти по простою: копию в базе не удалять
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        try:
+            docs = await asyncio.to_thread(lambda: list(conversations_collection.find({"name": name})))
+        except Exception as e:
+            # Без базы бот всё равно запускается: диалоги начнутся заново, новые состояния сохранятся позже.
+            log(f"Состояния диалога {name} не загружены: {e}", level=logging.WARNING)
+            return {}
+        return {tuple(doc["key"]): decode_conversation_state(doc["state"]) for doc in docs}
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, tuple(key))] = encode_conversation_state(new_state)
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        try:
+            encoded = bson.encode(data)
+        except Exception as e:
+            log(f"user_data пользователя {user_id} не сохранён: {e}")
+            return
+        if user_id not in self._pending_users and self._written.get(user_id) == encoded:
+            return
+        self._pending_users[user_id] = encoded
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._released:
+            self._released.discard(user_id)
+            return
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        doc = await asyncio.to_thread(sessions_collection.find_one, {"_id": user_id})
+        if doc and doc.get("data"):
+            for key, value in doc["data"].items():
+                user_data.setdefault(key, value)
+            self._written[user_id] = bson.encode(doc["data"])
+
+    # Пользователи выгружены из памяти (их данные уже записаны): при следующем обновлении user_data
+    # прочитается из базы заново, а срок хранения в базе отсчитывается от выгрузки.
+    # Отметки ставятся до первого await - вызывать сразу после Application.drop_user_data.
+    async def release_users(self, user_ids):
+        for user_id in user_ids:
+            self._loaded_users.discard(user_id)
+            self._written.pop(user_id, None)
+            self._released.add(user_id)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            await asyncio.to_thread(sessions_collection.update_many, {"_id": {"$in": list(user_ids)}}, {"$set": {"updated_at": now}})
+        except Exception as e:
+            log(f"Срок хранения сессий не продлён: {e}", level=logging.WARNING)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        if self._flush_task:
+            await self._flush_task
+        await self._write()
+
+    def _schedule_write(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        # PTB вызывает update_* одного прохода через gather - даём им всем отработать и пишем одним запросом.
+        await asyncio.sleep(0)
+        await self._write()
+
+    async def _write(self):
+        async with self._write_lock:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            if not users and not conversations:
+                return
+            now = datetime.datetime.now(datetime.timezone.utc)
+            user_ops = [
+                DeleteOne({"_id": user_id}) if encoded is None
+                else UpdateOne({"_id": user_id}, {"$set": {"data": bson.decode(encoded), "updated_at": now}}, upsert=True)
+                for user_id, encoded in users.items()
+            ]
+            conversation_ops = []
+            for (name, key), state in conversations.items():
+                conversation_id = ":".join([name] + [str(part) for part in key])
+                if state is None:
+                    conversation_ops.append(DeleteOne({"_id": conversation_id}))
+                else:
+                    conversation_ops.append(UpdateOne(
+                        {"_id": conversation_id},
+                        {"$set": {"name": name, "key": list(key), "state": state, "updated_at": now}},
+                        upsert=True
+                    ))
+            try:
+                await asyncio.to_thread(self._bulk_write, user_ops, conversation_ops)
+            except Exception as e:
+                log(f"Ошибка сохранения сессий: {e}", level=logging.ERROR)
+                # Вернём несохранённое в очередь: более новые данные, пришедшие за это время, важнее.
+                for user_id, encoded in users.items():
+                    self._pending_users.setdefault(user_id, encoded)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                return
+            for user_id, encoded in users.items():
+                if encoded is None:
+                    self._written.pop(user_id, None)
+                elif user_id in self._loaded_users:
+                    self._written[user_id] = encoded
+
+    @staticmethod
+    def _bulk_write(user_ops, conversation_ops):
+        if user_ops:
+            sessions_collection.bulk_write(user_ops, ordered=False)
+        if conversation_ops:
+            conversations_collection.bulk_write(conversation_ops, ordered=False)
+
+########################################
+######### СЕССИИ ПОЛЬЗОВАТЕЛЕЙ #########
+########################################
+
+# Оценка размера user_data в байтах (по BSON; что не кодируется - по repr).
+def session_size(data):
+    try:
+        return len(bson.encode(data))
+    except Exception:
+        return len(repr(data))
+
+# Последняя активность пользователей и выгрузка user_data тех, кто простаивает дольше SESSION_IDLE_TTL.
+# С сохранением в MongoDB выгружается только копия в памяти: данные записываются в базу и читаются
+# обратно при следующем обновлении. Без сохранения данные брошенных диалогов удаляются, а пользователь
+# попадает в expired: его следующее обновление в состоянии диалога завершает диалог (conversation_session_guard).
+class SessionStore:
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, interval=SESSION_SWEEP_INTERVAL):
+        self.idle_ttl = idle_ttl
+        self.interval = interval
+        self.last_seen = {}  # user_id -> time.monotonic() последнего обновления
+        self.evicted = 0
+        self.expired = set()  # выгруженные без сохранения: их диалоги остались в прежнем состоянии без user_data
+        self.stats = {"bytes": 0, "max_bytes": 0}
+        self.task = None
+
+    def touch(self, user_id):
+        self.last_seen[user_id] = time.monotonic()
+
+    # True (один раз), если user_data пользователя выгружены без сохранения после его последнего диалога.
+    def expire(self, user_id):
+        if user_id in self.expired:
+            self.expired.discard(user_id)
+            return True
+        return False
+
+    def start(self, app):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(app))
+
+    async def _run(self, app):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep(app)
+            except Exception as e:
+                log(f"Ошибка проверки сессий: {e}", level=logging.ERROR)
+
+    # Один проход: пересчитывает размеры и выгружает простаивающих; возвращает число выгруженных.
+    async def sweep(self, app):
+        now = time.monotonic()
+        idle = {}
+        total = largest = 0
+        for user_id, data in list(app.user_data.items()):
+            seen = self.last_seen.setdefault(user_id, now)
+            if self.idle_ttl and now - seen > self.idle_ttl:
+                idle[user_id] = seen
+                continue
+            size = session_size(data)
+            total += size
+            largest = max(largest, size)
+        for user_id in [user_id for user_id in self.last_seen if user_id not in app.user_data]:
+            del self.last_seen[user_id]
+        self.stats = {"bytes": total, "max_bytes": largest}
+        if not idle:
+            return 0
+
+        persistence = app.persistence
+        if persistence is not None:
+            for user_id in idle:
+                await persistence.update_user_data(user_id, app.user_data[user_id])
+            await persistence.flush()
+        # Пока шла запись, пользователь мог вернуться - его не трогаем.
+        idle = [user_id for user_id, seen in idle.items() if self.last_seen.get(user_id) == seen]
+        if not idle:
+            return 0
+        for user_id in idle:
+            app.drop_user_data(user_id)
+            self.last_seen.pop(user_id, None)
+        if persistence is None:
+            self.expired.update(idle)
+        else:
+            await persistence.release_users(idle)
+            # Сразу передаём PTB-удаление в хранилище (копия в базе остаётся), чтобы оно не съело
+            # изменения пользователя, вернувшегося до следующего периодического сохранения.
+            await app.update_persistence()
+        self.evicted += len(idle)
+        log(f"Sessions: evicted {len(idle)} idle, {len(app.user_data)} in memory (~{total // 1024} KB)")
+        return len(idle)
+
+session_store = SessionStore()
+
+MetricCollector("bot_sessions", "Пользователи с user_data в памяти.", (), lambda: {(): len(bot_application.user_data) if bot_application else 0})
+MetricCollector("bot_session_bytes", "Оценка объёма user_data в памяти на последней проверке: total - всего, max - самая большая сессия.", ("kind",),
+                lambda: {("total",): session_store.stats["bytes"], ("max",): session_store.stats["max_bytes"]})
+MetricCollector("bot_session_evictions_total", "Сессии, выгруженные из памяти по простою.", (), lambda: {(): session_store.evicted}, kind="counter")
+
+#####################################
+######### МАССОВАЯ РАССЫЛКА #########
+#####################################
+
+BROADCAST_SEGMENTS = {
+    "all": ("👥 Всем", {"status": {"$ne": "banned"}}),
+    "default": ("👶 Пользователям", {"status": {"$nin": ["admin", "banned"]}}),
+    "admin": ("👑 Администраторам", {"status": "admin"}),
+    "banned": ("🚫 Заблокированным", {"status": "banned"}),
+}
+
+broadcast_tasks = {}
+
+# Клавиатура выбора получателей рассылки.
+def build_broadcast_segment_keyboard():
+    buttons = [[InlineKeyboardButton(caption, callback_data=f"broadcast_segment:{segment}")] for segment, (caption, _) in BROADCAST_SEGMENTS.items()]
+    buttons.append([InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data="user_list")])
+    return InlineKeyboardMarkup(buttons)
+
+# Клавиатура подтверждения запуска рассылки.
+def build_broadcast_confirm_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Начать рассылку", callback_data="broadcast_start"),
+         InlineKeyboardButton("🔙 Отмена", callback_data="broadcast_cancel")]
+    ])
+
+# Фильтр пользователей для рассылки (без самого администратора).
+def get_broadcast_filter(segment, admin_id):
+    query = dict(BROADCAST_SEGMENTS[segment][1])
+    query["id"] = {"$ne": admin_id}
+    return query
+
+# Считает получателей рассылки.
+def count_broadcast_recipients(segment, admin_id):
+    return users_collection.count_documents(get_broadcast_filter(segment, admin_id))
+
+# Создаёт задание рассылки в базе.
+def create_broadcast(admin_id, segment, text, chat_id, message_id):
+    broadcast = {
+        "id": str(uuid.uuid4()),
+        "admin_id": admin_id,
+        "segment": segment,
+        "text": text,
+        "status": "running",
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "last_user_oid": None,
+        "total": count_broadcast_recipients(segment, admin_id),
+        "sent": 0,
+        "failed": 0,
+        "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    broadcasts_collection.insert_one(broadcast)
+    return broadcast
+
+# Получает следующую порцию получателей после last_oid (курсор по _id).
+def fetch_broadcast_batch(broadcast):
+    query = get_broadcast_filter(broadcast["segment"], broadcast["admin_id"])
+    if broadcast.get("last_user_oid") is not None:
+        query["_id"] = {"$gt": broadcast["last_user_oid"]}
+    cursor = users_collection.find(query, {"_id": 1, "id": 1}).sort("_id", 1).limit(BROADCAST_BATCH_SIZE)
+    return list(cursor)
+
+# Сохраняет прогресс после части порции; возвращает False, если рассылку остановили.
+# Счётчики пишутся и после остановки: сообщения части, отправленной до неё, уже доставлены.
+def save_broadcast_progress(broadcast, last_oid, sent, failed):
+    stored = broadcasts_collection.find_one_and_update(
+        {"id": broadcast["id"]},
+        {"$set": {"last_user_oid": last_oid}, "$inc": {"sent": sent, "failed": failed}},
+        projection={"status": 1}
+    )
+    broadcast["last_user_oid"] = last_oid
+    broadcast["sent"] += sent
+    broadcast["failed"] += failed
+    return bool(stored) and stored["status"] == "running"
+
+# Отмечает рассылку завершённой, если её не остановили.
+def finish_broadcast(broadcast_id):
+    broadcasts_collection.update_one({"id": broadcast_id, "status": "running"}, {"$set": {"status": "done"}})
+
+# Текущий статус рассылки в базе или None.
+def get_broadcast_status(broadcast_id):
+    stored = broadcasts_collection.find_one({"id": broadcast_id}, {"status": 1})
+    return stored["status"] if stored else None
+
+# Останавливает рассылку.
+def stop_broadcast(broadcast_id):
+    result = broadcasts_collection.update_one({"id": broadcast_id, "status": "running"}, {"$set": {"status": "stopped"}})
+    return result.matched_count > 0
+
+# Текст с прогрессом рассылки.
+def build_broadcast_progress_text(broadcast):
+    titles = {"running": "⏳ Рассылка идёт", "done": "✅ Рассылка завершена", "stopped": "⏹ Рассылка остановлена"}
+    done = broadcast["sent"] + broadcast["failed"]
+    return (
+        f"*📢 {titles.get(broadcast['status'], 'Рассылка')}*\n\n"
+        f"```Информация\n"
+        f"👥 Получатели: {BROADCAST_SEGMENTS[broadcast['segment']][0]}\n"
+        f"📨 Обработано: {done} из {broadcast['total']}\n"
+        f"✅ Доставлено: {broadcast['sent']}\n"
+        f"❌ Ошибок: {broadcast['failed']}```"
+    )
+
+# Обновляет сообщение с прогрессом рассылки у администратора.
+async def update_broadcast_progress(bot, broadcast):
+    keyboard = None
+    if broadcast["status"] == "running":
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить", callback_data=f"broadcast_stop:{broadcast['id']}")]])
+    text = build_broadcast_progress_text(broadcast)
+    try:
+        await apply_message_edit(
+            (broadcast["chat_id"], broadcast["message_id"]),
+            ("text", text, "Markdown", markup_fingerprint(keyboard)),
+            lambda: bot.edit_message_text(text, chat_id=broadcast["chat_id"], message_id=broadcast["message_id"], parse_mode="Markdown", reply_markup=keyboard, rate_limit_args=OUTBOUND_BULK)
+        )
+    except Exception as e:
+        log(f"Не удалось обновить прогресс рассылки {broadcast['id']}: {e}", level=logging.WARNING)
+
+# Отправляет сообщение рассылки одному пользователю.
+async def send_broadcast_message(bot, semaphore, user_id, text):
+    async with semaphore:
+        try:
+            await bot.send_message(user_id, text, parse_mode="Markdown", rate_limit_args=OUTBOUND_BULK)
+            return True
+        except Exception:
+            return False
+
+# Выполняет рассылку порциями; прогресс сохраняется каждые BROADCAST_CHUNK_SIZE отправок, поэтому её можно
+# продолжить после перезапуска. Доставка "хотя бы раз": сообщения части, прерванной перезапуском, уйдут повторно.
+async def run_broadcast(bot, broadcast):
+    text = f"*🔔 Уведомление*\n\nАдминистратор отправил сообщение.\n_Сообщение: {escape_md(broadcast['text'])}_"
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = 0.0
+    log(f"Рассылка {broadcast['id']} запущена: {broadcast['sent'] + broadcast['failed']} из {broadcast['total']}")
+    try:
+        while True:
+            batch = await asyncio.to_thread(fetch_broadcast_batch, broadcast)
+            if not batch:
+                await asyncio.to_thread(finish_broadcast, broadcast["id"])
+                break
+            running = True
+            for start in range(0, len(batch), BROADCAST_CHUNK_SIZE):
+                chunk = batch[start:start + BROADCAST_CHUNK_SIZE]
+                results = await asyncio.gather(*(send_broadcast_message(bot, semaphore, u["id"], text) for u in chunk))
+                sent = sum(1 for r in results if r)
+                running = await asyncio.to_thread(save_broadcast_progress, broadcast, chunk[-1]["_id"], sent, len(results) - sent)
+                if not running:
+                    break
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await update_broadcast_progress(bot, broadcast)
+            if not running:
+                break
+    except Exception as e:
+        log(f"Ошибка рассылки {broadcast['id']}: {e}\n{traceback.format_exc()}", level=logging.ERROR)
+    finally:
+        broadcast_tasks.pop(broadcast["id"], None)
+    status = await asyncio.to_thread(get_broadcast_status, broadcast["id"])
+    if status:
+        broadcast["status"] = status
+    log(f"Рассылка {broadcast['id']} ({broadcast['status']}): доставлено {broadcast['sent']}, ошибок {broadcast['failed']}")
+    await update_broadcast_progress(bot, broadcast)
+
+# Запускает рассылку в фоне.
+def start_broadcast_task(bot, broadcast):
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    broadcast_tasks[broadcast["id"]] = task
+    return task
+
+# Продолжает незавершённые рассылки после перезапуска бота.
+def resume_broadcasts(bot):
+    for broadcast in broadcasts_collection.find({"status": "running"}):
+        if broadcast["id"] not in broadcast_tasks:
+            start_broadcast_task(bot, broadcast)
+
+############################################
+######### РЕДАКТИРОВАНИЕ СООБЩЕНИЙ #########
+############################################
+
+# Последнее содержимое сообщений: (chat_id, message_id) -> состояние правки, в порядке LRU.
+message_edits = OrderedDict()
+message_edit_stats = {"sent": 0, "skipped": 0, "coalesced": 0, "not_modified": 0}
+
+# Отпечаток клавиатуры для сравнения содержимого.
+def markup_fingerprint(reply_markup):
+    return reply_markup.to_json() if reply_markup is not None else None
+
+# Применяет правку сообщения: одинаковые пропускает, правки во время выполнения другой сводит к последней.
+async def apply_message_edit(key, content, send):
+    state = message_edits.get(key)
+    if state is None:
+        state = message_edits[key] = {"content": None, "pending": None, "busy": False}
+        if len(message_edits) > MESSAGE_EDIT_CACHE_SIZE:
+            message_edits.popitem(last=False)
+    else:
+        message_edits.move_to_end(key)
+
+    if state["busy"]:
+        if state["pending"] is not None:
+            message_edit_stats["coalesced"] += 1
+        state["pending"] = (content, send)
+        return
+    if content == state["content"]:
+        message_edit_stats["skipped"] += 1
+        return
+
+    state["busy"] = True
+    try:
+        while True:
+            try:
+                await send()
+                message_edit_stats["sent"] += 1
+            except telegram.error.BadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+                message_edit_stats["not_modified"] += 1
+            state["content"] = content
+            if state["pending"] is None:
+                break
+            content, send = state["pending"]
+            state["pending"] = None
+            if content == state["content"]:
+                message_edit_stats["skipped"] += 1
+                break
+    except BaseException:
+        # Любая ошибка (BadRequest, NetworkError, TimedOut, отмена): содержимое сообщения неизвестно,
+        # а отложенная правка устарела - иначе следующий вызов повторит её поверх более новой.
+        state["content"] = None
+        state["pending"] = None
+        raise
+    finally:
+        state["busy"] = False
+
+# Редактирует текст сообщения с Inline-кнопкой через общий слой правок.
+async def edit_message_text(query, text, parse_mode=None, reply_markup=None):
+    if query.message is None:
+        return await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    key = (query.message.chat_id, query.message.message_id)
+    content = ("text", text, parse_mode, markup_fingerprint(reply_markup))
+    await apply_message_edit(key, content, lambda: query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup))
+
+# Редактирует только клавиатуру сообщения через общий слой правок.
+async def edit_message_reply_markup(query, reply_markup=None):
+    if query.message is None:
+        return await query.edit_message_reply_markup(reply_markup=reply_markup)
+    key = (query.message.chat_id, query.message.message_id)
+    content = ("markup", markup_fingerprint(reply_markup))
+    await apply_message_edit(key, content, lambda: query.edit_message_reply_markup(reply_markup=reply_markup))
+
+########################################
+######### МАРШРУТИЗАЦИЯ КНОПОК #########
+########################################
+
+# Маршрутизатор Inline-кнопок: префикс callback_data -> обработчик, с метриками по маршрутам.
+class CallbackRouter:
+    def __init__(self, name):
+        self.name = name
+        self._routes = {}
+        self._metrics = {}
+        self._last_report = time.monotonic()
+
+    # Регистрирует обработчик для префиксов; args - конвертеры аргументов после префикса.
+    def route(self, *prefixes, args=(), required=None):
+        required = len(args) if required is None else required
+        def decorator(handler):
+            for prefix in prefixes:
+                self._routes[prefix] = (handler, args, required)
+                self._metrics[prefix] = {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            return handler
+        return decorator
+
+    # Разбирает callback_data один раз: (префикс, обработчик, аргументы) или None.
+    def resolve(self, data):
+        prefix, _, rest = (data or "").partition(":")
+        route = self._routes.get(prefix)
+        if route is None:
+            return None
+        handler, converters, required = route
+        parts = rest.split(":") if rest else []
+        if not required <= len(parts) <= len(converters):
+            return None
+        try:
+            values = [convert(value) for convert, value in zip(converters, parts)]
+        except ValueError:
+            return None
+        values += [None] * (len(converters) - len(values))
+        return prefix, handler, values
+
+    async def dispatch(self, update, context):
+        data = update.callback_query.data
+        resolved = self.resolve(data)
+        if resolved is None:
+            log(f"{self.name}: нет маршрута для {data!r}")
+            return None
+        prefix, handler, values = resolved
+        metrics = self._metrics[prefix]
+        started = time.perf_counter()
+        try:
+            return await handler(update, context, *values)
+        except Exception:
+            metrics["errors"] += 1
+            route_errors.inc(self.name, prefix)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics["calls"] += 1
+            metrics["total"] += elapsed
+            metrics["max"] = max(metrics["max"], elapsed)
+            route_seconds.observe(elapsed, self.name, prefix)
+            self._maybe_report()
+
+    def stats(self):
+        return {
+            prefix: {
+                "calls": m["calls"],
+                "errors": m["errors"],
+                "avg_ms": round(m["total"] / m["calls"] * 1000, 2) if m["calls"] else 0.0,
+                "max_ms": round(m["max"] * 1000, 2),
+            }
+            for prefix, m in self._metrics.items() if m["calls"]
+        }
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_report >= CALLBACK_STATS_INTERVAL:
+            self._last_report = now
+            log(f"Callback stats ({self.name}): {self.stats()}")
+
+folder_router = CallbackRouter("folders")
+user_admin_router = CallbackRouter("users")
+
+###############################
+######### ОБРАБОТЧИКИ #########
+###############################
+
+#Проверяет доступ пользователя для Inline-обработчиков.
+async def precheck_inline(update, context):
+    user_id = update.effective_user.id if update and update.effective_user else None
+    if not is_in_database(user_id) or is_banned(user_id):
+        await update.callback_query.answer("Нет доступа.", show_alert=True)
+        return True
+    return False
+
+# Проверяет доступ пользователя для Reply-обработчиков.
+async def precheck_reply(update, context):
+    user_id = update.effective_user.id if update and update.effective_user else None
+    if not is_in_database(user_id):
+        await update.message.reply_text("Войдите через кнопку ниже.", reply_markup=get_guest_kb())
+        return True
+    if is_banned(user_id):
+        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
+        return True
+    return False
+
+# Приветственное сообщение, /start бота
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_state(update, context, "start")
+    photo_path = os.path.join(BASE_DIR, "start.jpg")
+    caption = (
+        "*👋 Добро пожаловать!*\n\n"
+        "🗄 *Приватный файловый менеджер*\n\n"
+        "*1️⃣ Возможности:*\n"
+        "✈️ Отправка файлов на сервер\n"
+        "📑 Загрузка любых типов файлов\n"
+        "✏️ Настройка файлов внутри бота\n"
+        "🔒 Ограничение доступка к папкам\n"
+        "📝 Система логирования\n"
+        "⚙️ Умное управление пользователями\n"
+        "🦾 Хранение данных в MongoDB\n"
+        "🤖 Доступно Local Bot API\n\n"
+        "*2️⃣ Принципы работы:*\n"
+        "⚡ Все действия — простые и быстрые\n"
+        "🛡 Безопасность ваших данных\n"
+        "✅ Только авторизованные пользователи\n\n"
+        "*3️⃣ Ссылки:*\n"
+        "💭 Автор проекта: [ibuzy](https://t.me/ibuzy)\n"
+        "🔗 GitHub репозиторий: [Kol-Dayn](https://github.com/Kol-Dayn/Database)\n\n"
+        "`Этот проект распространяется на условиях лицензии Apache-2.0 license.`\n\n"
+        "*➡️ Для входа — воспользуйтесь кнопкой в меню*"
+    )
+    if os.path.exists(photo_path):
+        with open(photo_path, "rb") as photo_file:
+            await update.message.reply_photo(photo=photo_file,caption=caption,parse_mode="Markdown",reply_markup=get_guest_kb())
+    else:
+        await update.message.reply_text(caption, parse_mode="Markdown", reply_markup=get_guest_kb())
+
+# Обработка авторизации пользователя.
+async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_state(update, context, "auth")
+    user_id = update.effective_user.id
+    if not is_in_database(user_id):
+        await update.message.reply_text("❓ Вас нет в базе данных пользователей. Доступ ограничен.", reply_markup=get_guest_kb())
+        return ConversationHandler.END
+    if is_banned(user_id):
+        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
+        return ConversationHandler.END
+    password = update.message.text
+    if check_password(user_id, password):
+        set_authorized(user_id, True)
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        await update.message.reply_text("*✅ Успешный вход!*\n\n_Сообщение с вашим паролем было удалено для повышения безопасности._",parse_mode="Markdown", reply_markup=get_main_kb(user_id))
+        return ConversationHandler.END
+    set_authorized(user_id, False)
+    await update.message.reply_text("*❌ Неверный пароль.* Попробуйте снова.",parse_mode="Markdown", reply_markup=get_guest_kb())
+    return ConversationHandler.END
+
+# Меню для неавторизованных пользователей.
+async def guest_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_state(update, context, "guest_menu")
+    user_id = update.effective_user.id
+    if not is_in_database(user_id):
+        await update.message.reply_text("❓ Вас нет в базе данных пользователей. Доступ ограничен.", reply_markup=get_guest_kb())
+        return ConversationHandler.END
+    if is_banned(user_id):
+        await update.message.reply_text("🚫 Функционал бота недоступен из-за блокировки.", reply_markup=get_guest_kb())
+        return ConversationHandler.END
+    user = get_user(user_id)
+    if user.get("authorized", False):
+        await update.message.reply_text("Вы уже авторизованы.", reply_markup=get_main_kb(user_id))
+        return ConversationHandler.END
+    await update.message.reply_text("Введите ваш пароль:", reply_markup=ReplyKeyboardRemove())
+    return ConversationStates.AUTH
+
+# Главное меню для авторизованных пользователей.
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_reply(update, context): return ConversationHandler.END
+    log_state(update, context, "main_menu")
+    user_id = update.effective_user.id
+    text = update.message.text
+
+    if not is_authorized(user_id):
+        await update.message.reply_text("Войдите через кнопку ниже.", reply_markup=get_guest_kb())
+        return
+
+    if text == "➕ Создать папку":
+        user = get_user(user_id)
+        limit = user.get("folders_limit", 10)
+        folders_created = user.get("folders", 0)
+        if limit != 0 and folders_created >= limit:
+            await update.message.reply_text(
+                "Вы достигли лимита на создание папок. Удалите какую-то папку.",
                 reply_markup=get_main_kb(user_id)
             )
             return ConversationHandler.END
@@ -1116,23 +3633,8 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationStates.FOLDER_NAME
 
     elif text == "🗂 Список папок":
-        sync_folders_with_filesystem()
-        cleanup_nonexistent_folders()
-        folders = get_folders_for_list()
-        page = 0
-        total_pages = max(1, (len(folders) + FOLDERS_PER_PAGE - 1) // FOLDERS_PER_PAGE)
-        page_folders = folders[page * FOLDERS_PER_PAGE : (page + 1) * FOLDERS_PER_PAGE]
-        num_folders, total_files, total_size, users_count = get_database_stats()
-        stats_message = (
-            f"*🗂 Список всех доступных папок в БД*\n\n"
-            f"```Информация\n"
-            f"📂 Папок: {num_folders}\n"
-            f"📄 Всего файлов: {total_files}\n"
-            f"🗄 Общий вес базы: {total_size}\n"
-            f"👤 Пользователей: {users_count}```\n\n"
-            "*🔎 Выберите папку:*"
-        )
-        await update.message.reply_text(stats_message,parse_mode="Markdown",reply_markup=build_folders_keyboard(page, total_pages, page_folders))
+        stats_message, keyboard = render_folders_page(0)
+        await update.message.reply_text(stats_message,parse_mode="Markdown",reply_markup=keyboard)
         return ConversationStates.CHOOSING_FOLDER
 
     elif text == "⚙️ Управление пользователями":
@@ -1146,6 +3648,9 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(build_my_account_text(user),parse_mode="Markdown",reply_markup=build_my_account_keyboard(user))
         return ConversationHandler.END
 
+    elif text == "🔎 Поиск файлов":
+        return await ask_search_query(update)
+
 # Создание новой папки.
 async def create_folder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await precheck_reply(update, context): return ConversationHandler.END
@@ -1180,344 +3685,255 @@ async def create_folder(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def folder_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await precheck_inline(update, context): return
     log_state(update, context, "folder_button_callback")
-    query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
+    return await folder_router.dispatch(update, context)
 
-    def check_folder_exists_or_back_by_id(folder_id, page, action_text=None):
-        if not folder_exists_by_id(folder_id):
-            msg = action_text if action_text else f"Папка не найдена."
-            return {
-                "reply": (msg, InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ]))
-            }
-        return None
+# Сообщение «Папка не найдена» с возвратом к списку папок.
+async def reply_folder_not_found(query, page, text="Папка не найдена."):
+    await edit_message_text(
+        query,
+        text,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
+        ])
+    )
 
-    if data == "no_folders_info":
-        await query.answer("В базе нет папок.", show_alert=True)
-        return ConversationStates.CHOOSING_FOLDER
+# Сообщение «Файл не найден» с возвратом к списку файлов.
+async def reply_file_not_found(query, page, text="Файл не найден."):
+    await edit_message_text(
+        query,
+        text,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]])
+    )
 
-    if data.startswith("folders_page:"):
-        page = int(data.split(":")[1])
-        sync_folders_with_filesystem()
-        cleanup_nonexistent_folders()
-        folders = get_folders_for_list()
-        total_pages = max(1, (len(folders) + FOLDERS_PER_PAGE - 1) // FOLDERS_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        page_folders = folders[page * FOLDERS_PER_PAGE : (page + 1) * FOLDERS_PER_PAGE]
-        num_folders, total_files, total_size, users_count = get_database_stats()
-        stats_message = (
-            f"*🗂 Список всех доступных папок в БД*\n\n"
-            f"```Информация\n"
-            f"📂 Папок: {num_folders}\n"
-            f"📄 Всего файлов: {total_files}\n"
-            f"🗄 Общий вес базы: {total_size}\n"
-            f"👤 Пользователей: {users_count}```\n\n"
-            "*🔎 Выберите папку:*"
-        )
-        await query.edit_message_text(stats_message,parse_mode="Markdown",reply_markup=build_folders_keyboard(page, total_pages, page_folders))
-        return ConversationStates.CHOOSING_FOLDER
+# Проверяет заморозку и приватность папки; при отказе показывает уведомление и возвращает True.
+async def deny_folder_access(query, user_id, snapshot, admin):
+    reason = snapshot.access_denied_reason(user_id, admin) if snapshot else None
+    if reason:
+        await query.answer(reason, show_alert=True)
+        return True
+    return False
 
-    if data.startswith("folder_select:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.CHOOSING_FOLDER
+# Проверяет право пользователя (addition/rename/delete/download); при отказе показывает уведомление и возвращает True.
+async def deny_user_permission(query, user, permission):
+    if not user or not user.get(permission, True):
+        await query.answer("Нет доступа.", show_alert=True)
+        return True
+    return False
 
-    if data.startswith("folder_file_list:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        context.user_data["current_folder_id"] = folder_id
-        folder = get_folder_by_id(folder_id)
-        folder = sync_files_in_folder(folder)
-        files = sorted(folder["files"], key=lambda f: f["name"])
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        files = folder["files"]
-        files = sorted(files, key=lambda f: f["name"])
-        total_pages = max(1, (len(files) + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        page_files = files[page * FILES_PER_PAGE : (page + 1) * FILES_PER_PAGE]
-        text = f"*📄 Список файлов в папке*"
-        await query.edit_message_text(
-            text, parse_mode="Markdown",
-            reply_markup=build_files_keyboard(folder_id, page, total_pages, page_files)
-        )
-        return ConversationStates.FILES_MENU
+# Проверяет, что пользователь есть в базе и не заблокирован; при отказе показывает уведомление и возвращает True.
+async def deny_non_member(query, user):
+    if not user or user.get("status") == "banned":
+        await query.answer("Нет доступа.", show_alert=True)
+        return True
+    return False
 
-    if data.startswith("files_page:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        folder = sync_files_in_folder(folder)
-        files = sorted(folder["files"], key=lambda f: f["name"])
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.FILES_MENU
-        files = sorted(folder["files"], key=lambda f: f["name"])
-        total_pages = max(1, (len(files) + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        page_files = files[page * FILES_PER_PAGE : (page + 1) * FILES_PER_PAGE]
-        text = f"*📄 Список файлов в папке*"
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=build_files_keyboard(folder_id, page, total_pages, page_files))
-        return ConversationStates.FILES_MENU
+# Показывает страницу со списком файлов папки; files - уже отсортированный список.
+async def show_files_page(query, folder_id, files, page, sort):
+    total_pages = max(1, (len(files) + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
+    page = max(0, min(page, total_pages - 1))
+    page_files = files[page * FILES_PER_PAGE : (page + 1) * FILES_PER_PAGE]
+    text = f"*📄 Список файлов в папке*"
+    await edit_message_text(query, text, parse_mode="Markdown", reply_markup=build_files_keyboard(folder_id, page, total_pages, page_files, sort))
+
+# Текущий режим сортировки файлов пользователя.
+def get_files_sort(context):
+    sort = context.user_data.get("files_sort", "name")
+    return sort if sort in FILE_SORT_MODES else "name"
+
+# Показывает карточку папки.
+async def show_folder_card(query, snapshot, page, user_id, admin=None):
+    text, keyboard = build_folder_manage_keyboard(snapshot.id, page, user_id, snapshot=snapshot, admin=admin)
+    await edit_message_text(query, text, parse_mode="Markdown", reply_markup=keyboard)
+
+@folder_router.route("no_folders_info")
+async def folder_no_folders_info(update, context):
+    await update.callback_query.answer("В базе нет папок.", show_alert=True)
+    return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("no_files_info:"):
-        _, folder_id, page = data.split(":")
-        await query.answer("В этой папке нет файлов.", show_alert=True)
-        return ConversationStates.FILES_MENU
+@folder_router.route("folders_page", args=(int,))
+async def folder_list_page(update, context, page):
+    query = update.callback_query
+    stats_message, keyboard = render_folders_page(page)
+    await edit_message_text(query, stats_message,parse_mode="Markdown",reply_markup=keyboard)
+    return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("back_to_folder:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
+@folder_router.route("folder_select", "back_to_folder", "folder_delete_cancel", args=(str, int))
+async def folder_open(update, context, folder_id, page):
+    query = update.callback_query
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
         return ConversationStates.CHOOSING_FOLDER
+    await show_folder_card(query, snapshot, page, query.from_user.id)
+    return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("file_select:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        folder = get_folder_by_id(folder_id)
-        folder = sync_files_in_folder(folder)
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-        if not file_meta:
-            await query.edit_message_text(
-                "Файл не найден.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]
-                ])
-            )
-            return ConversationStates.FILES_MENU
-
-        file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"])
-        if not os.path.exists(file_path):
-            await query.edit_message_text(
-                "Файл не найден.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]
-                ])
-            )
-            return ConversationStates.FILES_MENU
-
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.FILES_MENU
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        info_text, keyboard = build_file_manage_keyboard(folder_id, file_id, page)
-        await query.edit_message_text(info_text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.FILES_MENU
-
-    if data.startswith("back_to_file_list:"):
-        parts = data.split(":")
-        page = int(parts[1])
-        folder_id = context.user_data.get("current_folder_id")
-
-        context.user_data.pop("rename_file", None)
-        context.user_data.pop("add_files", None)
-
-        folder = get_folder_by_id(folder_id)
-        if not folder:
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:0")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-
-        folder = sync_files_in_folder(folder)
-        files = sorted(folder["files"], key=lambda f: f["name"])
-        total_pages = max(1, (len(files) + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        page_files = files[page * FILES_PER_PAGE : (page + 1) * FILES_PER_PAGE]
-        text = f"*📄 Список файлов в папке*"
-        await query.edit_message_text(
-            text,
-            parse_mode="Markdown",
-            reply_markup=build_files_keyboard(folder_id, page, total_pages, page_files)
-        )
-        return ConversationStates.FILES_MENU
-
-    if data.startswith("file_rename:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        folder = get_folder_by_id(folder_id)
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-
-        if not user.get("rename", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.FILES_MENU
-        context.user_data["rename_file"] = {"folder_id": folder_id, "file_id": file_id, "page": page}
-        await query.edit_message_reply_markup(reply_markup=None)
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-        file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"]) if file_meta else None
-        if not file_meta or not os.path.exists(file_path):
-            await query.edit_message_text(
-                "Файл не найден.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]])
-            )
-            return ConversationStates.FILES_MENU
-        await query.message.chat.send_message(f"Введите новое имя для файла `{escape_md(file_meta['name'])}`:",parse_mode="Markdown", reply_markup=get_cancel_kb())
-        return ConversationStates.FILE_RENAME
-
-    if data.startswith("file_delete_confirm:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        folder = get_folder_by_id(folder_id)
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-
-        if not user.get("delete", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("folder_file_list", args=(str, int))
+async def folder_file_list(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    context.user_data["current_folder_id"] = folder_id
+    sort = get_files_sort(context)
+    folder, files = get_sorted_files(folder_id, sort)
+    if files is None:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.CHOOSING_FOLDER
+    reason = folder_access_denied_reason(folder, user_id, is_admin(user_id))
+    if reason:
+        await query.answer(reason, show_alert=True)
+        return ConversationStates.CHOOSING_FOLDER
+    await show_files_page(query, folder_id, files, page, sort)
+    return ConversationStates.FILES_MENU
 
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-        file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"]) if file_meta else None
-        if not file_meta or not os.path.exists(file_path):
-            await query.edit_message_text(
-                "Файл не найден.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]])
-            )
-            return ConversationStates.FILES_MENU
-        confirm_text = (f"Вы действительно хотите удалить файл `{escape_md(file_meta['name'])}`? Это действие *необратимо*.")
-        confirm_kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🗑 Удалить", callback_data=f"file_delete:{file_id}:{page}"),
-                InlineKeyboardButton("🔙 Отмена", callback_data=f"file_delete_cancel:{file_id}:{page}")
-            ]
-        ])
-        await query.edit_message_text(confirm_text, parse_mode="Markdown", reply_markup=confirm_kb)
-        return ConversationStates.FILE_DELETE_CONFIRM
+@folder_router.route("files_page", args=(str, int))
+async def folder_files_page(update, context, folder_id, page):
+    query = update.callback_query
+    sort = get_files_sort(context)
+    _, files = get_sorted_files(folder_id, sort)
+    if files is None:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.FILES_MENU
+    await show_files_page(query, folder_id, files, page, sort)
+    return ConversationStates.FILES_MENU
 
-    if data.startswith("file_delete_cancel:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        info_text, keyboard = build_file_manage_keyboard(folder_id, file_id, page)
-        await query.edit_message_text(info_text, parse_mode="Markdown", reply_markup=keyboard)
+@folder_router.route("files_sort", args=(str, str))
+async def folder_files_sort(update, context, folder_id, sort):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if sort not in FILE_SORT_MODES:
+        await query.answer()
+        return ConversationStates.FILES_MENU
+    context.user_data["files_sort"] = sort
+    folder, files = get_sorted_files(folder_id, sort)
+    if files is None:
+        await reply_folder_not_found(query, 0)
+        return ConversationStates.FILES_MENU
+    reason = folder_access_denied_reason(folder, user_id, is_admin(user_id))
+    if reason:
+        await query.answer(reason, show_alert=True)
         return ConversationStates.FILES_MENU
+    await show_files_page(query, folder_id, files, 0, sort)
+    return ConversationStates.FILES_MENU
 
-    if data.startswith("file_delete:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        folder = get_folder_by_id(folder_id)
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
+@folder_router.route("no_files_info", args=(str, int))
+async def folder_no_files_info(update, context, folder_id, page):
+    await update.callback_query.answer("В этой папке нет файлов.", show_alert=True)
+    return ConversationStates.FILES_MENU
 
-        if not is_in_database(user_id) or is_banned(user_id):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("file_select", args=(str, int))
+async def file_select(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    folder_id = context.user_data.get("current_folder_id")
+    snapshot = FolderSnapshot.load(folder_id)
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await reply_file_not_found(query, page)
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, is_admin(user_id)):
+        return ConversationStates.FILES_MENU
+    info_text, keyboard = build_file_manage_keyboard(folder_id, file_id, page, snapshot=snapshot)
+    await edit_message_text(query, info_text, parse_mode="Markdown", reply_markup=keyboard)
+    return ConversationStates.FILES_MENU
 
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("back_to_file_list", args=(int,))
+async def file_back_to_list(update, context, page):
+    query = update.callback_query
+    folder_id = context.user_data.get("current_folder_id")
+    context.user_data.pop("rename_file", None)
+    context.user_data.pop("add_files", None)
+    sort = get_files_sort(context)
+    folder, files = get_sorted_files(folder_id, sort)
+    if not folder:
+        await reply_folder_not_found(query, 0)
+        return ConversationStates.CHOOSING_FOLDER
+    await show_files_page(query, folder_id, files or [], page, sort)
+    return ConversationStates.FILES_MENU
 
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("file_rename", args=(str, int))
+async def file_rename(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    folder_id = context.user_data.get("current_folder_id")
+    snapshot = FolderSnapshot.load(folder_id)
+    user = get_user(user_id)
+    if await deny_user_permission(query, user, "rename"):
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.FILES_MENU
+    context.user_data["rename_file"] = {"folder_id": folder_id, "file_id": file_id, "page": page}
+    await edit_message_reply_markup(query)
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await reply_file_not_found(query, page)
+        return ConversationStates.FILES_MENU
+    await query.message.chat.send_message(f"Введите новое имя для файла `{escape_md(file_meta['name'])}`:",parse_mode="Markdown", reply_markup=get_cancel_kb())
+    return ConversationStates.FILE_RENAME
 
-        if not user.get("delete", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("file_delete_confirm", args=(str, int))
+async def file_delete_confirm(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(context.user_data.get("current_folder_id"))
+    user = get_user(user_id)
+    if await deny_user_permission(query, user, "delete"):
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.FILES_MENU
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await reply_file_not_found(query, page)
+        return ConversationStates.FILES_MENU
+    confirm_text = (f"Вы действительно хотите удалить файл `{escape_md(file_meta['name'])}`? Это действие *необратимо*.")
+    confirm_kb = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🗑 Удалить", callback_data=f"file_delete:{file_id}:{page}"),
+            InlineKeyboardButton("🔙 Отмена", callback_data=f"file_delete_cancel:{file_id}:{page}")
+        ]
+    ])
+    await edit_message_text(query, confirm_text, parse_mode="Markdown", reply_markup=confirm_kb)
+    return ConversationStates.FILE_DELETE_CONFIRM
 
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-        file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"]) if file_meta else None
-        if not file_meta or not os.path.exists(file_path):
-            await query.edit_message_text(
-                f"Файл `{escape_md(file_meta['name'])}` уже удален." if file_meta else "Файл уже удален.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]])
-            )
-            return ConversationStates.FILES_MENU
-        try:
-            os.remove(file_path)
-            folder["files"] = [f for f in folder["files"] if f["id"] != file_id]
-            save_folders(load_folders())
+@folder_router.route("file_delete_cancel", args=(str, int))
+async def file_delete_cancel(update, context, file_id, page):
+    query = update.callback_query
+    folder_id = context.user_data.get("current_folder_id")
+    info_text, keyboard = build_file_manage_keyboard(folder_id, file_id, page)
+    await edit_message_text(query, info_text, parse_mode="Markdown", reply_markup=keyboard)
+    return ConversationStates.FILES_MENU
 
-            if is_folder_logging_enabled(folder_id):
+@folder_router.route("file_delete", args=(str, int))
+async def file_delete(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    folder_id = context.user_data.get("current_folder_id")
+    snapshot = FolderSnapshot.load(folder_id)
+    user = get_user(user_id)
+    if await deny_non_member(query, user):
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.FILES_MENU
+    if await deny_user_permission(query, user, "delete"):
+        return ConversationStates.FILES_MENU
+
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await reply_file_not_found(query, page, f"Файл `{escape_md(file_meta['name'])}` уже удален." if file_meta else "Файл уже удален.")
+        return ConversationStates.FILES_MENU
+    try:
+        async with hold_locks(folder_lock_key(folder_id)) as (lease,):
+            # Файл могли переименовать или удалить, пока ждали блокировку.
+            snapshot = FolderSnapshot.load(folder_id)
+            file_meta = snapshot.find_file(file_id) if snapshot else None
+            if not file_meta or not snapshot.file_stat(file_meta):
+                await reply_file_not_found(query, page, "Файл уже удален.")
+                return ConversationStates.FILES_MENU
+            os.remove(snapshot.file_path(file_meta))
+            delete_thumbnails(file_id)
+            remove_file_from_folder(folder_id, file_id, lease)
+
+            if snapshot.logging:
                 add_folder_log(
                     folder_id,
                     user_id,
@@ -1525,455 +3941,472 @@ async def folder_button_callback(update: Update, context: ContextTypes.DEFAULT_T
                     f'удалил файл "{escape_md(file_meta["name"])}". (🗑)'
                 )
 
-            success_text = f"*Файл* `{escape_md(file_meta['name'])}` *удален.*"
-            back_kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]
-            ])
-            await query.edit_message_text(success_text, parse_mode="Markdown", reply_markup=back_kb)
-        except Exception as e:
-            await query.edit_message_text(f"Ошибка удаления файла: {escape_md(str(e))}", parse_mode="Markdown")
-            await query.message.chat.send_message("Выберите действие:",reply_markup=get_main_kb(user_id))
-        return ConversationStates.FILES_MENU
-
-    if data.startswith("file_get:"):
-        parts = data.split(":")
-        file_id, page = parts[1], int(parts[2])
-        folder_id = context.user_data.get("current_folder_id")
-        folder = get_folder_by_id(folder_id)
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        is_owner = user_id == get_folder_owner_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-
-        if not is_in_database(user_id) or is_banned(user_id):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.FILES_MENU
+        success_text = f"*Файл* `{escape_md(file_meta['name'])}` *удален.*"
+        back_kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]
+        ])
+        await edit_message_text(query, success_text, parse_mode="Markdown", reply_markup=back_kb)
+    except LockBusy:
+        await edit_message_text(query, "Папка сейчас изменяется. Попробуйте ещё раз через несколько секунд.")
+    except Exception as e:
+        await edit_message_text(query, f"Ошибка удаления файла: {escape_md(str(e))}", parse_mode="Markdown")
+        await query.message.chat.send_message("Выберите действие:",reply_markup=get_main_kb(user_id))
+    return ConversationStates.FILES_MENU
 
-        if status == "private" and not (admin or is_owner):
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.FILES_MENU
+@folder_router.route("file_get", args=(str, int))
+async def file_get(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(context.user_data.get("current_folder_id"))
+    user = get_user(user_id)
+    if await deny_non_member(query, user):
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.FILES_MENU
+    if await deny_user_permission(query, user, "download"):
+        return ConversationStates.FILES_MENU
 
-        if not user.get("download", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.FILES_MENU
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await reply_file_not_found(query, page)
+        return ConversationStates.FILES_MENU
 
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-        file_path = os.path.join(DATABASE_DIR, folder["name"], file_meta["name"]) if file_meta else None
-        if not file_meta or not os.path.exists(file_path):
-            await query.edit_message_text(
-                "Файл не найден.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку файлов", callback_data=f"back_to_file_list:{page}")]])
-            )
+    try:
+        await query.answer()
+        if file_meta.get("tg_file_type") == "document":
+            cache_requests.inc("telegram_file_id", "hit")
+            await query.message.chat.send_document(document=file_meta["tg_file_id"])
             return ConversationStates.FILES_MENU
+        cache_requests.inc("telegram_file_id", "miss")
+        started = time.perf_counter()
+        with open_stored_file(snapshot.file_path(file_meta), file_meta) as f:
+            message = await query.message.chat.send_document(document=f, filename=file_meta["name"])
+        record_transfer("upload", get_logical_size(file_meta, snapshot.file_stat(file_meta).st_size), time.perf_counter() - started)
+        if not file_meta.get("tg_file_id") and message.document:
+            remember_telegram_file(snapshot.id, file_meta, message.document.file_id, "document", snapshot.file_stat(file_meta).st_size)
+    except Exception as e:
+        await query.answer(f"Ошибка отправки файла: {str(e)}", show_alert=True)
+    return ConversationStates.FILES_MENU
 
-        try:
-            await query.answer()
-            with open(file_path, "rb") as f:
-                await query.message.chat.send_document(document=f, filename=file_meta["name"])
-        except Exception as e:
-            await query.answer(f"Ошибка отправки файла: {str(e)}", show_alert=True)
+@folder_router.route("file_preview", args=(str, int))
+async def file_preview(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(context.user_data.get("current_folder_id"))
+    if await deny_folder_access(query, user_id, snapshot, is_admin(user_id)):
         return ConversationStates.FILES_MENU
 
-    if data.startswith("folder_priv:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        owner_id = get_folder_owner_by_id(folder_id)
-        admin = is_admin(user_id)
-        frozen = is_folder_frozen_by_id(folder_id)
-        if owner_id == user_id and frozen and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        if owner_id == user_id or admin:
-            set_folder_status_by_id(folder_id, "private")
-
-            if is_folder_logging_enabled(folder_id):
-                add_folder_log(
-                    folder_id,
-                    user_id,
-                    get_user(user_id).get("username", ""),
-                    f'сменил статус папки на Приватный. (🔒)'
-                )
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    file_stat = snapshot.file_stat(file_meta) if file_meta else None
+    thumb_path = get_cached_thumbnail(file_id, snapshot.file_path(file_meta), file_stat.st_mtime) if file_stat else None
+    if not thumb_path:
+        await query.answer("Превью ещё не готово.", show_alert=True)
+        return ConversationStates.FILES_MENU
 
-            text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
+    await query.answer()
+    thumb_name = os.path.basename(thumb_path)
+    cached_id = thumbnail_file_ids.get(thumb_name)
+    try:
+        if cached_id:
+            cache_requests.inc("thumbnail_file_id", "hit")
+            await query.message.chat.send_photo(photo=cached_id, caption=file_meta["name"])
         else:
-            await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
-        return ConversationStates.CHOOSING_FOLDER
-
-    if data.startswith("folder_public:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        owner_id = get_folder_owner_by_id(folder_id)
-        admin = is_admin(user_id)
-        frozen = is_folder_frozen_by_id(folder_id)
-        if owner_id == user_id and frozen and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        if owner_id == user_id or admin:
-            set_folder_status_by_id(folder_id, "public")
-
-            if is_folder_logging_enabled(folder_id):
-                add_folder_log(
-                    folder_id,
-                    user_id,
-                    get_user(user_id).get("username", ""),
-                    f'сменил статус папки на Публичный. (🔓)'
-                )
+            cache_requests.inc("thumbnail_file_id", "miss")
+            with open(thumb_path, "rb") as f:
+                sent = await query.message.chat.send_photo(photo=f, caption=file_meta["name"])
+            thumbnail_file_ids[thumb_name] = sent.photo[-1].file_id
+    except Exception as e:
+        log(f"Не удалось отправить превью {thumb_path}: {e}", level=logging.WARNING)
+    return ConversationStates.FILES_MENU
 
-            text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-            await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        else:
-            await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
+@folder_router.route("folder_priv", "folder_public", args=(str, int))
+async def folder_set_status(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
         return ConversationStates.CHOOSING_FOLDER
+    owner_id = snapshot.owner_id
+    admin = is_admin(user_id)
+    if owner_id == user_id and snapshot.frozen and not admin:
+        await query.answer("Папка заморожена администратором.", show_alert=True)
+        return ConversationStates.CHOOSING_FOLDER
+    if owner_id == user_id or admin:
+        private = query.data.startswith("folder_priv:")
+        status = "private" if private else "public"
+        set_folder_status_by_id(folder_id, status)
+        snapshot.folder["status"] = status
 
-    if data.startswith("folder_freeze:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        if not is_admin(user_id):
-            await query.answer("Только администратор может замораживать папки.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        set_folder_freezing_by_id(folder_id, True)
-
-        if is_folder_logging_enabled(folder_id):
+        if snapshot.logging:
             add_folder_log(
                 folder_id,
                 user_id,
                 get_user(user_id).get("username", ""),
-                f'сменил тип папки на Заморожена. (❄️)'
+                f'сменил статус папки на Приватный. (🔒)' if private else f'сменил статус папки на Публичный. (🔓)'
             )
 
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
+        await show_folder_card(query, snapshot, page, user_id, admin)
+    else:
+        await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
+    return ConversationStates.CHOOSING_FOLDER
+
+@folder_router.route("folder_freeze", "folder_unfreeze", args=(str, int))
+async def folder_set_freezing(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    freeze = query.data.startswith("folder_freeze:")
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.CHOOSING_FOLDER
+    if not is_admin(user_id):
+        await query.answer("Только администратор может замораживать папки." if freeze else "Только администратор может разморозить папки.", show_alert=True)
         return ConversationStates.CHOOSING_FOLDER
+    set_folder_freezing_by_id(folder_id, freeze)
+    snapshot.folder["freezing"] = freeze
 
+    if snapshot.logging:
+        add_folder_log(
+            folder_id,
+            user_id,
+            get_user(user_id).get("username", ""),
+            f'сменил тип папки на Заморожена. (❄️)' if freeze else f'сменил тип папки на Обычная. (🔥)'
+        )
 
-    if data.startswith("folder_unfreeze:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        if not is_admin(user_id):
-            await query.answer("Только администратор может разморозить папки.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        set_folder_freezing_by_id(folder_id, False)
+    await show_folder_card(query, snapshot, page, user_id, True)
+    return ConversationStates.CHOOSING_FOLDER
 
-        if is_folder_logging_enabled(folder_id):
-            add_folder_log(
-                folder_id,
-                user_id,
-                get_user(user_id).get("username", ""),
-                f'сменил тип папки на Обычная. (🔥)'
-            )
+@folder_router.route("folder_add_files", args=(str, int))
+async def folder_add_files(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.CHOOSING_FOLDER
+    user = get_user(user_id)
+    if await deny_user_permission(query, user, "addition"):
+        return ConversationStates.CHOOSING_FOLDER
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.CHOOSING_FOLDER
+    context.user_data["add_files"] = {"folder_id": folder_id, "page": page, "added": False}
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message(f"_Внимание! Бот автоматически конвертирует все изображения в формат .jpg. Чтобы сохранить исходный формат, отправляйте изображение как файл._\n\nОтправьте файл(ы) для папки `{escape_md(snapshot.name)}`:",parse_mode="Markdown", reply_markup=get_files_cancel_kb())
+    return ConversationStates.ADD_FILES
 
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
+@folder_router.route("folder_rename", args=(str, int))
+async def folder_rename(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.CHOOSING_FOLDER
+    user = get_user(user_id)
+    if await deny_user_permission(query, user, "rename"):
+        return ConversationStates.CHOOSING_FOLDER
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
         return ConversationStates.CHOOSING_FOLDER
+    context.user_data["rename_folder"] = {"folder_id": folder_id, "page": page}
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message(f"Введите новое имя для папки `{escape_md(snapshot.name)}`:",parse_mode="Markdown", reply_markup=get_cancel_kb())
+    return ConversationStates.RENAME_FOLDER_NAME
 
-    if data.startswith("folder_add_files:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        owner_id = get_folder_owner_by_id(folder_id)
-
-        if not user.get("addition", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if status == "private" and owner_id != user_id and not admin:
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        context.user_data["add_files"] = {"folder_id": folder_id, "page": page, "added": False}
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.chat.send_message(f"_Внимание! Бот автоматически конвертирует все изображения в формат .jpg. Чтобы сохранить исходный формат, отправляйте изображение как файл._\n\nОтправьте файл(ы) для папки `{escape_md(folder['name'])}`:",parse_mode="Markdown", reply_markup=get_files_cancel_kb())
-        return ConversationStates.ADD_FILES
+@folder_router.route("folder_delete_confirm", args=(str, int))
+async def folder_delete_confirm(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
+        return ConversationStates.CHOOSING_FOLDER
+    user = get_user(user_id)
+    if await deny_user_permission(query, user, "delete"):
+        return ConversationStates.CHOOSING_FOLDER
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("folder_rename:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        owner_id = get_folder_owner_by_id(folder_id)
-
-        if not user.get("rename", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if status == "private" and owner_id != user_id and not admin:
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-        context.user_data["rename_folder"] = {"folder_id": folder_id, "page": page}
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.chat.send_message(f"Введите новое имя для папки `{escape_md(folder['name'])}`:",parse_mode="Markdown", reply_markup=get_cancel_kb())
-        return ConversationStates.RENAME_FOLDER_NAME
+    confirm_text = (f"Вы действительно хотите удалить папку `{escape_md(snapshot.name)}`? Это действие *необратимо*.")
+    confirm_kb = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🗑 Удалить", callback_data=f"folder_delete:{folder_id}:{page}"),
+            InlineKeyboardButton("🔙 Отмена", callback_data=f"folder_delete_cancel:{folder_id}:{page}")
+        ]
+    ])
+    await edit_message_text(query, confirm_text, parse_mode="Markdown", reply_markup=confirm_kb)
+    return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("folder_delete_confirm:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        owner_id = get_folder_owner_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-
-        if not user.get("delete", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        if status == "private" and owner_id != user_id and not admin:
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
-
-        confirm_text = (f"Вы действительно хотите удалить папку `{escape_md(folder['name'])}`? Это действие *необратимо*.")
-        confirm_kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🗑 Удалить", callback_data=f"folder_delete:{folder_id}:{page}"),
-                InlineKeyboardButton("🔙 Отмена", callback_data=f"folder_delete_cancel:{folder_id}:{page}")
-            ]
-        ])
-        await query.edit_message_text(confirm_text, parse_mode="Markdown", reply_markup=confirm_kb)
+@folder_router.route("folder_delete", args=(str, int))
+async def folder_delete(update, context, folder_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
         return ConversationStates.CHOOSING_FOLDER
-
-    if data.startswith("folder_delete_cancel:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
+    user = get_user(user_id)
+    owner_id = snapshot.owner_id
+    if await deny_non_member(query, user):
+        return ConversationStates.CHOOSING_FOLDER
+    if await deny_folder_access(query, user_id, snapshot, user.get("status") == "admin"):
+        return ConversationStates.CHOOSING_FOLDER
+    if await deny_user_permission(query, user, "delete"):
         return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("folder_delete:"):
-        folder_id, page = data.split(":")[1], int(data.split(":")[2])
-        folder = get_folder_by_id(folder_id)
-        if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-            await query.edit_message_text(
-                "Папка не найдена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-                ])
-            )
-            return ConversationStates.CHOOSING_FOLDER
-        user = get_user(user_id)
-        admin = is_admin(user_id)
-        owner_id = get_folder_owner_by_id(folder_id)
-        status = get_folder_status_by_id(folder_id)
-        freezing = is_folder_frozen_by_id(folder_id)
-
-        if not is_in_database(user_id) or is_banned(user_id):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
+    try:
+        async with hold_locks(folder_lock_key(folder_id)) as (lease,):
+            # Снимок мог устареть, пока ждали блокировку (папку переименовали или уже удалили).
+            snapshot = FolderSnapshot.load(folder_id)
+            if not snapshot or not snapshot.exists:
+                await reply_folder_not_found(query, page)
+                return ConversationStates.CHOOSING_FOLDER
+            success_fs, msg_fs = delete_folder_fs(snapshot.name)
+            if not success_fs:
+                await edit_message_text(query, f"Ошибка удаления папки: {msg_fs}", parse_mode="Markdown")
+                return ConversationStates.CHOOSING_FOLDER
+            if not delete_folder_in_db_by_id(folder_id, lease):
+                log(f"Папка {folder_id} удалена с диска, но не из базы: аренда блокировки истекла", level=logging.WARNING)
+    except LockBusy:
+        await edit_message_text(query, "Папка сейчас изменяется. Попробуйте ещё раз через несколько секунд.")
+        return ConversationStates.CHOOSING_FOLDER
 
-        if freezing and not admin:
-            await query.answer("Папка заморожена администратором.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
+    if owner_id:
+        users = load_users()
+        for u in users:
+            if u.get("id") == owner_id:
+                u["folders"] = max(0, u.get("folders", 0) - 1)
+                break
+        save_users(users)
+    for file_meta in snapshot.files:
+        delete_thumbnails(file_meta["id"])
+    success_text = f"*Папка* `{escape_md(snapshot.name)}` *удалена.*"
+    back_kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
+    ])
+    await edit_message_text(query, success_text, parse_mode="Markdown", reply_markup=back_kb)
+    return ConversationStates.CHOOSING_FOLDER
 
-        if status == "private" and owner_id != user_id and not admin:
-            await query.answer("Нет доступа к приватной папке.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
+# Проверка доступа к меню логгинга: папка существует и пользователь - владелец или администратор.
+# Возвращает снимок папки или None, если доступа нет.
+async def check_folder_logging_access(query, folder_id, page):
+    snapshot = FolderSnapshot.load(folder_id)
+    if not snapshot or not snapshot.exists:
+        await reply_folder_not_found(query, page)
+        return None
+    user_id = query.from_user.id
+    if not (user_id == snapshot.owner_id or is_admin(user_id)):
+        await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
+        return None
+    return snapshot
 
-        if not user.get("delete", True):
-            await query.answer("Нет доступа.", show_alert=True)
-            return ConversationStates.CHOOSING_FOLDER
+# Показывает меню логгинга папки.
+async def show_folder_logging(query, snapshot, page):
+    text, keyboard = build_folder_logging_keyboard(snapshot.id, page, query.from_user.id, snapshot=snapshot)
+    await edit_message_text(query, text, parse_mode="Markdown", reply_markup=keyboard)
 
-        if not folder:
-            await query.edit_message_text(
-                "Папка уже удалена.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]])
-            )
-            return ConversationStates.CHOOSING_FOLDER
+@folder_router.route("folder_logging", args=(str, int), required=1)
+async def folder_logging_menu(update, context, folder_id, page):
+    query = update.callback_query
+    page = page or 0
+    snapshot = await check_folder_logging_access(query, folder_id, page)
+    if snapshot:
+        await show_folder_logging(query, snapshot, page)
+    return ConversationStates.CHOOSING_FOLDER
 
-        if owner_id:
-            users = load_users()
-            for u in users:
-                if u.get("id") == owner_id:
-                    u["folders"] = max(0, u.get("folders", 0) - 1)
-                    break
-            save_users(users)
+@folder_router.route("folder_logging_toggle", args=(str, int), required=1)
+async def folder_logging_toggle(update, context, folder_id, page):
+    query = update.callback_query
+    page = page or 0
+    snapshot = await check_folder_logging_access(query, folder_id, page)
+    if snapshot:
+        set_folder_logging(folder_id, not snapshot.logging)
+        snapshot.folder["logging"] = not snapshot.logging
+        await show_folder_logging(query, snapshot, page)
+    return ConversationStates.CHOOSING_FOLDER
 
-        success_fs, msg_fs = delete_folder_fs(folder["name"])
-        if not success_fs:
-            await query.edit_message_text(f"Ошибка удаления папки: {msg_fs}", parse_mode="Markdown")
-            return ConversationStates.CHOOSING_FOLDER
-        delete_folder_in_db_by_id(folder_id)
-        success_text = f"*Папка* `{escape_md(folder['name'])}` *удалена.*"
-        back_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-        ])
-        await query.edit_message_text(success_text, parse_mode="Markdown", reply_markup=back_kb)
+@folder_router.route("folder_logging_download", args=(str, int), required=1)
+async def folder_logging_download(update, context, folder_id, page):
+    query = update.callback_query
+    snapshot = await check_folder_logging_access(query, folder_id, page or 0)
+    if not snapshot:
+        return ConversationStates.CHOOSING_FOLDER
+    logs = snapshot.folder.get("logs", [])
+    folder_name = snapshot.name
+    if not logs:
+        await query.answer("Логов нет.", show_alert=True)
         return ConversationStates.CHOOSING_FOLDER
+    logs_numbered = [
+        f"{i+1}. {log}" for i, log in enumerate(logs[::-1])
+    ]
+    logs_text = "\n\n".join(logs_numbered)
+    msg = f"*👁 Последние 100 действий с папкой* `{escape_md(folder_name)}`\n\n{logs_text}"
+    await query.message.reply_text(msg, parse_mode="Markdown")
+    await query.answer()
+    return ConversationStates.CHOOSING_FOLDER
 
-    if data.startswith("folder_logging"):
-        await folder_logging_callback(update, context)
+@folder_router.route("folder_logging_clear", args=(str, int), required=1)
+async def folder_logging_clear(update, context, folder_id, page):
+    query = update.callback_query
+    page = page or 0
+    snapshot = await check_folder_logging_access(query, folder_id, page)
+    if not snapshot:
+        return ConversationStates.CHOOSING_FOLDER
+    if not snapshot.folder.get("logs"):
+        await query.answer("Логов нет.", show_alert=True)
         return ConversationStates.CHOOSING_FOLDER
+    clear_folder_logs(folder_id)
+    snapshot.folder["logs"] = []
+    await query.answer("Логи удалены.", show_alert=True)
+    await show_folder_logging(query, snapshot, page)
+    return ConversationStates.CHOOSING_FOLDER
 
-# Обработка нажатий на Inline-кнопки для меню логгинга
-async def folder_logging_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@folder_router.route("folder_logging_back", args=(str, int), required=1)
+async def folder_logging_back(update, context, folder_id, page):
     query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
-    parts = data.split(":")
-    action = parts[0]
-    folder_id = parts[1]
-    page = int(parts[2]) if len(parts) > 2 else 0
+    page = page or 0
+    snapshot = await check_folder_logging_access(query, folder_id, page)
+    if snapshot:
+        await show_folder_card(query, snapshot, page, query.from_user.id)
+    return ConversationStates.CHOOSING_FOLDER
 
-    folder = get_folder_by_id(folder_id)
-    if not folder or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"])):
-        await query.edit_message_text(
-            "Папка не найдена.",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад к списку папок", callback_data=f"folders_page:{page}")]
-            ])
-        )
-        return ConversationStates.CHOOSING_FOLDER
+# Запрашивает строку поиска файлов.
+async def ask_search_query(update):
+    await update.message.reply_text(
+        f"Введите часть имени файла (не короче {SEARCH_MIN_QUERY} символов):",
+        reply_markup=get_cancel_kb()
+    )
+    return ConversationStates.SEARCH_QUERY
 
-    owner_id = get_folder_owner_by_id(folder_id)
-    admin = is_admin(user_id)
-    is_owner = (user_id == owner_id)
+# Команда /search: с текстом ищет сразу, без текста - спрашивает строку поиска.
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_reply(update, context): return ConversationHandler.END
+    log_state(update, context, "search_command")
+    user_id = update.effective_user.id
+    if not is_authorized(user_id):
+        await update.message.reply_text("Войдите через кнопку ниже.", reply_markup=get_guest_kb())
+        return ConversationHandler.END
+    text = " ".join(context.args or []).strip()
+    if not text:
+        return await ask_search_query(update)
+    return await reply_search_results(update, context, text)
 
-    if action != "folder_logging" and not (is_owner or admin):
-        await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
-        return
+# Ввод строки поиска.
+async def search_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_reply(update, context): return ConversationHandler.END
+    log_state(update, context, "search_files")
+    user_id = update.effective_user.id
+    text = update.message.text.strip()
+    if text == "🔙 Отмена":
+        await update.message.reply_text("_Действие отменено._", parse_mode="Markdown", reply_markup=get_main_kb(user_id))
+        return ConversationHandler.END
+    return await reply_search_results(update, context, text, restore_kb=True)
 
-    if action == "folder_logging":
-        if not (is_owner or admin):
-            await query.answer("Только владелец папки может изменять данный параметр.", show_alert=True)
-            return
-        text, keyboard = build_folder_logging_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.CHOOSING_FOLDER
+# Выполняет поиск, сохраняет результаты для листания и показывает первую страницу.
+async def reply_search_results(update, context, text, restore_kb=False):
+    user_id = update.effective_user.id
+    if len(text) < SEARCH_MIN_QUERY:
+        await update.message.reply_text(f"Слишком короткий запрос: нужно не меньше {SEARCH_MIN_QUERY} символов.", reply_markup=get_cancel_kb())
+        return ConversationStates.SEARCH_QUERY
+    if not file_search_index.ready:
+        await update.message.reply_text("Индекс поиска ещё строится, попробуйте через минуту.", reply_markup=get_main_kb(user_id))
+        return ConversationHandler.END
+
+    refresh_data_version()
+    folders = get_searchable_folders(user_id)
+    total, matches = file_search_index.search(text, folders, SEARCH_MAX_RESULTS)
+    context.user_data["search"] = {
+        "query": text,
+        "total": total,
+        "results": [[file_id, folder_id, name, folders[folder_id]] for file_id, folder_id, name in matches]
+    }
+    if restore_kb:
+        await update.message.reply_text("*🔎 Поиск выполнен.*", parse_mode="Markdown", reply_markup=get_main_kb(user_id))
+    search_text, keyboard = render_search_page(context.user_data["search"], 0)
+    await update.message.reply_text(search_text, parse_mode="Markdown", reply_markup=keyboard)
+    return ConversationStates.FILES_MENU
+
+# Текст и клавиатура страницы результатов поиска.
+def render_search_page(search, page):
+    results = search["results"]
+    total_pages = max(1, (len(results) + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
+    page = max(0, min(page, total_pages - 1))
+    if search["total"] is None and results:
+        text = f"*🔎 Поиск:* `{escape_md(search['query'])}`\n\nНайдено файлов: больше {len(results)} (показаны {len(results)}, уточните запрос)"
+    elif search["total"] is None:
+        text = f"*🔎 Поиск:* `{escape_md(search['query'])}`\n\n_Запрос слишком общий: среди просмотренных файлов совпадений нет, уточните запрос._"
+    else:
+        text = f"*🔎 Поиск:* `{escape_md(search['query'])}`\n\nНайдено файлов: {search['total']}"
+        if search["total"] > len(results):
+            text += f" (показаны первые {len(results)})"
+        if not results:
+            text += "\n\n_Ничего не найдено._"
+    buttons = []
+    for file_id, _, name, folder_name in results[page * FILES_PER_PAGE : (page + 1) * FILES_PER_PAGE]:
+        label = f"{name} · {folder_name}"
+        buttons.append([InlineKeyboardButton(
+            label[:60] + ("..." if len(label) > 60 else ""),
+            callback_data=f"search_open:{file_id}:{page}"
+        )])
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"search_page:{page-1}"))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"search_page:{page+1}"))
+    if nav_buttons:
+        buttons.append(nav_buttons)
+    return text, InlineKeyboardMarkup(buttons)
 
-    if action == "folder_logging_toggle":
-        enabled = is_folder_logging_enabled(folder_id)
-        set_folder_logging(folder_id, not enabled)
-        text, keyboard = build_folder_logging_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.CHOOSING_FOLDER
+@folder_router.route("search_page", args=(int,))
+async def search_page(update, context, page):
+    query = update.callback_query
+    search = context.user_data.get("search")
+    if not search:
+        await query.answer("Результаты поиска устарели, повторите поиск.", show_alert=True)
+        return ConversationStates.FILES_MENU
+    text, keyboard = render_search_page(search, page)
+    await edit_message_text(query, text, parse_mode="Markdown", reply_markup=keyboard)
+    return ConversationStates.FILES_MENU
 
-    if action == "folder_logging_download":
-        logs = get_folder_logs(folder_id)
-        folder = get_folder_by_id(folder_id)
-        folder_name = folder["name"] if folder else ""
-        if not logs:
-            await query.answer("Логов нет.", show_alert=True)
-            return
-        logs_numbered = [
-            f"{i+1}. {log}" for i, log in enumerate(logs[::-1])
-        ]
-        logs_text = "\n\n".join(logs_numbered)
-        msg = f"*👁 Последние 100 действий с папкой* `{escape_md(folder_name)}`\n\n{logs_text}"
-        await query.message.reply_text(msg, parse_mode="Markdown")
-        await query.answer()
+# Открывает карточку найденного файла; дальше работают обычные кнопки управления файлом.
+@folder_router.route("search_open", args=(str, int))
+async def search_open(update, context, file_id, page):
+    query = update.callback_query
+    user_id = query.from_user.id
+    search = context.user_data.get("search") or {}
+    folder_id = next((r[1] for r in search.get("results", []) if r[0] == file_id), None)
+    snapshot = FolderSnapshot.load(folder_id) if folder_id else None
+    file_meta = snapshot.find_file(file_id) if snapshot else None
+    if not file_meta or not snapshot.file_stat(file_meta):
+        await query.answer("Файл не найден.", show_alert=True)
+        return ConversationStates.FILES_MENU
+    if await deny_folder_access(query, user_id, snapshot, is_admin(user_id)):
+        return ConversationStates.FILES_MENU
+    context.user_data["current_folder_id"] = folder_id
+    info_text, keyboard = build_file_manage_keyboard(folder_id, file_id, 0, snapshot=snapshot)
+    keyboard = InlineKeyboardMarkup(list(keyboard.inline_keyboard) + [
+        [InlineKeyboardButton("🔎 К результатам поиска", callback_data=f"search_page:{page}")]
+    ])
+    await edit_message_text(query, info_text, parse_mode="Markdown", reply_markup=keyboard)
+    return ConversationStates.FILES_MENU
+
+# Inline-режим: @бот <запрос> в любом чате - найденные файлы отправляются по сохранённому file_id без повторной загрузки.
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    text = inline_query.query.strip()
+    user = get_user(user_id)
+    if (
+        not user or not user.get("authorized") or user.get("status") == "banned" or not user.get("download", True)
+        or len(text) < SEARCH_MIN_QUERY or not file_search_index.ready
+    ):
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
         return
-
-    if action == "folder_logging_clear":
-        logs = get_folder_logs(folder_id)
-        if not logs:
-            await query.answer("Логов нет.", show_alert=True)
-            return
-        clear_folder_logs(folder_id)
-        await query.answer("Логи удалены.", show_alert=True)
-        text, keyboard = build_folder_logging_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.CHOOSING_FOLDER
-
-    if action == "folder_logging_back":
-        text, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
-        return ConversationStates.CHOOSING_FOLDER
+    results = [
+        INLINE_RESULT_BUILDERS.get(tg_file_type, INLINE_RESULT_BUILDERS["document"])(file_id, tg_file_id, name, folder_name)
+        for file_id, name, folder_name, tg_file_id, tg_file_type in get_inline_matches(user_id, text)
+    ]
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, auto_pagination=True)
 
 # Добавление файлов в папку.
 async def add_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2082,7 +4515,7 @@ async def add_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationStates.ADD_FILES
 
     existing_files = set(os.listdir(folder_path))
-    added_files, duplicate_files, processed_file_names, too_big_files = [], set(), set(), []
+    added_files, duplicate_files, processed_file_names, too_big_files, busy_files = [], set(), set(), [], []
 
     for file_obj, ext in file_items:
         file_name = getattr(file_obj, "file_name", None)
@@ -2101,25 +4534,51 @@ async def add_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif ext and not file_name.lower().endswith(ext):
                 file_name = os.path.splitext(file_name)[0] + ext
 
-        save_path = os.path.join(folder_path, file_name)
         if file_name in existing_files or file_name in processed_file_names:
             duplicate_files.add(file_name)
             continue
+        # Скачиваем и сжимаем без блокировки; под арендой только проверка имени и перенос в папку.
+        tmp_path = os.path.join(get_uploads_dir(), f"{uuid.uuid4()}.part")
         try:
+            started = time.perf_counter()
             file = await file_obj.get_file()
-            await file.download_to_drive(save_path)
-            file_size = os.path.getsize(save_path)
-            added_files.append((file_name, file_size))
-            processed_file_names.add(file_name)
-
-            folders = load_folders()
-            for f in folders:
-                if f["id"] == folder_id:
-                    f["files"].append({"id": str(uuid.uuid4()), "name": file_name})
-                    break
-            save_folders(folders)
+            await file.download_to_drive(tmp_path)
+            file_size = os.path.getsize(tmp_path)
+            record_transfer("download", file_size, time.perf_counter() - started)
+
+            new_file_id = str(uuid.uuid4())
+            new_file_meta = {"id": new_file_id, "name": file_name}
+            compression = await asyncio.to_thread(compress_stored_file, tmp_path)
+            if compression:
+                new_file_meta.update(compression)
+            stored_size = os.path.getsize(tmp_path)
+            new_file_meta.update(
+                tg_file_id=file_obj.file_id,
+                tg_file_type=TELEGRAM_FILE_TYPES.get(type(file_obj).__name__, "document"),
+                tg_size=stored_size,
+                size=stored_size
+            )
 
-            if is_folder_logging_enabled(folder_id):
+            async with hold_locks(folder_lock_key(folder_id)) as (lease,):
+                # Пока скачивали, папку могли переименовать или удалить, а имя файла - занять.
+                folder = folders_collection.find_one({"id": folder_id})
+                if not folder:
+                    await update.message.reply_text("Папка не найдена.", reply_markup=get_main_kb(user_id))
+                    context.user_data.pop("add_files", None)
+                    return ConversationHandler.END
+                save_path = os.path.join(DATABASE_DIR, folder["name"], file_name)
+                if os.path.exists(save_path):
+                    duplicate_files.add(file_name)
+                    continue
+                os.replace(tmp_path, save_path)
+                added_files.append((file_name, file_size))
+                processed_file_names.add(file_name)
+                if not add_file_to_folder(folder_id, new_file_meta, lease):
+                    # Файл уже на диске - метаданные добавит сверка с диском.
+                    log(f"Файл {file_name} сохранён, но не записан в папку {folder_id}: аренда блокировки истекла", level=logging.WARNING)
+
+            schedule_thumbnail(new_file_id, save_path)
+            if folder.get("logging", False):
                 add_folder_log(
                     folder_id,
                     user_id,
@@ -2127,11 +4586,16 @@ async def add_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f'добавил файл "{escape_md(file_name)}". (➕)'
                 )
 
+        except LockBusy:
+            busy_files.append(file_name)
         except telegram.error.BadRequest as e:
             if "File is too big" in str(e):
                 too_big_files.append(file_name)
             else:
                 await update.message.reply_text(f"Ошибка загрузки файла `{escape_md(file_name)}`: {escape_md(str(e))}",parse_mode="Markdown")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     if added_files:
         context.user_data["add_files"]["added"] = True
@@ -2148,6 +4612,8 @@ async def add_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_messages.append(f"*❌ Файл не добавлен*\n\nДанный файл уже есть в папке.")
     if too_big_files:
         reply_messages.append(f"*❌ Файл не добавлен*\n\nОтправленный файл слишком большой (макс 50 MB).")
+    if busy_files:
+        reply_messages.append(f"*❌ Файл не добавлен*\n\nПапка сейчас изменяется. Отправьте файл ещё раз через несколько секунд.")
 
     await update.message.reply_text(
         "\n\n".join(reply_messages),
@@ -2218,21 +4684,39 @@ async def rename_folder_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Недопустимое или занятое имя папки. Попробуйте другое.", reply_markup=get_cancel_kb())
         return ConversationStates.RENAME_FOLDER_NAME
 
-    success, msg = rename_folder_fs(folder["name"], text)
-    if not success:
-        await update.message.reply_text(msg, reply_markup=get_cancel_kb())
-        return ConversationStates.RENAME_FOLDER_NAME
-
-    old_name = folder["name"]
-    rename_folder_in_db_by_id(folder_id, text)
+    try:
+        async with hold_locks(folder_lock_key(folder_id), folder_name_lock_key(text)) as (lease, _):
+            # Пока ждали блокировку, папку могли переименовать или удалить, а имя - занять.
+            folder = folders_collection.find_one({"id": folder_id})
+            if not folder:
+                await update.message.reply_text("Папка не найдена.", parse_mode="Markdown", reply_markup=get_main_kb(user_id))
+                context.user_data.pop("rename_folder", None)
+                return ConversationHandler.END
+            if text == folder["name"] or folder_exists(text):
+                await update.message.reply_text("Недопустимое или занятое имя папки. Попробуйте другое.", reply_markup=get_cancel_kb())
+                return ConversationStates.RENAME_FOLDER_NAME
+
+            old_name = folder["name"]
+            success, msg = rename_folder_fs(old_name, text)
+            if not success:
+                await update.message.reply_text(msg, reply_markup=get_cancel_kb())
+                return ConversationStates.RENAME_FOLDER_NAME
+            if not rename_folder_in_db_by_id(folder_id, text, lease):
+                # Аренда истекла и перешла другому экземпляру - возвращаем каталогу прежнее имя.
+                rename_folder_fs(text, old_name)
+                await update.message.reply_text("Папку одновременно изменили. Попробуйте ещё раз.", reply_markup=get_cancel_kb())
+                return ConversationStates.RENAME_FOLDER_NAME
 
-    if is_folder_logging_enabled(folder_id):
-        add_folder_log(
-            folder_id,
-            user_id,
-            user.get("username", ""),
-            f'переименовал папку "{escape_md(old_name)}" на "{escape_md(text)}". (✏️)'
-        )
+            if is_folder_logging_enabled(folder_id):
+                add_folder_log(
+                    folder_id,
+                    user_id,
+                    user.get("username", ""),
+                    f'переименовал папку "{escape_md(old_name)}" на "{escape_md(text)}". (✏️)'
+                )
+    except LockBusy:
+        await update.message.reply_text("Папка сейчас изменяется. Попробуйте ещё раз через несколько секунд.", reply_markup=get_cancel_kb())
+        return ConversationStates.RENAME_FOLDER_NAME
 
     await update.message.reply_text(f"*Имя папки было сменено на* `{escape_md(text)}`*.*", parse_mode="Markdown", reply_markup=get_main_kb(user_id))
     text_reply, keyboard = build_folder_manage_keyboard(folder_id, page, user_id)
@@ -2261,8 +4745,7 @@ async def rename_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     folder_id = data["folder_id"]
     file_id = data["file_id"]
     page = data["page"]
-    folders = load_folders()
-    folder = next((f for f in folders if f["id"] == folder_id), None)
+    folder = folders_collection.find_one({"id": folder_id})
     if not folder:
         await update.message.reply_text("Папка уже удалена.", reply_markup=get_main_kb(user_id))
         context.user_data.pop("rename_file", None)
@@ -2319,17 +4802,37 @@ async def rename_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationStates.FILE_RENAME
 
     try:
-        os.rename(file_path, os.path.join(DATABASE_DIR, folder["name"], text))
-        for f in folders:
-            if f["id"] == folder_id:
-                for file in f["files"]:
-                    if file["id"] == file_id:
-                        file["name"] = text
-        save_folders(folders)
-        folder = next((f for f in folders if f["id"] == folder_id), None)
-        file_meta = next((f for f in folder["files"] if f["id"] == file_id), None)
-
-        if is_folder_logging_enabled(folder_id):
+        async with hold_locks(folder_lock_key(folder_id)):
+            # Пока ждали блокировку, папку или файл могли переименовать или удалить, а новое имя - занять.
+            folder = folders_collection.find_one({"id": folder_id})
+            file_meta = next((f for f in folder["files"] if f["id"] == file_id), None) if folder else None
+            if not file_meta or not os.path.exists(os.path.join(DATABASE_DIR, folder["name"], file_meta["name"])):
+                await update.message.reply_text("Файл уже удален.", reply_markup=get_main_kb(user_id))
+                context.user_data.pop("rename_file", None)
+                return ConversationStates.FILES_MENU
+            old_name = file_meta["name"]
+            file_path = os.path.join(DATABASE_DIR, folder["name"], old_name)
+            new_path = os.path.join(DATABASE_DIR, folder["name"], text)
+            if text == old_name or os.path.exists(new_path):
+                await update.message.reply_text("Недопустимое или занятое имя файла. Попробуйте другое.", reply_markup=get_cancel_kb())
+                return ConversationStates.FILE_RENAME
+            os.rename(file_path, new_path)
+
+            # Папка перечитывается перед записью: файлы, добавленные и изменённые за это время, не теряются.
+            def rename_meta(doc):
+                meta = next((f for f in doc.get("files", []) if f["id"] == file_id), None)
+                if not meta:
+                    return False
+                meta["name"] = text
+
+            folder = update_folder(folder_id, rename_meta)
+            file_meta = next((f for f in folder["files"] if f["id"] == file_id), None) if folder else None
+            if not file_meta or file_meta["name"] != text:
+                os.rename(new_path, file_path)
+                await update.message.reply_text("Папку одновременно изменили. Попробуйте ещё раз.", reply_markup=get_cancel_kb())
+                return ConversationStates.FILE_RENAME
+
+        if folder.get("logging", False):
             add_folder_log(
                 folder_id,
                 user_id,
@@ -2342,6 +4845,9 @@ async def rename_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(info_text, parse_mode="Markdown", reply_markup=keyboard)
         context.user_data.pop("rename_file", None)
         return ConversationStates.FILES_MENU
+    except LockBusy:
+        await update.message.reply_text("Папка сейчас изменяется. Попробуйте ещё раз через несколько секунд.", reply_markup=get_cancel_kb())
+        return ConversationStates.FILE_RENAME
     except Exception as e:
         await update.message.reply_text(f"Ошибка переименования файла: {escape_md(str(e))}", reply_markup=get_cancel_kb())
         return ConversationStates.FILE_RENAME
@@ -2353,7 +4859,7 @@ async def my_account_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     data = query.data
 
     if data == "my_account_logout_confirm":
-        await query.edit_message_text("Вы действительно хотите *завершить* сессию?",parse_mode="Markdown",reply_markup=build_logout_confirm_keyboard())
+        await edit_message_text(query, "Вы действительно хотите *завершить* сессию?",parse_mode="Markdown",reply_markup=build_logout_confirm_keyboard())
         return ConversationHandler.END
 
     elif data == "my_account_logout":
@@ -2368,7 +4874,7 @@ async def my_account_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     elif data == "my_account_logout_cancel":
         user = get_user(user_id)
-        await query.edit_message_text(build_my_account_text(user),parse_mode="Markdown",reply_markup=build_my_account_keyboard(user))
+        await edit_message_text(query, build_my_account_text(user),parse_mode="Markdown",reply_markup=build_my_account_keyboard(user))
         return ConversationHandler.END
 
     elif data == "noop":
@@ -2388,268 +4894,262 @@ async def admin_users_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def user_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await precheck_inline(update, context): return
     log_state(update, context, "user_admin_callback")
-    user_id = update.effective_user.id
-    query = update.callback_query
-    data = query.data
 
-    if not is_admin(user_id):
+    if not is_admin(update.effective_user.id):
         await update.callback_query.answer("Нет доступа.", show_alert=True)
         return
 
+    return await user_admin_router.dispatch(update, context)
+
+# Показывает список пользователей на странице page (редактированием или новым сообщением).
+async def show_users_list(query, page, send_new=False):
     users = load_users()
+    admin_id = query.from_user.id
+    total_pages = max(1, (len([u for u in users if u.get('id') != admin_id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
+    page = max(0, min(page, total_pages - 1))
+    text, keyboard = build_users_list_message(users), build_users_list_keyboard(users, admin_id, page, total_pages)
+    if send_new:
+        await query.message.chat.send_message(text, reply_markup=keyboard, parse_mode="Markdown")
+    else:
+        await edit_message_text(query, text, reply_markup=keyboard, parse_mode="Markdown")
 
-    if data.startswith("users_page:"):
-        page = int(data.split(":")[1])
-        context.user_data['users_page'] = page
-        total_pages = max(1, (len([u for u in users if u.get('id') != query.from_user.id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        await query.edit_message_text(build_users_list_message(users),reply_markup=build_users_list_keyboard(users, query.from_user.id, page, total_pages),parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_MENU
+# Показывает карточку пользователя (редактированием или новым сообщением).
+async def show_user_card(query, context, user, send_new=False):
+    page = context.user_data.get('users_page', 0)
+    text, keyboard = build_user_manage_text(user), build_user_manage_keyboard(user, page)
+    if send_new:
+        await query.message.chat.send_message(text, reply_markup=keyboard, parse_mode="Markdown")
+    else:
+        await edit_message_text(query, text, reply_markup=keyboard, parse_mode="Markdown")
 
-    if data.startswith("user_manage:"):
-        parts = data.split(":")
-        user_id_to_manage = int(parts[1])
-        page = int(parts[2]) if len(parts) > 2 else context.user_data.get('users_page', 0)
-        context.user_data['users_page'] = page
-        user = get_user(user_id_to_manage)
-        if user:
-            await query.edit_message_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
-            context.user_data["current_manage_user"] = user_id_to_manage
-        else:
-            total_pages = max(1, (len([u for u in users if u.get('id') != query.from_user.id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
-            page = max(0, min(page, total_pages - 1))
-            await query.edit_message_text(build_users_list_message(users),reply_markup=build_users_list_keyboard(users, query.from_user.id, page, total_pages),parse_mode="Markdown")
+# Переключает право пользователя, если он не администратор.
+async def toggle_user_permission(update, context, target_user_id, field):
+    query = update.callback_query
+    user = get_user(target_user_id)
+    if user and user.get("status") == "admin":
+        await query.answer("Нельзя изменить права администратора.", show_alert=True)
         return ConversationStates.USER_MANAGE_USER
+    users = load_users()
+    for u in users:
+        if u.get("id") == target_user_id:
+            u[field] = not u.get(field, True)
+            save_users(users)
+            break
+    await query.answer()
+    await show_user_card(query, context, get_user(target_user_id))
+    return ConversationStates.USER_MANAGE_USER
 
-    if data.startswith("user_list:"):
-        page = int(data.split(":")[1])
+@user_admin_router.route("users_page", "user_list", args=(int,), required=0)
+async def user_list_page(update, context, page):
+    if page is None:
+        page = context.user_data.get('users_page', 0)
+    else:
         context.user_data['users_page'] = page
-        total_pages = max(1, (len([u for u in users if u.get('id') != query.from_user.id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        await query.edit_message_text(build_users_list_message(users),reply_markup=build_users_list_keyboard(users, query.from_user.id, page, total_pages),parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_MENU
+    await show_users_list(update.callback_query, page)
+    return ConversationStates.USER_MANAGE_MENU
 
-    if data == "user_list":
+@user_admin_router.route("user_manage", args=(int, int), required=1)
+async def user_manage(update, context, user_id_to_manage, page):
+    query = update.callback_query
+    if page is None:
         page = context.user_data.get('users_page', 0)
-        total_pages = max(1, (len([u for u in users if u.get('id') != query.from_user.id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
-        page = max(0, min(page, total_pages - 1))
-        await query.edit_message_text(build_users_list_message(users),reply_markup=build_users_list_keyboard(users, query.from_user.id, page, total_pages),parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_MENU
+    context.user_data['users_page'] = page
+    user = get_user(user_id_to_manage)
+    if user:
+        await show_user_card(query, context, user)
+        context.user_data["current_manage_user"] = user_id_to_manage
+    else:
+        await show_users_list(query, page)
+    return ConversationStates.USER_MANAGE_USER
 
-    if data == "user_add":
-        await query.message.edit_reply_markup(reply_markup=None)
-        await query.message.chat.send_message("Введите Telegram ID пользователя:", reply_markup=get_cancel_kb())
-        return ConversationStates.USER_ADD_ID
+@user_admin_router.route("user_add")
+async def user_add(update, context):
+    query = update.callback_query
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Введите Telegram ID пользователя:", reply_markup=get_cancel_kb())
+    return ConversationStates.USER_ADD_ID
 
-    if data == "no_users":
-        await query.answer("В базе нет пользователей.", show_alert=True)
-        return ConversationStates.USER_MANAGE_MENU
+@user_admin_router.route("no_users")
+async def user_no_users(update, context):
+    await update.callback_query.answer("В базе нет пользователей.", show_alert=True)
+    return ConversationStates.USER_MANAGE_MENU
 
-    if data.startswith("user_toggle_status:"):
-        target_user_id = int(data.split(":")[1])
-        users = load_users()
-        for u in users:
-            if u.get("id") == target_user_id:
-                if u.get("status") != "admin":
-                    u["status"] = "admin"
-                    u["addition"] = True
-                    u["download"] = True
-                    u["rename"] = True
-                    u["delete"] = True
-                    u["folders_limit"] = 0
-                    save_users(users)
-                    try:
-                        await update.get_bot().send_message(
-                            target_user_id,
-                            f"*🔔 Уведомление*\n\nВас сделали администратором.",
-                            parse_mode="Markdown"
-                        )
-                    except Exception:
-                        pass
-                else:
-                    u["status"] = "default"
-                    u["folders_limit"] = 10
-                    save_users(users)
-                    try:
-                        await update.get_bot().send_message(target_user_id,f"*🔔 Уведомление*\n\nУ вас забрали права администратора.",parse_mode="Markdown")
-                    except Exception:
-                        pass
-                break
-        user = get_user(target_user_id)
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_toggle_status", args=(int,))
+async def user_toggle_status(update, context, target_user_id):
+    users = load_users()
+    for u in users:
+        if u.get("id") == target_user_id:
+            if u.get("status") != "admin":
+                u["status"] = "admin"
+                u["addition"] = True
+                u["download"] = True
+                u["rename"] = True
+                u["delete"] = True
+                u["folders_limit"] = 0
+                save_users(users)
+                await send_notification(update.get_bot(), target_user_id, "*🔔 Уведомление*\n\nВас сделали администратором.")
+            else:
+                u["status"] = "default"
+                u["folders_limit"] = 10
+                save_users(users)
+                await send_notification(update.get_bot(), target_user_id, f"*🔔 Уведомление*\n\nУ вас забрали права администратора.")
+            break
+    await show_user_card(update.callback_query, context, get_user(target_user_id))
+    return ConversationStates.USER_MANAGE_USER
 
-    if data.startswith("user_change_pass:"):
-        user_id_to_change = int(data.split(":")[1])
-        context.user_data["change_pass_user"] = user_id_to_change
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.chat.send_message("Введите новый пароль для пользователя:", reply_markup=get_cancel_kb())
-        return ConversationStates.USER_ADD_PASS
-
-    if data.startswith("user_block:"):
-        user_id_to_block = int(data.split(":")[1])
-        admin_block_user(user_id_to_block)
-        user = get_user(user_id_to_block)
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
-        try:
-            await update.get_bot().send_message(user_id_to_block,"*🔔 Уведомление*\n\nВас заблокировал администратор.",parse_mode="Markdown")
-        except Exception:
-            pass
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_change_pass", args=(int,))
+async def user_change_pass(update, context, user_id_to_change):
+    query = update.callback_query
+    context.user_data["change_pass_user"] = user_id_to_change
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Введите новый пароль для пользователя:", reply_markup=get_cancel_kb())
+    return ConversationStates.USER_ADD_PASS
 
-    if data.startswith("user_unblock:"):
-        user_id_to_unblock = int(data.split(":")[1])
-        admin_unblock_user(user_id_to_unblock)
-        user = get_user(user_id_to_unblock)
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
-        try:
-            await update.get_bot().send_message(user_id_to_unblock,"*🔔 Уведомление*\n\nВас разблокировал администратор.",parse_mode="Markdown")
-        except Exception:
-            pass
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_block", args=(int,))
+async def user_block(update, context, user_id_to_block):
+    admin_block_user(user_id_to_block)
+    await show_user_card(update.callback_query, context, get_user(user_id_to_block))
+    await send_notification(update.get_bot(), user_id_to_block, "*🔔 Уведомление*\n\nВас заблокировал администратор.")
+    return ConversationStates.USER_MANAGE_USER
 
-    if data.startswith("user_delete_confirm:"):
-        user_id_to_del = int(data.split(":")[1])
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(f"Вы действительно хотите удалить пользователя `{user_id_to_del}`? Это действие *необратимо*.",parse_mode="Markdown",reply_markup=build_user_delete_confirm_keyboard(user_id_to_del))
-        return ConversationStates.USER_DELETE_CONFIRM
+@user_admin_router.route("user_unblock", args=(int,))
+async def user_unblock(update, context, user_id_to_unblock):
+    admin_unblock_user(user_id_to_unblock)
+    await show_user_card(update.callback_query, context, get_user(user_id_to_unblock))
+    await send_notification(update.get_bot(), user_id_to_unblock, "*🔔 Уведомление*\n\nВас разблокировал администратор.")
+    return ConversationStates.USER_MANAGE_USER
 
-    if data.startswith("user_delete_cancel:"):
-        user_id_to_cancel = int(data.split(":")[1])
-        user = get_user(user_id_to_cancel)
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_delete_confirm", args=(int,))
+async def user_delete_confirm(update, context, user_id_to_del):
+    await edit_message_text(update.callback_query, f"Вы действительно хотите удалить пользователя `{user_id_to_del}`? Это действие *необратимо*.",parse_mode="Markdown",reply_markup=build_user_delete_confirm_keyboard(user_id_to_del))
+    return ConversationStates.USER_DELETE_CONFIRM
 
-    if data.startswith("user_delete:"):
-        user_id_to_delete = int(data.split(":")[1])
-        users = [u for u in load_users() if u.get("id") != user_id_to_delete]
-        save_users(users)
-        page = context.user_data.get('users_page', 0)
-        await query.edit_message_text(
-            f"Пользователь `{user_id_to_delete}` успешно удалён.",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data=f"user_list:{page}")]
-            ])
-        )
-        try:
-            await update.get_bot().send_message(user_id_to_delete,"*🔔 Уведомление*\n\nАдминистратор исключил вас из базы.",parse_mode="Markdown")
-        except Exception:
-            pass
-        return ConversationStates.USER_MANAGE_MENU
+@user_admin_router.route("user_delete_cancel", args=(int,))
+async def user_delete_cancel(update, context, user_id_to_cancel):
+    await show_user_card(update.callback_query, context, get_user(user_id_to_cancel))
+    return ConversationStates.USER_MANAGE_USER
+
+@user_admin_router.route("user_delete", args=(int,))
+async def user_delete(update, context, user_id_to_delete):
+    users = [u for u in load_users() if u.get("id") != user_id_to_delete]
+    save_users(users)
+    page = context.user_data.get('users_page', 0)
+    await edit_message_text(
+        update.callback_query,
+        f"Пользователь `{user_id_to_delete}` успешно удалён.",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад к списку пользователей", callback_data=f"user_list:{page}")]
+        ])
+    )
+    await send_notification(update.get_bot(), user_id_to_delete, "*🔔 Уведомление*\n\nАдминистратор исключил вас из базы.")
+    return ConversationStates.USER_MANAGE_MENU
 
-    if data.startswith("user_send_msg:"):
-        user_id_to_send = int(data.split(":")[1])
-        context.user_data["send_msg_user"] = user_id_to_send
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.chat.send_message("Введите сообщение, которое хотите отправить пользователю:", reply_markup=get_cancel_kb())
-        return ConversationStates.USER_SEND_MSG
+@user_admin_router.route("user_send_msg", args=(int,))
+async def user_send_msg(update, context, user_id_to_send):
+    query = update.callback_query
+    context.user_data["send_msg_user"] = user_id_to_send
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Введите сообщение, которое хотите отправить пользователю:", reply_markup=get_cancel_kb())
+    return ConversationStates.USER_SEND_MSG
 
-    if data.startswith("user_send_msg_cancel:"):
-        user_id_to_cancel = int(data.split(":")[1])
-        user = get_user(user_id_to_cancel)
-        page = context.user_data.get('users_page', 0)
-        await query.message.chat.send_message("_Действие отменено._",parse_mode="Markdown",reply_markup=get_main_kb(update.effective_user.id))
-        await query.message.chat.send_message(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user, page),parse_mode="Markdown")
+@user_admin_router.route("user_send_msg_cancel", args=(int,))
+async def user_send_msg_cancel(update, context, user_id_to_cancel):
+    query = update.callback_query
+    await query.message.chat.send_message("_Действие отменено._",parse_mode="Markdown",reply_markup=get_main_kb(update.effective_user.id))
+    await show_user_card(query, context, get_user(user_id_to_cancel), send_new=True)
+    return ConversationStates.USER_MANAGE_USER
+
+@user_admin_router.route("user_do_send_msg", args=(int,))
+async def user_do_send_msg(update, context, user_id_to_send):
+    query = update.callback_query
+    text_to_send = context.user_data.get("send_msg_text")
+    admin_id = query.from_user.id
+
+    if not text_to_send:
+        await query.answer("Сообщение уже отправлено.", show_alert=True)
         return ConversationStates.USER_MANAGE_USER
 
-    if data.startswith("user_do_send_msg:"):
-        user_id_to_send = int(data.split(":")[1])
-        text_to_send = context.user_data.get("send_msg_text")
-        admin_id = query.from_user.id
+    await query.answer()
 
-        if not text_to_send:
-            await query.answer("Сообщение уже отправлено.", show_alert=True)
-            return ConversationStates.USER_MANAGE_USER
+    if await send_notification(update.get_bot(), user_id_to_send, f"*🔔 Уведомление*\n\nАдминистратор отправил вам сообщение.\n_Сообщение: {text_to_send}_"):
+        await query.message.chat.send_message("Сообщение отправлено.", reply_markup=get_main_kb(admin_id))
+    else:
+        await query.message.chat.send_message("Не удалось отправить сообщение (пользователь, возможно, не запускал бота).", reply_markup=get_main_kb(admin_id))
 
-        await query.answer()
+    await show_user_card(query, context, get_user(user_id_to_send), send_new=True)
+    context.user_data.pop("send_msg_text", None)
+    context.user_data.pop("send_msg_user", None)
+    return ConversationStates.USER_MANAGE_USER
 
-        try:
-            await update.get_bot().send_message(user_id_to_send,f"*🔔 Уведомление*\n\nАдминистратор отправил вам сообщение.\n_Сообщение: {text_to_send}_",parse_mode="Markdown")
-            await query.message.chat.send_message("Сообщение отправлено.", reply_markup=get_main_kb(admin_id))
-        except Exception:
-            await query.message.chat.send_message("Не удалось отправить сообщение (пользователь, возможно, не запускал бота).", reply_markup=get_main_kb(admin_id))
+@user_admin_router.route("broadcast_new")
+async def broadcast_new(update, context):
+    await edit_message_text(update.callback_query, "*📢 Рассылка*\n\n*🔎 Выберите получателей:*", parse_mode="Markdown", reply_markup=build_broadcast_segment_keyboard())
+    return ConversationStates.USER_MANAGE_MENU
 
-        user_obj = get_user(user_id_to_send)
-        page = context.user_data.get('users_page', 0)
-        await query.message.chat.send_message(build_user_manage_text(user_obj),reply_markup=build_user_manage_keyboard(user_obj, page),parse_mode="Markdown")
-        context.user_data.pop("send_msg_text", None)
-        context.user_data.pop("send_msg_user", None)
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("broadcast_segment", args=(str,))
+async def broadcast_segment(update, context, segment):
+    query = update.callback_query
+    if segment not in BROADCAST_SEGMENTS:
+        await query.answer("Неизвестная группа получателей.", show_alert=True)
+        return ConversationStates.USER_MANAGE_MENU
+    context.user_data["broadcast"] = {"segment": segment}
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Введите сообщение для рассылки:", reply_markup=get_cancel_kb())
+    return ConversationStates.BROADCAST_TEXT
 
-    if data.startswith("user_toggle_addition:") or data.startswith("user_toggle_download:") or data.startswith("user_toggle_rename:") or data.startswith("user_toggle_delete:") or data.startswith("user_set_folders_limit:"):
-        target_user_id = int(data.split(":")[1])
-        user = get_user(target_user_id)
-        if user and user.get("status") == "admin":
-            await query.answer("Нельзя изменить права администратора.", show_alert=True)
-            return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("broadcast_start")
+async def broadcast_start(update, context):
+    query = update.callback_query
+    user_id = query.from_user.id
+    draft = context.user_data.pop("broadcast", None)
+    if not draft or not draft.get("text"):
+        await query.answer("Рассылка уже запущена.", show_alert=True)
+        return ConversationStates.USER_MANAGE_MENU
+    await query.answer()
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Рассылка запущена.", reply_markup=get_main_kb(user_id))
+    progress = await query.message.chat.send_message("*📢 Рассылка запускается...*", parse_mode="Markdown")
+    broadcast = create_broadcast(user_id, draft["segment"], draft["text"], progress.chat_id, progress.message_id)
+    start_broadcast_task(context.bot, broadcast)
+    return ConversationStates.USER_MANAGE_MENU
 
-    if data.startswith("user_toggle_addition:"):
-        target_user_id = int(data.split(":")[1])
-        users = load_users()
-        for u in users:
-            if u.get("id") == target_user_id:
-                u["addition"] = not u.get("addition", True)
-                save_users(users)
-                break
-        user = get_user(target_user_id)
-        page = context.user_data.get('users_page', 0)
-        await query.answer()
-        await query.edit_message_text(build_user_manage_text(user), reply_markup=build_user_manage_keyboard(user, page), parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("broadcast_cancel")
+async def broadcast_cancel(update, context):
+    query = update.callback_query
+    context.user_data.pop("broadcast", None)
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("_Действие отменено._", parse_mode="Markdown", reply_markup=get_main_kb(query.from_user.id))
+    await show_users_list(query, context.user_data.get('users_page', 0), send_new=True)
+    return ConversationStates.USER_MANAGE_MENU
 
-    if data.startswith("user_toggle_download:"):
-        target_user_id = int(data.split(":")[1])
-        users = load_users()
-        for u in users:
-            if u.get("id") == target_user_id:
-                u["download"] = not u.get("download", True)
-                save_users(users)
-                break
-        user = get_user(target_user_id)
-        page = context.user_data.get('users_page', 0)
-        await query.answer()
-        await query.edit_message_text(build_user_manage_text(user), reply_markup=build_user_manage_keyboard(user, page), parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_toggle_addition", args=(int,))
+async def user_toggle_addition(update, context, target_user_id):
+    return await toggle_user_permission(update, context, target_user_id, "addition")
 
-    if data.startswith("user_toggle_rename:"):
-        target_user_id = int(data.split(":")[1])
-        users = load_users()
-        for u in users:
-            if u.get("id") == target_user_id:
-                u["rename"] = not u.get("rename", True)
-                save_users(users)
-                break
-        user = get_user(target_user_id)
-        page = context.user_data.get('users_page', 0)
-        await query.answer()
-        await query.edit_message_text(build_user_manage_text(user), reply_markup=build_user_manage_keyboard(user, page), parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_toggle_download", args=(int,))
+async def user_toggle_download(update, context, target_user_id):
+    return await toggle_user_permission(update, context, target_user_id, "download")
 
-    if data.startswith("user_toggle_delete:"):
-        target_user_id = int(data.split(":")[1])
-        users = load_users()
-        for u in users:
-            if u.get("id") == target_user_id:
-                u["delete"] = not u.get("delete", True)
-                save_users(users)
-                break
-        user = get_user(target_user_id)
-        page = context.user_data.get('users_page', 0)
-        await query.answer()
-        await query.edit_message_text(build_user_manage_text(user), reply_markup=build_user_manage_keyboard(user, page), parse_mode="Markdown")
-        return ConversationStates.USER_MANAGE_USER
+@user_admin_router.route("user_toggle_rename", args=(int,))
+async def user_toggle_rename(update, context, target_user_id):
+    return await toggle_user_permission(update, context, target_user_id, "rename")
 
-    if data.startswith("user_set_folders_limit:"):
-        target_user_id = int(data.split(":")[1])
-        context.user_data["set_limit_user"] = target_user_id
-        await query.edit_message_reply_markup(reply_markup=None)
-        await query.message.chat.send_message("Введите лимит для пользователя (0 - Нет лимита):", reply_markup=get_cancel_kb())
-        return ConversationStates.USER_SET_LIMIT
+@user_admin_router.route("user_toggle_delete", args=(int,))
+async def user_toggle_delete(update, context, target_user_id):
+    return await toggle_user_permission(update, context, target_user_id, "delete")
+
+@user_admin_router.route("user_set_folders_limit", args=(int,))
+async def user_set_folders_limit(update, context, target_user_id):
+    query = update.callback_query
+    user = get_user(target_user_id)
+    if user and user.get("status") == "admin":
+        await query.answer("Нельзя изменить права администратора.", show_alert=True)
+        return ConversationStates.USER_MANAGE_USER
+    context.user_data["set_limit_user"] = target_user_id
+    await edit_message_reply_markup(query)
+    await query.message.chat.send_message("Введите лимит для пользователя (0 - Нет лимита):", reply_markup=get_cancel_kb())
+    return ConversationStates.USER_SET_LIMIT
 
 # Обработка ввода лимита папок.
 async def user_set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2736,10 +5236,7 @@ async def user_add_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пароль пользователя изменен.", reply_markup=get_main_kb(update.effective_user.id))
         user = get_user(user_id)
         await update.message.reply_text(build_user_manage_text(user),reply_markup=build_user_manage_keyboard(user),parse_mode="Markdown")
-        try:
-            await update.get_bot().send_message(user_id,f"*🔔 Уведомление*\n\nАдминистратор изменил ваш пароль.\n_Новый пароль: {password}_",parse_mode="Markdown")
-        except Exception:
-            pass
+        await send_notification(update.get_bot(), user_id, f"*🔔 Уведомление*\n\nАдминистратор изменил ваш пароль.\n_Новый пароль: {password}_")
         return ConversationStates.USER_MANAGE_USER
 
     add_stage = context.user_data.get("add_stage", {})
@@ -2775,10 +5272,7 @@ async def user_add_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     add_user(user_id, password, "default", username)
     context.user_data.pop("add_stage", None)
     await update.message.reply_text("Пользователь добавлен!", reply_markup=get_main_kb(update.effective_user.id))
-    try:
-        await update.get_bot().send_message(user_id, f"*🔔 Уведомление*\n\nАдминистратор добавил вас в базу данных! Вы можете войти в бота.",parse_mode="Markdown")
-    except Exception:
-        pass
+    await send_notification(update.get_bot(), user_id, f"*🔔 Уведомление*\n\nАдминистратор добавил вас в базу данных! Вы можете войти в бота.")
     users = load_users()
     page = 0
     total_other = len([u for u in users if u.get('id') != update.effective_user.id])
@@ -2803,6 +5297,89 @@ async def user_send_msg_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(f"Вы точно хотите отправить данное сообщение пользователю `{user_id}`?\n\n"f"_Сообщение: {update.message.text}_",parse_mode="Markdown",reply_markup=build_confirm_send_msg_keyboard(user_id))
     return ConversationStates.USER_CONFIRM_SEND_MSG
 
+# Ввод текста рассылки (для администратора).
+async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_reply(update, context): return ConversationHandler.END
+    log_state(update, context, "broadcast_text")
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("Нет доступа.", reply_markup=get_main_kb(user_id))
+        return ConversationHandler.END
+
+    draft = context.user_data.get("broadcast")
+    if update.message.text == "🔙 Отмена" or not draft:
+        context.user_data.pop("broadcast", None)
+        await update.message.reply_text("_Действие отменено._" if draft else "Ошибка данных.", parse_mode="Markdown", reply_markup=get_main_kb(user_id))
+        users = load_users()
+        total_pages = max(1, (len([u for u in users if u.get('id') != user_id]) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
+        await update.message.reply_text(build_users_list_message(users), reply_markup=build_users_list_keyboard(users, user_id, 0, total_pages), parse_mode="Markdown")
+        return ConversationStates.USER_MANAGE_MENU
+
+    draft["text"] = update.message.text
+    total = count_broadcast_recipients(draft["segment"], user_id)
+    caption = BROADCAST_SEGMENTS[draft["segment"]][0]
+    await update.message.reply_text(
+        f"Вы точно хотите начать рассылку?\n\n```Информация\n👥 Получатели: {caption}\n📨 Всего: {total}```\n\n_Сообщение: {escape_md(update.message.text)}_",
+        parse_mode="Markdown",
+        reply_markup=build_broadcast_confirm_keyboard()
+    )
+    return ConversationStates.BROADCAST_CONFIRM
+
+# Остановка рассылки по кнопке в сообщении с прогрессом.
+async def broadcast_stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_inline(update, context): return
+    log_state(update, context, "broadcast_stop_callback")
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("Нет доступа.", show_alert=True)
+        return
+    broadcast_id = query.data.split(":")[1]
+    if stop_broadcast(broadcast_id):
+        await query.answer("Рассылка будет остановлена.")
+    else:
+        await query.answer("Рассылка уже завершена.", show_alert=True)
+
+# Профилирование обработчиков администратором: /profile [секунды | N u], /profile stop.
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await precheck_reply(update, context): return
+    log_state(update, context, "profile_command")
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Нет доступа.")
+        return
+    if context.args and context.args[0].lower() == "stop":
+        if profiler.active:
+            profiler.stop()
+            await update.message.reply_text("Профилирование остановлено, файл скоро будет отправлен.")
+        else:
+            await update.message.reply_text("Профилирование не запущено.")
+        return
+    parsed = parse_profile_args(context.args)
+    if parsed is None:
+        await update.message.reply_text("Использование: `/profile [секунды]`, `/profile 200u` (200 обновлений) или `/profile stop`.", parse_mode="Markdown")
+        return
+    seconds, updates = parsed
+    loop = asyncio.get_running_loop()
+    chat_id = update.effective_chat.id
+    on_done = lambda path, samples: asyncio.run_coroutine_threadsafe(send_profile(context.bot, chat_id, path, samples), loop)
+    if not profiler.start(seconds, updates, on_done):
+        await update.message.reply_text("Профилирование уже идёт. Завершить: /profile stop")
+        return
+    if updates:
+        await update.message.reply_text(f"Профилирование запущено на {updates} обновлений (не дольше {seconds} с).")
+    else:
+        await update.message.reply_text(f"Профилирование запущено на {seconds} с.")
+
+# Отправляет администратору файл профиля.
+async def send_profile(bot, chat_id, path, samples):
+    try:
+        if not samples:
+            await bot.send_message(chat_id, "Профилирование завершено: сэмплов нет.")
+            return
+        with open(path, "rb") as f:
+            await bot.send_document(chat_id, document=f, caption=f"Профиль: {samples} сэмплов. Формат collapsed stacks (flamegraph.pl, speedscope).")
+    except Exception as e:
+        log(f"Не удалось отправить профиль {path}: {e}", level=logging.WARNING)
+
 # Отмена отправки сообщения пользователю.
 async def cancel_confirm_send_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await precheck_reply(update, context): return ConversationHandler.END
@@ -2851,26 +5428,232 @@ async def ignore_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_state(update, context, "ignore_message")
     return
 
+#######################################
+######### ЗАПУСК И ГОТОВНОСТЬ #########
+#######################################
+
+# MongoDB ответила и индексы построены; до этого бот уже принимает обновления.
+mongo_indexes_ready = threading.Event()
+
+# Отмечает завершение этапа запуска (только первый раз).
+def mark_startup(phase):
+    startup_phases.setdefault(phase, round(time.perf_counter() - STARTUP_STARTED, 3))
+
+def format_startup_phases():
+    return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_phases.items())
+
+# Строит индексы MongoDB; пока база недоступна, повторяет попытки с растущей паузой (до минуты).
+def ensure_indexes():
+    delay = 1
+    while True:
+        try:
+            client.admin.command("ping")
+            mark_startup("mongo")
+            for collection, key, options in MONGO_INDEXES:
+                create_index(collection, key, options)
+            break
+        except Exception as e:
+            log(f"MongoDB недоступна или индексы не построены: {e}. Повтор через {delay} с", level=logging.WARNING)
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+    mongo_indexes_ready.set()
+    mark_startup("indexes")
+
+# Создаёт индекс; у существующего TTL-индекса с другим сроком (SESSION_ABANDON_TTL изменён) меняет срок.
+def create_index(collection, key, options):
+    try:
+        collection.create_index(key, **options)
+    except OperationFailure as e:
+        if e.code != 85 or "expireAfterSeconds" not in options:
+            raise
+        db.command("collMod", collection.name, index={"keyPattern": {key: 1}, "expireAfterSeconds": options["expireAfterSeconds"]})
+
+# Фоновый поток запуска: индексы, затем продолжение рассылок (в цикле событий) и индекс поиска.
+# Поток-демон не задерживает остановку бота, даже если MongoDB так и не стала доступна.
+def start_background_startup(app):
+    loop = asyncio.get_running_loop()
+
+    def run():
+        ensure_indexes()
+        try:
+            loop.call_soon_threadsafe(resume_broadcasts, app.bot)
+        except RuntimeError:
+            return  # бот уже остановлен
+        file_search_index.build()
+        mark_startup("search_index")
+        log(f"Startup complete: {format_startup_phases()}")
+
+    threading.Thread(target=run, name="startup", daemon=True).start()
+
+MetricCollector("bot_startup_seconds", "Время от начала запуска до завершения этапа: imports, init, ready, mongo, indexes, search_index.", ("phase",),
+                lambda: {(phase,): seconds for phase, seconds in startup_phases.items()})
+
+#####################################
+######### ПРОВЕРКИ ЗДОРОВЬЯ #########
+#####################################
+
+# Последние результаты фоновой проверки; /healthz и /readyz только отдают их.
+health_report = {"checked_at": None, "checks": {}, "live": False, "ready": False}
+# Отметки для проверки свежести получения обновлений (time.monotonic()).
+health_marks = {"last_poll": None, "last_update": None, "probe_started": None}
+health_task = None
+
+# Запросы getUpdates с отметкой последнего успешного ответа - для проверки, что polling жив.
+class PollingHealthRequest(HTTPXRequest):
+    async def do_request(self, *args, **kwargs):
+        status, payload = await super().do_request(*args, **kwargs)
+        if status == 200:
+            health_marks["last_poll"] = time.monotonic()
+        return status, payload
+
+# Свободное место в DATABASE_DIR.
+def check_disk():
+    free_mb = shutil.disk_usage(DATABASE_DIR).free // (1024 * 1024)
+    return {"ok": free_mb >= HEALTH_MIN_FREE_MB, "free_mb": free_mb, "min_mb": HEALTH_MIN_FREE_MB}
+
+# Очереди фоновой работы: обновления, ожидающие обработки, превью, рассылки, запись лога.
+def check_backlog(app):
+    processor = app.update_processor.stats() if hasattr(app.update_processor, "stats") else {}
+    updates = app.update_queue.qsize() + processor.get("queued", 0)
+    return {
+        "ok": updates <= HEALTH_MAX_BACKLOG,
+        "updates": updates,
+        "max_updates": HEALTH_MAX_BACKLOG,
+        "thumbnails": len(thumbnail_pending),
+        "broadcasts": sum(not task.done() for task in broadcast_tasks.values()),
+        "log_records": bot_log_queue.queue.qsize(),
+    }
+
+# Свежесть polling: сколько секунд назад getUpdates ответил (до первого ответа - с начала проверок).
+def check_polling(now):
+    last = health_marks["last_poll"] or health_marks["probe_started"]
+    age = round(now - last, 1)
+    return {"ok": age <= HEALTH_POLL_STALE, "last_poll_age": age, "max_age": HEALTH_POLL_STALE, "seen": health_marks["last_poll"] is not None}
+
+# Состояние вебхука по getWebhookInfo: недавние ошибки доставки при ожидающих обновлениях - неготовность.
+async def check_webhook(app):
+    info = await app.bot.get_webhook_info()
+    error_age = None
+    if info.last_error_date:
+        error_age = round((datetime.datetime.now(datetime.timezone.utc) - info.last_error_date).total_seconds())
+    failing = error_age is not None and error_age < 2 * HEALTH_WEBHOOK_INTERVAL and info.pending_update_count > 0
+    return {
+        "ok": not failing and info.pending_update_count <= HEALTH_MAX_BACKLOG,
+        "pending_updates": info.pending_update_count,
+        "last_error_age": error_age,
+        "last_error": info.last_error_message,
+    }
+
+# Задержка цикла событий: насколько позже просыпаются короткие паузы за период проверки (максимум).
+async def measure_loop_lag(duration, step=0.25):
+    loop = asyncio.get_running_loop()
+    lag = 0.0
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(step)
+        lag = max(lag, loop.time() - started - step)
+    return lag
+
+# Фоновая проверка: раз в HEALTH_PROBE_INTERVAL обновляет health_report. Запросы к базе и диску - в рабочем потоке.
+async def run_health_probe(app):
+    health_marks["probe_started"] = time.monotonic()
+    webhook = None
+    webhook_checked = 0.0
+    while True:
+        lag = await measure_loop_lag(HEALTH_PROBE_INTERVAL)
+        now = time.monotonic()
+        checks = {"loop": {"ok": lag <= HEALTH_MAX_LOOP_LAG, "lag": round(lag, 3), "max_lag": HEALTH_MAX_LOOP_LAG}}
+        try:
+            ok, latency_ms, error = await asyncio.wait_for(asyncio.to_thread(check_mongodb_connection), MONGO_TIMEOUT_MS / 1000 + 1)
+        except asyncio.TimeoutError:
+            ok, latency_ms, error = False, None, "timeout"
+        checks["mongo"] = {"ok": ok, "latency_ms": latency_ms, "error": error, "indexes_ready": mongo_indexes_ready.is_set()}
+        try:
+            checks["disk"] = await asyncio.to_thread(check_disk)
+        except OSError as e:
+            checks["disk"] = {"ok": False, "error": str(e)}
+        checks["backlog"] = check_backlog(app)
+        if BOT_RUN_MODE == "webhook":
+            if now - webhook_checked >= HEALTH_WEBHOOK_INTERVAL:
+                webhook_checked = now
+                try:
+                    webhook = await check_webhook(app)
+                except Exception as e:
+                    webhook = {"ok": False, "error": str(e)}
+            checks["webhook"] = webhook
+        elif app.updater is not None and app.updater.running:
+            checks["polling"] = check_polling(now)
+        if health_marks["last_update"] is not None:
+            checks["backlog"]["last_update_age"] = round(now - health_marks["last_update"], 1)
+
+        ready = all(check["ok"] for check in checks.values()) and mongo_indexes_ready.is_set()
+        if health_report["checked_at"] is not None and ready != health_report["ready"]:
+            failed = [name for name, check in checks.items() if not check["ok"]]
+            log(f"Readiness changed: {'ready' if ready else 'not ready'}" + (f" ({', '.join(failed)})" if failed else ""),
+                level=logging.INFO if ready else logging.WARNING)
+        health_report.update(checked_at=time.time(), checks=checks, live=True, ready=ready)
+
+# Отчёт о здоровье в JSON; status_ok - признак, по которому выбирается код ответа.
+def health_response(status_ok):
+    age = time.time() - health_report["checked_at"] if health_report["checked_at"] else None
+    body = {**health_report, "age": round(age, 1) if age is not None else None}
+    status = "200 OK" if status_ok else "503 Service Unavailable"
+    return status, "application/json; charset=utf-8", json.dumps(body, ensure_ascii=False).encode()
+
+# Жив ли процесс: цикл событий отвечает, и фоновая проверка выполнялась недавно.
+async def healthz_response():
+    fresh = health_report["checked_at"] is not None and time.time() - health_report["checked_at"] <= 3 * HEALTH_PROBE_INTERVAL + 5
+    return health_response(fresh)
+
+# Готов ли бот обслуживать пользователей: все проверки последнего прохода пройдены.
+async def readyz_response():
+    fresh = health_report["checked_at"] is not None and time.time() - health_report["checked_at"] <= 3 * HEALTH_PROBE_INTERVAL + 5
+    return health_response(fresh and health_report["ready"])
+
+metrics_http_routes.update({"/healthz": healthz_response, "/readyz": readyz_response})
+
+# Запускает фоновую проверку (нужна, только если работает HTTP-сервер метрик и проверок).
+def start_health_probe(app):
+    global health_task
+    if METRICS_PORT and health_task is None:
+        health_task = asyncio.create_task(run_health_probe(app))
+
+MetricCollector("bot_health_check", "Результат последней фоновой проверки: 1 - пройдена, 0 - нет.", ("check",),
+                lambda: {(name,): int(check["ok"]) for name, check in health_report["checks"].items()})
+MetricCollector("bot_event_loop_lag_seconds", "Наибольшая задержка цикла событий за последний период проверки.", (),
+                lambda: {(): health_report["checks"]["loop"]["lag"]} if "loop" in health_report["checks"] else {})
+
 ########################################
 ######### HANDLERS РЕГИСТРАЦИЯ #########
 ########################################
 
-# Инициализация и запуск.
-def main():
-    if LOG_ENABLED:
-        log("Bot starting...")
-
-    if not check_mongodb_connection():
-        log("Ошибка подключения к MongoDB. Бот не может быть запущен.")
-        return
-
-    os.makedirs(DATABASE_DIR, exist_ok=True)
+# Фоновые задачи после инициализации приложения; всё, что ждёт MongoDB, выполняется в фоновом потоке запуска.
+async def post_init(app: Application):
+    global bot_application
+    bot_application = app
+    await start_metrics_server()
+    start_health_probe(app)
+    session_store.start(app)
+    if hasattr(signal, "SIGUSR2"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, toggle_profiler_by_signal)
+        except (NotImplementedError, RuntimeError):
+            pass
+    mark_startup("ready")
+    log(f"Startup: {format_startup_phases()}")
+    start_background_startup(app)
 
+# Собирает Application со всеми обработчиками; request и rate_limit позволяют подменить доступ к Bot API (нагрузочные тесты).
+def build_application(request=None, rate_limit=True):
     main_conv = ConversationHandler(
-        entry_points=[MessageHandler(
-            filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"),
-            main_menu
-        )],
+        entry_points=[
+            MessageHandler(
+                filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"),
+                main_menu
+            ),
+            CommandHandler("search", search_command)
+        ],
         states={
             ConversationStates.FOLDER_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, create_folder),
@@ -2904,30 +5687,30 @@ def main():
             ],
             ConversationStates.USER_MANAGE_MENU: [
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_MANAGE_USER: [
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_ADD_ID: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, user_add_id),
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_ADD_PASS: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, user_add_pass),
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_ADD_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, user_add_name),
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_SEND_MSG: [
@@ -2943,31 +5726,62 @@ def main():
             ConversationStates.USER_SET_LIMIT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, user_set_limit),
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
-                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт)$"), main_menu),
+                MessageHandler(filters.Regex("^(➕ Создать папку|🗂 Список папок|⚙️ Управление пользователями|👁 Мой аккаунт|🔎 Поиск файлов)$"), main_menu),
                 MessageHandler(filters.ALL, unknown)
             ],
             ConversationStates.USER_DELETE_CONFIRM: [
                 CallbackQueryHandler(user_admin_callback, pattern=r".*"),
                 MessageHandler(filters.ALL, unknown)
             ],
+            ConversationStates.BROADCAST_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_text),
+                CallbackQueryHandler(user_admin_callback, pattern=r".*"),
+                MessageHandler(filters.ALL, unknown)
+            ],
+            ConversationStates.SEARCH_QUERY: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, search_files),
+                CallbackQueryHandler(folder_button_callback, pattern=r".*")
+            ],
+            ConversationStates.BROADCAST_CONFIRM: [
+                CallbackQueryHandler(user_admin_callback, pattern=r".*"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_text),
+                MessageHandler(filters.ALL, ignore_message)
+            ],
         },
-        fallbacks=[CommandHandler("start", start)],
-        map_to_parent={ConversationHandler.END: ConversationHandler.END}
+        fallbacks=[CommandHandler("start", start), CommandHandler("search", search_command)],
+        map_to_parent={ConversationHandler.END: ConversationHandler.END},
+        name="main",
+        persistent=SESSION_PERSISTENCE == "mongo"
     )
 
     guest_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^📥 Войти в аккаунт$"), guest_menu)],
         states={ConversationStates.AUTH: [MessageHandler(filters.TEXT & ~filters.COMMAND, auth)]},
         fallbacks=[CommandHandler("start", start)],
-        map_to_parent={ConversationHandler.END: ConversationHandler.END}
+        map_to_parent={ConversationHandler.END: ConversationHandler.END},
+        name="guest",
+        persistent=SESSION_PERSISTENCE == "mongo"
     )
 
-    if request:
-        app = Application.builder().token(API_TOKEN).request(request).build()
-    else:
-        app = Application.builder().token(API_TOKEN).build()
+    builder = Application.builder().token(API_TOKEN).post_init(post_init)
+    if rate_limit:
+        builder = builder.rate_limiter(outbound_limiter)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    elif BOT_RUN_MODE != "webhook":
+        builder = builder.get_updates_request(PollingHealthRequest(connection_pool_size=1))
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    if SESSION_PERSISTENCE == "mongo":
+        builder = builder.persistence(MongoPersistence())
+    if BOT_API_MODE == "local":
+        builder = builder.base_url(BOT_API_URL).local_mode(True)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CallbackQueryHandler(broadcast_stop_callback, pattern=r"^broadcast_stop:"))
+    app.add_handler(InlineQueryHandler(inline_search))
     app.add_handler(guest_conv)
     app.add_handler(main_conv)
     app.add_handler(CallbackQueryHandler(
@@ -2975,10 +5789,43 @@ def main():
         pattern=r"^(my_account_logout|noop|my_account_logout_confirm|my_account_logout_cancel)$"
     ))
     app.add_handler(MessageHandler(filters.ALL, unknown))
+    instrument_handlers(app)
+    return app
 
+# Инициализация и запуск.
+def main():
+    mark_startup("init")
     if LOG_ENABLED:
-        log("Handlers registered, polling starts...")
-    app.run_polling()
+        log("Bot starting...")
+
+    # Без секрета любой, кто достучится до вебхука, подделает обновление от имени администратора;
+    # без внешнего адреса PTB подставит https://127.0.0.1:8443, который Telegram не примет.
+    # Секрет не генерируется: экземпляры за одним вебхуком должны использовать один и тот же.
+    if BOT_RUN_MODE == "webhook":
+        if not WEBHOOK_URL:
+            sys.exit("BOT_RUN_MODE=webhook: задайте WEBHOOK_URL - внешний адрес, на который Telegram шлёт обновления.")
+        if not WEBHOOK_SECRET_TOKEN:
+            sys.exit("BOT_RUN_MODE=webhook: задайте WEBHOOK_SECRET_TOKEN - без него запросы к вебхуку не проверяются.")
+
+    os.makedirs(DATABASE_DIR, exist_ok=True)
+
+    app = build_application()
+
+    if BOT_RUN_MODE == "webhook":
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        if LOG_ENABLED:
+            log(f"Handlers registered, webhook server starts on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET_TOKEN
+        )
+    else:
+        if LOG_ENABLED:
+            log("Handlers registered, polling starts...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file